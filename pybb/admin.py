@@ -63,6 +63,7 @@ class PollAnswerAdmin(admin.TabularInline):
 
 class TopicAdmin(admin.ModelAdmin):
     list_display = ['name', 'forum', 'created', 'head', 'post_count', 'poll_type',]
+    list_select_related = ['forum', 'head']
     list_per_page = 20
     raw_id_fields = ['user', 'subscribers']
     ordering = ['-created']
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks for pybbm.
+
+Benchmarks are not collected by the regular test suite, run them explicitly::
+
+    python runtests.py pybb.benchmarks
+"""
+
+from __future__ import unicode_literals, print_function
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.html import strip_tags
+from django.utils.timezone import now as tznow
+from markdown import Markdown
+
+from pybb import defaults
+from pybb.markup import html_to_text
+from pybb.models import Category, Forum, Topic, Post
+from pybb.permissions import perms
+from pybb.tests import SharedTestModule
+from pybb.util import get_user_model, unescape
+
+User = get_user_model()
+
+
+class BenchmarkMixin(object):
+
+    def measure(self, func, repeat=1):
+        """
+        Run `func` `repeat` times, return (milliseconds, queries) per run
+        """
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.time()
+            for i in range(repeat):
+                func()
+            elapsed = time.time() - start
+        return elapsed * 1000 / repeat, len(ctx.captured_queries) / float(repeat)
+
+    def explain(self, qs):
+        """
+        Return query plan of queryset as list of lines
+        """
+        sql, params = qs.query.sql_with_params()
+        prefix = 'EXPLAIN QUERY PLAN' if connection.vendor == 'sqlite' else 'EXPLAIN'
+        cursor = connection.cursor()
+        cursor.execute('%s %s' % (prefix, sql), params)
+        return [' '.join('%s' % cell for cell in row) for row in cursor.fetchall()]
+
+    def report(self, title, header, rows):
+        widths = [max(len('%s' % r[i]) for r in [header] + rows) for i in range(len(header))]
+        print('\n%s' % title)
+        for row in [header] + rows:
+            print('  '.join(('%s' % cell).rjust(width) for cell, width in zip(row, widths)))
+
+
+class CountersBenchmark(BenchmarkMixin, TestCase, SharedTestModule):
+    """
+    Cost of writing one post should not depend on number of posts in forum
+    """
+    sizes = (10, 100, 1000)
+    repeat = 20
+
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+
+    def fill_forum(self, count):
+        topics_count = max(count // 10, 1)
+        existing = Topic.objects.filter(forum=self.forum).count()
+        Topic.objects.bulk_create([Topic(name='topic %s' % i, forum=self.forum, user=self.user)
+                                   for i in range(existing, topics_count)])
+        topics = list(Topic.objects.filter(forum=self.forum))
+        existing = Post.objects.filter(topic__forum=self.forum).count()
+        Post.objects.bulk_create([Post(topic=topics[i % len(topics)], user=self.user, body='post %s' % i,
+                                       body_html='post %s' % i, body_text='post %s' % i, created=tznow())
+                                  for i in range(existing, count)])
+        self.forum.update_counters()
+
+    def test_post_write_cost(self):
+        rows = []
+        for size in self.sizes:
+            self.fill_forum(size)
+            topic = Topic.objects.create(name='measured', forum=self.forum, user=self.user)
+            ms, queries = self.measure(
+                lambda: Post.objects.create(topic=topic, user=self.user, body='measured'), self.repeat)
+            rows.append((size, '%.2f' % ms, '%.1f' % queries))
+        self.report('Post creation cost by forum size', ('posts in forum', 'ms/post', 'queries/post'), rows)
+        self.assertEqual(len(set(row[2] for row in rows)), 1)
+
+
+def legacy_smile_it(smiles, str):
+    """
+    Smiles replacement as it was done before `defaults.compile_smiles`
+    """
+    s = str
+    for smile, url in smiles.items():
+        s = s.replace(smile, '<img src="%s%s%s" alt="smile" />' % (
+            settings.STATIC_URL, defaults.PYBB_SMILES_PREFIX, url))
+    return s
+
+
+class SmilesBenchmark(BenchmarkMixin, TestCase):
+    """
+    Single pass smiles replacement against replace() loop per smile
+    """
+    smiles_counts = (12, 100, 500)
+    text_sizes = (1, 10, 100)
+    repeat = 50
+
+    def get_smiles(self, count):
+        smiles = dict(defaults.PYBB_SMILES)
+        for i in range(count - len(smiles)):
+            smiles[':custom%s:' % i] = 'custom%s.png' % i
+        return smiles
+
+    def test_smile_it(self):
+        paragraph = '<p>Hello :) look at <a href="http://example.com/8)">this</a> :D ' \
+                    'some longer text without any smiles in it at all ;)</p>\n'
+        rows = []
+        for count in self.smiles_counts:
+            smiles = self.get_smiles(count)
+            smile_it = defaults.compile_smiles(smiles)
+            for size in self.text_sizes:
+                text = paragraph * size
+                legacy_ms, _ = self.measure(lambda: legacy_smile_it(smiles, text), self.repeat)
+                ms, _ = self.measure(lambda: smile_it(text), self.repeat)
+                rows.append((count, len(text), '%.3f' % legacy_ms, '%.3f' % ms))
+        self.report('Smiles replacement', ('smiles', 'html length', 'loop ms', 'single pass ms'), rows)
+
+
+def legacy_filter_topics(user, qs):
+    """
+    Topics filtering as it was done before visible forum ids sets
+    """
+    if not user.is_staff:
+        qs = qs.filter(Q(forum__hidden=False) & Q(forum__category__hidden=False))
+    if not user.is_superuser:
+        qs = qs.filter(Q(forum__moderators=user) | Q(user=user) | Q(on_moderation=False)).distinct()
+    return qs
+
+
+def legacy_filter_posts(user, qs):
+    """
+    Posts filtering (with premoderation) as it was done before visible forum ids sets
+    """
+    if not user.is_staff:
+        qs = qs.filter(Q(topic__forum__hidden=False) & Q(topic__forum__category__hidden=False))
+    if not user.is_superuser:
+        qs = qs.filter(Q(user=user) | Q(on_moderation=False) | Q(topic__forum__moderators=user))
+    return qs
+
+
+class VisibleForumsBenchmark(BenchmarkMixin, TestCase, SharedTestModule):
+    """
+    `forum_id IN (...)` filtering against joins to forum, category and moderators tables
+    """
+    forums = 20
+    topics = 500
+    repeat = 20
+
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        hidden_category = Category.objects.create(name='hidden', client=self.client_for, hidden=True)
+        forums = [Forum.objects.create(name='forum %s' % i, hidden=i % 5 == 0,
+                                       category=hidden_category if i % 7 == 0 else self.category)
+                  for i in range(self.forums)]
+        Topic.objects.bulk_create([Topic(name='topic %s' % i, forum=forums[i % len(forums)], user=self.user,
+                                         on_moderation=i % 10 == 0)
+                                   for i in range(self.topics)])
+        topics = list(Topic.objects.all())
+        Post.objects.bulk_create([Post(topic=topic, user=self.user, body='post', body_html='post',
+                                       body_text='post', created=tznow(), on_moderation=topic.on_moderation)
+                                  for topic in topics])
+        self.moderator = User.objects.create_user('moderator', 'moderator@localhost', 'moderator')
+        forums[1].moderators.add(self.moderator)
+        forums[2].moderators.add(self.moderator)
+
+    def compare(self, title, model, legacy_filter, new_filter):
+        orig_premoderation = defaults.PYBB_PREMODERATION
+        defaults.PYBB_PREMODERATION = True
+        try:
+            rows = []
+            for variant, func in (('joins', legacy_filter), ('forum ids', new_filter)):
+                user = User.objects.get(id=self.moderator.id)
+                qs = func(user, model.objects.order_by('-id'))
+                result = list(qs.values_list('id', flat=True))
+                ms, queries = self.measure(lambda: list(func(
+                    User.objects.get(id=self.moderator.id), model.objects.order_by('-id'))[:20]), self.repeat)
+                rows.append((variant, len(result), '%.2f' % ms, '%.1f' % queries))
+                print('\n%s %s plan:\n  %s' % (title, variant, '\n  '.join(self.explain(qs))))
+                if variant == 'joins':
+                    expected = result
+            self.report(title, ('filter', 'rows', 'ms/page', 'queries/page'), rows)
+            self.assertEqual(result, expected)
+        finally:
+            defaults.PYBB_PREMODERATION = orig_premoderation
+
+    def test_filter_topics(self):
+        self.compare('Topics filtering', Topic, legacy_filter_topics, perms.filter_topics)
+
+    def test_filter_posts(self):
+        self.compare('Posts filtering', Post, legacy_filter_posts, perms.filter_posts)
+
+
+class PaginationBenchmark(BenchmarkMixin, TestCase, SharedTestModule):
+    """
+    Keyset pagination against OFFSET and COUNT(*) on deep topic pages
+    """
+    posts = 5000
+    repeat = 5
+
+    def setUp(self):
+        self.create_user()
+        self.create_initial(post=False)
+        start = tznow()
+        Post.objects.bulk_create([Post(topic=self.topic, user=self.user, body='post', body_html='post',
+                                       body_text='post', created=start, position=i + 1)
+                                  for i in range(self.posts)])
+        Topic.objects.filter(pk=self.topic.pk).update(post_count=self.posts)
+
+    def test_topic_pages(self):
+        url = self.topic.get_absolute_url()
+        page_size = defaults.PYBB_TOPIC_PAGE_SIZE
+        last_page = self.posts // page_size
+        orig_keyset = defaults.PYBB_KEYSET_PAGINATION
+        rows = []
+        try:
+            for keyset in (False, True):
+                defaults.PYBB_KEYSET_PAGINATION = keyset
+                for page in (1, last_page // 2, last_page):
+                    ms, queries = self.measure(lambda: self.client.get(url, {'page': page}), self.repeat)
+                    rows.append(('keyset' if keyset else 'offset', page, '%.2f' % ms, '%.1f' % queries))
+        finally:
+            defaults.PYBB_KEYSET_PAGINATION = orig_keyset
+        self.report('Topic page cost by page number', ('pagination', 'page', 'ms/page', 'queries/page'), rows)
+
+
+MARKDOWN_CORPUS = [
+    'Hi all!\n\nI have a problem with **installation** on Ubuntu:\n\n'
+    '    $ pip install something\n    error: command failed\n\nAny ideas? :(',
+    '> I have a problem with installation\n\nTry `sudo apt-get install python-dev` first, '
+    'see [docs](http://example.com/docs/install.html) for details.',
+    'Changelog:\n\n* fixed *paging* in topics\n* new [feature][1]\n* speed up\n\n'
+    '[1]: http://example.com/features',
+    'Thanks, it works now ;)',
+    '## Summary\n\n1. First step\n2. Second step with <b>html</b> that should be escaped\n'
+    '3. Third step\n\n---\n\n_Regards_, John',
+]
+
+
+class MarkdownBenchmark(BenchmarkMixin, TestCase):
+    """
+    Markdown instance reused per thread against new instance per render
+    """
+    repeat = 200
+
+    def test_markdown_throughput(self):
+        def render_new():
+            for text in MARKDOWN_CORPUS:
+                Markdown(safe_mode='escape').convert(text)
+
+        def render_reused():
+            for text in MARKDOWN_CORPUS:
+                defaults.markdown_it(text)
+
+        rows = []
+        for title, func in (('new Markdown per post', render_new), ('markdown_it', render_reused)):
+            ms, _ = self.measure(func, self.repeat)
+            rows.append((title, '%.0f' % (len(MARKDOWN_CORPUS) * 1000 / ms)))
+        self.report('Markdown rendering', ('converter', 'posts/s'), rows)
+
+
+class HtmlToTextBenchmark(BenchmarkMixin, TestCase):
+    """
+    Single pass html_to_text against strip_tags and unescape
+    """
+    quote_depths = (1, 5, 20)
+    repeat = 20
+
+    def get_html(self, depth):
+        text = 'Lorem ipsum &quot;dolor&quot; sit amet, <a href="http://example.com/?a=1&amp;b=2">' \
+               'http://example.com/</a> &lt;consectetur&gt; <strong>adipiscing</strong> elit. ' \
+               '<img src="/static/pybb/emoticons/smile.png" alt="smile" /><br />\n' * 5
+        bbcode = '[quote="user"]%s[/quote]' % ('[b]Lorem[/b] ipsum "dolor" <sit> amet ;) ' * 10)
+        html = defaults.PYBB_MARKUP_ENGINES['bbcode'](bbcode)
+        for i in range(depth):
+            html = '<blockquote><em>user</em><br />%s</blockquote>%s' % (html, text)
+        return html
+
+    def test_html_to_text(self):
+        rows = []
+        for depth in self.quote_depths:
+            html = self.get_html(depth)
+            old_ms, _ = self.measure(lambda: unescape(strip_tags(html)), self.repeat)
+            ms, _ = self.measure(lambda: html_to_text(html), self.repeat)
+            rows.append((depth, len(html), '%.3f' % old_ms, '%.3f' % ms))
+        self.report('Html to text', ('quotes', 'html length', 'strip_tags+unescape ms', 'html_to_text ms'),
+                    rows)
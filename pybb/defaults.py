@@ -2,6 +2,8 @@
 
 from __future__ import unicode_literals
 import os.path
+import re
+import threading
 
 from django.conf import settings
 
@@ -57,15 +59,70 @@ PYBB_SMILES = getattr(settings, 'PYBB_SMILES', {
     ';)': 'wink.png'
 })
 
-def smile_it(str):
-    s = str
-    for smile, url in PYBB_SMILES.items():
-        s = s.replace(smile, '<img src="%s%s%s" alt="smile" />' % (settings.STATIC_URL, PYBB_SMILES_PREFIX, url))
-    return s
+
+def _trie_pattern(trie):
+    """
+    Regexp alternatives for words stored in trie, longer words go first
+    """
+    alternatives = [re.escape(char) + _trie_pattern(child)
+                    for char, child in sorted(trie.items()) if char]
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1 and '' not in trie:
+        return alternatives[0]
+    return '(?:%s)%s' % ('|'.join(alternatives), '?' if '' in trie else '')
+
+
+def compile_smiles(smiles):
+    """
+    Build function which replaces all smiles in html with one pass.
+    Tags and entities are matched too and left as is, so smiles are not
+    replaced inside tags and attributes and `&quot;)` doesn't end with a
+    wink. Longer smiles win over their prefixes.
+    """
+    if not smiles:
+        return lambda str: str
+    images = dict((smile, '<img src="%s%s%s" alt="smile" />' % (
+        settings.STATIC_URL, PYBB_SMILES_PREFIX, url)) for smile, url in smiles.items())
+    trie = {}
+    for smile in images:
+        node = trie
+        for char in smile:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    # every top level alternative starts with literal, so regexp engine
+    # can skip text that can't start a tag, smile or entity. Entities go
+    # after smiles, so smiles like '&gt;_&lt;' still win
+    pattern = re.compile('|'.join(['<[^>]*>'] + [
+        re.escape(char) + _trie_pattern(child) for char, child in sorted(trie.items())] + [
+        r'&#?\w+;']))
+
+    def replace(match):
+        text = match.group(0)
+        return images.get(text, text)
+
+    return lambda str: pattern.sub(replace, str)
+
+
+smile_it = compile_smiles(PYBB_SMILES)
+
+_markdown_local = threading.local()
+
+
+def markdown_it(str):
+    """
+    Convert markdown to html. Markdown instance is expensive to build,
+    so one instance is kept per thread and reset before each conversion
+    """
+    md = getattr(_markdown_local, 'converter', None)
+    if md is None:
+        md = _markdown_local.converter = Markdown(safe_mode='escape')
+    return md.reset().convert(str)
+
 
 PYBB_MARKUP_ENGINES = getattr(settings, 'PYBB_MARKUP_ENGINES', {
     'bbcode': lambda str: urlize(smile_it(render_bbcode(str, exclude_tags=['size', 'center']))),
-    'markdown': lambda str: urlize(smile_it(Markdown(safe_mode='escape').convert(str)))
+    'markdown': lambda str: urlize(smile_it(markdown_it(str)))
 })
 
 PYBB_QUOTE_ENGINES = getattr(settings, 'PYBB_QUOTE_ENGINES', {
@@ -75,6 +132,12 @@ PYBB_QUOTE_ENGINES = getattr(settings, 'PYBB_QUOTE_ENGINES', {
 
 PYBB_MARKUP = getattr(settings, 'PYBB_MARKUP', 'bbcode')
 
+PYBB_MARKUP_VERSION = getattr(settings, 'PYBB_MARKUP_VERSION', 1)
+
+PYBB_RENDER_CACHE_SIZE = getattr(settings, 'PYBB_RENDER_CACHE_SIZE', 1000)
+PYBB_RENDER_CACHE_BACKEND = getattr(settings, 'PYBB_RENDER_CACHE_BACKEND', None)
+PYBB_RENDER_CACHE_TIMEOUT = getattr(settings, 'PYBB_RENDER_CACHE_TIMEOUT', 60 * 60 * 24)
+
 PYBB_TEMPLATE = getattr(settings, 'PYBB_TEMPLATE', "base.html")
 PYBB_DEFAULT_AUTOSUBSCRIBE = getattr(settings, 'PYBB_DEFAULT_AUTOSUBSCRIBE', True)
 PYBB_ENABLE_ANONYMOUS_POST = getattr(settings, 'PYBB_ENABLE_ANONYMOUS_POST', False)
@@ -94,5 +157,14 @@ PYBB_AUTO_USER_PERMISSIONS = getattr(settings, 'PYBB_AUTO_USER_PERMISSIONS', Tru
 PYBB_USE_DJANGO_MAILER = getattr(settings, 'PYBB_USE_DJANGO_MAILER', False)
 
 PYBB_PERMISSION_HANDLER = getattr(settings, 'PYBB_PERMISSION_HANDLER', 'pybb.permissions.DefaultPermissionHandler')
+PYBB_MODERATORS_CACHE_TIMEOUT = getattr(settings, 'PYBB_MODERATORS_CACHE_TIMEOUT', 3600)
+PYBB_VISIBLE_FORUMS_CACHE_TIMEOUT = getattr(settings, 'PYBB_VISIBLE_FORUMS_CACHE_TIMEOUT', 300)
+
+PYBB_READ_TRACKER = getattr(settings, 'PYBB_READ_TRACKER', 'pybb.read_tracking.DefaultReadTracker')
+PYBB_READ_TRACKER_FLUSH_INTERVAL = getattr(settings, 'PYBB_READ_TRACKER_FLUSH_INTERVAL', 0)
+PYBB_READ_TRACKER_BUFFER_BACKEND = getattr(settings, 'PYBB_READ_TRACKER_BUFFER_BACKEND', 'default')
+PYBB_UNREAD_COUNTS_CACHE_TIMEOUT = getattr(settings, 'PYBB_UNREAD_COUNTS_CACHE_TIMEOUT', 300)
+
+PYBB_KEYSET_PAGINATION = getattr(settings, 'PYBB_KEYSET_PAGINATION', True)
 
 PYBB_PROFILE_RELATED_NAME = getattr(settings, 'PYBB_PROFILE_RELATED_NAME', 'pybb_profile')
@@ -9,6 +9,7 @@ from django.utils.translation import ugettext_lazy as _
 from pybb.models import Post, Topic
 
 from pybb.permissions import perms
+from pybb.util import filter_by_client
 
 
 class PybbFeed(Feed):
@@ -54,11 +55,12 @@ class LastPosts(PybbFeed):
     description_template = 'pybb/feeds/posts_description.html'
 
     def get_object(self, request, *args, **kwargs):
-        return request.user
+        return request.user, request.pybb_client
 
-    def items(self, user):
+    def items(self, obj):
+        user, client = obj
         ids = [p.id for p in perms.filter_posts(
-            user, Post.objects.only('id')).order_by('-created')[:15]]
+            user, filter_by_client(Post.objects.only('id'), client)).order_by('-created')[:15]]
         return Post.objects.filter(id__in=ids).select_related(
             'topic', 'topic__forum', 'user')
 
@@ -70,8 +72,11 @@ class LastTopics(PybbFeed):
     description_template = 'pybb/feeds/topics_description.html'
 
     def get_object(self, request, *args, **kwargs):
-        return request.user
+        return request.user, request.pybb_client
 
-    def items(self, user):
+    def items(self, obj):
+        user, client = obj
         return perms.filter_topics(
-            user, Topic.objects.all()).order_by('-created')[:15]
+            user, filter_by_client(Topic.objects, client).select_related(
+                'forum__category__client', 'head__user')
+        ).order_by('-created')[:15]
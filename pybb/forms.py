@@ -79,7 +79,7 @@ class PostForm(forms.ModelForm):
         if not (self.topic or self.forum or ('instance' in kwargs)):
             raise ValueError('You should provide topic, forum or instance')
             #Handle topic subject, poll type and question if editing topic head
-        if kwargs.get('instance', None) and (kwargs['instance'].topic.head == kwargs['instance']):
+        if kwargs.get('instance', None) and (kwargs['instance'].topic.head_id == kwargs['instance'].id):
             kwargs.setdefault('initial', {})['name'] = kwargs['instance'].topic.name
             kwargs.setdefault('initial', {})['poll_type'] = kwargs['instance'].topic.poll_type
             kwargs.setdefault('initial', {})['poll_question'] = kwargs['instance'].topic.poll_question
@@ -87,7 +87,7 @@ class PostForm(forms.ModelForm):
         super(PostForm, self).__init__(**kwargs)
 
         # remove topic specific fields
-        if not (self.forum or (self.instance.pk and (self.instance.topic.head == self.instance))):
+        if not (self.forum or (self.instance.pk and (self.instance.topic.head_id == self.instance.id))):
             del self.fields['name']
             del self.fields['poll_type']
             del self.fields['poll_question']
@@ -121,7 +121,7 @@ class PostForm(forms.ModelForm):
             post = super(PostForm, self).save(commit=False)
             if self.user:
                 post.user = self.user
-            if post.topic.head == post:
+            if post.topic.head_id == post.id:
                 post.topic.name = self.cleaned_data['name']
                 if self.may_create_poll:
                     post.topic.poll_type = self.cleaned_data['poll_type']
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from pybb.models import Topic, Forum
+
+
+class Command(BaseCommand):
+    help = 'Fill stored last post of topics and forums'
+
+    def handle(self, *args, **options):
+
+        topics = 0
+        for topic in Topic.objects.all().iterator():
+            topic.refresh_last_post()
+            topics += 1
+        self.stdout.write('Successfully updated %d topics\n' % topics)
+
+        forums = 0
+        for forum in Forum.objects.all().iterator():
+            forum.refresh_last_post()
+            forums += 1
+        self.stdout.write('Successfully updated %d forums\n' % forums)
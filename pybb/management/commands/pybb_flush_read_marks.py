@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from pybb import read_tracking
+
+
+class Command(BaseCommand):
+    help = 'Write read marks buffered when PYBB_READ_TRACKER_FLUSH_INTERVAL is set to database'
+
+    def handle(self, *args, **options):
+        if not isinstance(read_tracking.read_tracker, read_tracking.BufferedReadTracker):
+            self.stdout.write('Read marks are not buffered\n')
+            return
+        count = read_tracking.read_tracker.flush()
+        self.stdout.write('Successfully written %d read marks\n' % count)
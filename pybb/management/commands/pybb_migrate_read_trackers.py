@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from pybb.models import TopicReadTracker, ForumReadTracker, ForumReadWatermark, atomic_func
+
+
+class Command(BaseCommand):
+    help = ('Convert TopicReadTracker and ForumReadTracker rows to ForumReadWatermark rows '
+            'used by pybb.read_tracking.WatermarkReadTracker')
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+                    help='Users converted at once (default 500)'),
+        make_option('--delete', dest='delete', action='store_true', default=False,
+                    help='Delete converted TopicReadTracker and ForumReadTracker rows'),
+    )
+
+    def convert(self, user_ids):
+        """
+        Replace watermarks of `user_ids` with ones built from read trackers,
+        return count of created watermarks
+        """
+        marks = {}
+        for user_id, forum_id, time_stamp in ForumReadTracker.objects.filter(
+                user__in=user_ids, forum__isnull=False).values_list('user', 'forum', 'time_stamp'):
+            marks[(user_id, forum_id)] = (time_stamp, {})
+        for user_id, forum_id, topic_id, time_stamp in TopicReadTracker.objects.filter(
+                user__in=user_ids, topic__isnull=False).values_list(
+                    'user', 'topic__forum', 'topic', 'time_stamp'):
+            forum_time_stamp, topic_marks = marks.setdefault((user_id, forum_id), (None, {}))
+            if forum_time_stamp is None or time_stamp > forum_time_stamp:
+                topic_marks[topic_id] = time_stamp
+
+        watermarks = []
+        for (user_id, forum_id), (time_stamp, topic_marks) in marks.items():
+            watermark = ForumReadWatermark(user_id=user_id, forum_id=forum_id, time_stamp=time_stamp)
+            watermark.set_topics(topic_marks)
+            watermarks.append(watermark)
+        with atomic_func():
+            ForumReadWatermark.objects.filter(user__in=user_ids).delete()
+            ForumReadWatermark.objects.bulk_create(watermarks)
+        return len(watermarks)
+
+    def handle(self, *args, **options):
+        user_ids = sorted(
+            set(ForumReadTracker.objects.values_list('user', flat=True).distinct()) |
+            set(TopicReadTracker.objects.values_list('user', flat=True).distinct()))
+        chunk_size = options['chunk_size']
+        created = 0
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            created += self.convert(chunk)
+            self.stdout.write('%d/%d users processed, %d watermarks created\n' % (
+                start + len(chunk), len(user_ids), created))
+        if options['delete']:
+            TopicReadTracker.objects.all().delete()
+            ForumReadTracker.objects.all().delete()
+            self.stdout.write('Read trackers deleted\n')
+        self.stdout.write('Successfully converted read marks of %d users\n' % len(user_ids))
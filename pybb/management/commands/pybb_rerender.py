@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+from __future__ import unicode_literals
+import datetime
+import multiprocessing
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from pybb import defaults
+from pybb.markup import html_to_text, markup_hash
+from pybb.models import Post, atomic_func
+from pybb.util import get_pybb_profile_model
+
+# rows per single UPDATE statement, keeps query parameters count
+# below sqlite limit
+UPDATE_BATCH_SIZE = 100
+
+
+def render_post(row):
+    """
+    Render (id, body, body_hash) row, return (id, html, text, hash) or None
+    if rendered version is up to date. Runs in pool worker, so it calls
+    markup engine directly, bypassing render cache which may contain stale
+    html.
+    """
+    pk, body, body_hash, force = row
+    new_hash = markup_hash(body)
+    if not force and new_hash == body_hash:
+        return None
+    html = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP](body)
+    return pk, html, html_to_text(html), new_hash
+
+
+def render_signature(row):
+    """
+    Render (id, signature, signature_hash) row, return (id, html, hash) or
+    None if rendered version is up to date
+    """
+    pk, signature, signature_hash, force = row
+    new_hash = markup_hash(signature)
+    if not force and new_hash == signature_hash:
+        return None
+    return pk, defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP](signature), new_hash
+
+
+def bulk_update(model, fields, rows):
+    """
+    Update `fields` of `model` with values from (pk, value, ...) rows using
+    one UPDATE ... CASE statement per batch. Signals are not sent.
+    """
+    qn = connection.ops.quote_name
+    pk_column = qn(model._meta.pk.column)
+    columns = [qn(model._meta.get_field(name).column) for name in fields]
+    cursor = connection.cursor()
+    for start in range(0, len(rows), UPDATE_BATCH_SIZE):
+        batch = rows[start:start + UPDATE_BATCH_SIZE]
+        params = []
+        assignments = []
+        for i, column in enumerate(columns):
+            assignments.append('%s = CASE %s %s END' % (
+                column, pk_column, ' '.join(['WHEN %s THEN %s'] * len(batch))))
+            for row in batch:
+                params.extend((row[0], row[i + 1]))
+        params.extend(row[0] for row in batch)
+        cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+            qn(model._meta.db_table), ', '.join(assignments), pk_column,
+            ', '.join(['%s'] * len(batch))), params)
+
+
+class Command(BaseCommand):
+    help = 'Render html and text versions of posts and signatures again'
+    option_list = BaseCommand.option_list + (
+        make_option('--client', dest='client',
+                    help='Render only posts of client with this code'),
+        make_option('--forum', dest='forums', action='append', type='int', default=[],
+                    help='Render only posts of forum with this id, may be repeated'),
+        make_option('--from', dest='date_from',
+                    help='Render only posts created at this date (YYYY-MM-DD) or later'),
+        make_option('--to', dest='date_to',
+                    help='Render only posts created before this date (YYYY-MM-DD)'),
+        make_option('--start-id', dest='start_id', type='int', default=0,
+                    help='Resume rendering from post with this id'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+                    help='Posts fetched and updated at once (default 1000)'),
+        make_option('--processes', dest='processes', type='int', default=None,
+                    help='Worker processes count (default is cpu count), 1 disables pool'),
+        make_option('--force', dest='force', action='store_true', default=False,
+                    help='Render posts and signatures which are rendered with current markup too'),
+        make_option('--signatures', dest='signatures', action='store_true', default=False,
+                    help='Render profile signatures too'),
+    )
+
+    def parse_date(self, value):
+        try:
+            date = datetime.datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            raise CommandError('Wrong date "%s", use YYYY-MM-DD format' % value)
+        if settings.USE_TZ:
+            date = timezone.make_aware(date, timezone.get_current_timezone())
+        return date
+
+    def get_posts(self, options):
+        posts = Post.objects.all()
+        if options['client']:
+            posts = posts.filter(client__code=options['client'])
+        if options['forums']:
+            posts = posts.filter(topic__forum_id__in=options['forums'])
+        if options['date_from']:
+            posts = posts.filter(created__gte=self.parse_date(options['date_from']))
+        if options['date_to']:
+            posts = posts.filter(created__lt=self.parse_date(options['date_to']))
+        return posts
+
+    def process(self, queryset, fields, updated_fields, render, map_func,
+                chunk_size, start_id=0, extra=()):
+        """
+        Stream (pk, fields...) rows of queryset in primary key order, render
+        them with `map_func` and write (pk, updated_fields...) results back
+        """
+        total = queryset.filter(pk__gte=start_id).count()
+        done = updated = 0
+        last_id = start_id - 1
+        while True:
+            rows = list(queryset.filter(pk__gt=last_id).order_by('pk').values_list(
+                'pk', *fields)[:chunk_size])
+            if not rows:
+                break
+            results = [result for result in map_func(render, [row + extra for row in rows])
+                       if result is not None]
+            with atomic_func():
+                bulk_update(queryset.model, updated_fields, results)
+            last_id = rows[-1][0]
+            done += len(rows)
+            updated += len(results)
+            self.stdout.write('%d/%d processed, %d updated, last id %d\n' % (
+                done, total, updated, last_id))
+        return updated
+
+    def handle(self, *args, **options):
+        processes = options['processes'] or multiprocessing.cpu_count()
+        chunk_size = options['chunk_size']
+        pool = None
+        map_func = map
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            map_func = lambda func, rows: pool.map(
+                func, rows, max(len(rows) // (processes * 4), 1))
+
+        try:
+            updated = self.process(
+                self.get_posts(options), ('body', 'body_hash'),
+                ('body_html', 'body_text', 'body_hash'), render_post, map_func,
+                chunk_size, options['start_id'], extra=(options['force'],))
+            self.stdout.write('Successfully rendered %d posts\n' % updated)
+
+            if options['signatures']:
+                profiles = get_pybb_profile_model().objects.exclude(signature='')
+                updated = self.process(
+                    profiles, ('signature', 'signature_hash'), ('signature_html', 'signature_hash'),
+                    render_signature, map_func, chunk_size, extra=(options['force'],))
+                self.stdout.write('Successfully rendered %d signatures\n' % updated)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
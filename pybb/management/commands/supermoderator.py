@@ -21,3 +21,4 @@ class Command(BaseCommand):
             forum.moderators.remove(user)
             if action == 'add':
                 forum.moderators.add(user)
+        util.invalidate_moderators()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of user text with markup engines from ``PYBB_MARKUP_ENGINES``.
+
+Rendered html is cached by hash of engine name, engine version and source
+text. First tier is bounded LRU in process memory, second optional tier is
+django cache shared between processes (``PYBB_RENDER_CACHE_BACKEND``).
+"""
+from __future__ import unicode_literals
+import re
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+
+from django.utils import six
+from django.utils.six.moves import html_entities
+
+from pybb import defaults
+from pybb.util import build_cache_key, get_cache
+
+
+def markup_hash(text, markup=None):
+    """
+    Hash of text together with markup engine and its version, so changing
+    any of them gives another hash
+    """
+    return sha1(('%s:%s:%s' % (
+        markup or defaults.PYBB_MARKUP, defaults.PYBB_MARKUP_VERSION, text)
+    ).encode('utf-8')).hexdigest()
+
+
+_html_token_re = re.compile(
+    r'<!--.*?-->|<[^>]*>|&(?:#(\d+)|#[xX]([0-9a-fA-F]+)|([a-zA-Z][a-zA-Z0-9]*));',
+    re.DOTALL)
+
+
+def _html_token_to_text(match):
+    decimal, hexadecimal, name = match.groups()
+    try:
+        if decimal:
+            return six.unichr(int(decimal))
+        if hexadecimal:
+            return six.unichr(int(hexadecimal, 16))
+    except (ValueError, OverflowError):
+        return match.group(0)
+    if name:
+        if name in html_entities.name2codepoint:
+            return six.unichr(html_entities.name2codepoint[name])
+        return match.group(0)
+    # tag or comment
+    return ''
+
+
+def html_to_text(html):
+    """
+    Plain text version of html generated with markup engine. Tags and
+    comments are removed and all entities are decoded in one pass
+    """
+    return _html_token_re.sub(_html_token_to_text, html)
+
+
+_shared_cache_local = threading.local()
+
+
+def get_shared_cache():
+    """
+    Django cache with ``PYBB_RENDER_CACHE_BACKEND`` alias or None. Backend is
+    resolved once per thread, as django cache connections are thread local
+    """
+    alias = defaults.PYBB_RENDER_CACHE_BACKEND
+    if not alias:
+        return None
+    cached = getattr(_shared_cache_local, 'cache', None)
+    if cached is None or cached[0] != alias:
+        cached = _shared_cache_local.cache = (alias, get_cache(alias))
+    return cached[1]
+
+
+class RenderCache(object):
+    """
+    Thread safe LRU cache of rendered html with optional shared tier
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._items = OrderedDict()
+            self.hits = self.shared_hits = self.misses = 0
+
+    def stats(self):
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+        }
+
+    def _get_local(self, key):
+        with self._lock:
+            try:
+                html = self._items.pop(key)
+            except KeyError:
+                return None
+            self._items[key] = html
+            self.hits += 1
+            return html
+
+    def _set_local(self, key, html):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = html
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def get_or_render(self, key, render):
+        html = self._get_local(key)
+        if html is not None:
+            return html
+
+        shared_cache = get_shared_cache()
+        cache_key = build_cache_key('rendered_markup', hash=key)
+        if shared_cache is not None:
+            html = shared_cache.get(cache_key)
+            if html is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                self._set_local(key, html)
+                return html
+
+        with self._lock:
+            self.misses += 1
+        html = render()
+        self._set_local(key, html)
+        if shared_cache is not None:
+            shared_cache.set(
+                cache_key, html, defaults.PYBB_RENDER_CACHE_TIMEOUT)
+        return html
+
+
+render_cache = RenderCache(defaults.PYBB_RENDER_CACHE_SIZE)
+
+
+def render_markup(text, markup=None):
+    """
+    Render text with markup engine (PYBB_MARKUP by default) using cache
+    """
+    markup = markup or defaults.PYBB_MARKUP
+    engine = defaults.PYBB_MARKUP_ENGINES[markup]
+    return render_cache.get_or_render(
+        markup_hash(text, markup), lambda: engine(text))
@@ -77,3 +77,7 @@ class PybbRouterMiddleware(object):
                             PermissionDecoratorLoader(config_data.get(
                                 'permission_decorators'))
                     break
+        if request.pybb_client and hasattr(request, 'user'):
+            # limit forums visible in permission checks to this client
+            from pybb.permissions import get_permission_context
+            get_permission_context(request.user, request.pybb_client)
@@ -3,23 +3,26 @@ from __future__ import unicode_literals
 import functools
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
-from django.db.models.signals import post_delete, post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from pybb.markup import html_to_text, markup_hash, render_markup
 from pybb.profiles import PybbProfile
 from pybb.subscription import notify_topic_subscribers
 
 from django.db import models, transaction
+from django.db.models import F, Max, Q, Sum
 from django.core.urlresolvers import reverse
 from django.db.utils import IntegrityError
 from django.utils.encoding import python_2_unicode_compatible
-from django.utils.html import strip_tags
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import now as tznow
 
 from annoying.fields import AutoOneToOneField
 
 from pybb.util import (
-    unescape, get_user_model, get_username_field, get_pybb_profile_model,
-    get_pybb_profile, get_file_path)
+    get_user_model, get_username_field, get_pybb_profile_model,
+    get_pybb_profile, get_file_path, bulk_insert, upsert_supported,
+    invalidate_unread_counts, invalidate_moderators, invalidate_visible_forums,
+    datetime_to_micro, micro_to_datetime, FieldTrackerMixin)
 
 User = get_user_model()
 username_field = get_username_field()
@@ -44,6 +47,14 @@ except ImportError:
     from django.db.transaction import commit_on_success as atomic_func
 
 
+def _is_latest(post, obj):
+    """
+    Check if `post` is not older than the latest post of `obj` (topic or
+    forum), i.e. if it should become `obj.last_post`
+    """
+    return obj.updated is None or (post.updated or post.created) >= obj.updated
+
+
 @python_2_unicode_compatible
 class Client(models.Model):
     name = models.CharField(_('Name'), max_length=80)
@@ -59,7 +70,7 @@ class Client(models.Model):
 
 
 @python_2_unicode_compatible
-class Category(models.Model):
+class Category(FieldTrackerMixin, models.Model):
     client = models.ForeignKey(
         Client, related_name='client_forums', verbose_name=_('Client'))
     name = models.CharField(_('Name'), max_length=80)
@@ -69,6 +80,8 @@ class Category(models.Model):
         help_text=_('If checked, this category will be visible only for staff')
     )
 
+    tracked_fields = ('client_id',)
+
     class Meta(object):
         ordering = ['position']
         verbose_name = _('Category')
@@ -77,6 +90,14 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        client_changed = self.pk is not None and self.field_changed('client_id')
+        super(Category, self).save(*args, **kwargs)
+        if client_changed:
+            Topic.objects.filter(forum__category=self).update(client=self.client_id)
+            Post.objects.filter(topic__forum__category=self).update(client=self.client_id)
+        self.reset_tracked_fields()
+
     def forum_count(self):
         return self.forums.all().count()
 
@@ -104,7 +125,7 @@ class Category(models.Model):
 
 
 @python_2_unicode_compatible
-class Forum(models.Model):
+class Forum(FieldTrackerMixin, models.Model):
     category = models.ForeignKey(
         Category, related_name='forums', verbose_name=_('Category'))
     parent = models.ForeignKey(
@@ -123,6 +144,14 @@ class Forum(models.Model):
     readed_by = models.ManyToManyField(
         User, through='ForumReadTracker', related_name='readed_forums')
     headline = models.TextField(_('Headline'), blank=True, null=True)
+    last_post = models.ForeignKey(
+        'Post', related_name='+', verbose_name=_('Last post'),
+        blank=True, null=True, on_delete=models.SET_NULL)
+    # materialized path: ids of ancestors and forum itself, e.g. "1/5/12/"
+    path = models.CharField(
+        _('Path'), max_length=255, blank=True, db_index=True, editable=False)
+
+    tracked_fields = ('parent_id', 'category_id', 'hidden')
 
     class Meta(object):
         ordering = ['position']
@@ -132,47 +161,175 @@ class Forum(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        parent_changed = self.field_changed('parent_id')
+        category_changed = self.field_changed('category_id')
+        visibility_changed = category_changed or self.field_changed('hidden')
+        super(Forum, self).save(*args, **kwargs)
+        if parent_changed:
+            self.update_path()
+        if category_changed:
+            self.update_client()
+        if visibility_changed:
+            invalidate_visible_forums()
+        self.reset_tracked_fields()
+
+    def update_client(self):
+        """
+        Copy client of forum category to topics and posts of forum
+        """
+        client_id = self.category.client_id
+        Topic.objects.filter(forum=self).exclude(client=client_id).update(client=client_id)
+        Post.objects.filter(topic__forum=self).exclude(client=client_id).update(client=client_id)
+
+    def update_path(self):
+        """
+        Build `path` from parent path and move whole subtree with it
+        """
+        old_path = self.path
+        self.path = '%s%d/' % (self.parent.path if self.parent_id else '',
+                               self.id)
+        if old_path == self.path:
+            return
+        Forum.objects.filter(pk=self.pk).update(path=self.path)
+        if old_path:
+            for pk, path in Forum.objects.filter(
+                    path__startswith=old_path).exclude(
+                    pk=self.pk).values_list('pk', 'path'):
+                Forum.objects.filter(pk=pk).update(
+                    path=self.path + path[len(old_path):])
+
     def update_counters(self):
+        """
+        Recalculate counters from scratch.
+
+        Counters are maintained incrementally by `change_counters` on every
+        post/topic change, so this is only needed to repair them
+        (see `pybb_update_counters` command)
+        """
         posts = Post.objects.filter(topic__forum_id=self.id)
         self.post_count = posts.count()
         self.topic_count = Topic.objects.filter(forum=self).count()
         try:
             last_post = posts.order_by('-created')[0]
             self.updated = last_post.updated or last_post.created
+            self.last_post = last_post
         except IndexError:
-            pass
+            self.last_post = None
 
         self.save()
 
+    def change_counters(self, post_delta=0, topic_delta=0, last_post=None):
+        """
+        Atomically apply counter deltas with single UPDATE query and
+        mirror them on this instance. If `last_post` passed, it becomes
+        the latest post of forum
+        """
+        values = {}
+        if post_delta:
+            values['post_count'] = F('post_count') + post_delta
+            self.post_count += post_delta
+        if topic_delta:
+            values['topic_count'] = F('topic_count') + topic_delta
+            self.topic_count += topic_delta
+        if last_post is not None:
+            values['last_post'] = self.last_post = last_post
+            values['updated'] = self.updated = \
+                last_post.updated or last_post.created
+        if values:
+            Forum.objects.filter(pk=self.pk).update(**values)
+
+    def refresh_last_post(self):
+        """
+        Reread `last_post` and `updated` from the latest post of forum.
+        Should be called only when the latest post leaves forum
+        (deletion or move)
+        """
+        last_post = Post.objects.filter(topic__forum_id=self.id).order_by(
+            '-created').first()
+        if last_post is None:
+            self.last_post = None
+            Forum.objects.filter(pk=self.pk).update(last_post=None)
+        else:
+            self.change_counters(last_post=last_post)
+
     def get_absolute_url(self):
         return reverse('%s_pybb:forum' % self.category.client_code, kwargs={
             'pk': self.id})
 
     @property
     def posts(self):
-        return Post.objects.filter(topic__forum=self).select_related()
+        return Post.objects.filter(topic__forum=self).select_related(
+            'topic', 'user')
 
     @property
-    def last_post(self):
-        try:
-            return self.posts.order_by('-created')[0]
-        except IndexError:
-            return None
+    def subtree_topics(self):
+        """
+        Topics of this forum and all its subforums
+        """
+        if not self.path:
+            return Topic.objects.filter(forum__in=self._get_descendant_ids(include_self=True))
+        return Topic.objects.filter(forum__path__startswith=self.path)
+
+    def _get_descendant_ids(self, include_self=False):
+        """
+        Ids of subforums at any depth walking children level by level, used
+        while `path` is not built yet
+        """
+        ids = [self.pk] if include_self else []
+        level = [self.pk]
+        while level:
+            level = list(Forum.objects.filter(parent__in=level).values_list('id', flat=True))
+            ids.extend(level)
+        return ids
+
+    def get_descendants(self, include_self=False):
+        """
+        All subforums at any depth
+        """
+        if not self.path:
+            # path is not built yet, empty prefix would match every forum
+            return Forum.objects.filter(pk__in=self._get_descendant_ids(include_self))
+        forums = Forum.objects.filter(path__startswith=self.path)
+        if not include_self:
+            forums = forums.exclude(pk=self.pk)
+        return forums
+
+    def get_subtree_counters(self):
+        """
+        Topics and posts count of this forum together with subforums
+        """
+        counters = self.get_descendants(include_self=True).aggregate(
+            topic_count=Sum('topic_count'), post_count=Sum('post_count'))
+        return dict((key, value or 0) for key, value in counters.items())
+
+    def get_ancestors(self):
+        """
+        Parent forums starting from the root one, loaded with one query
+        """
+        if not self.path:
+            # path is not built yet, walk parents one by one
+            ancestors = []
+            parent = self.parent
+            while parent is not None:
+                ancestors.insert(0, parent)
+                parent = parent.parent
+            return ancestors
+        ids = [int(pk) for pk in self.path.split('/') if pk][:-1]
+        if not ids:
+            return []
+        forums = Forum.objects.select_related('category__client').in_bulk(ids)
+        return [forums[pk] for pk in ids if pk in forums]
 
     def get_parents(self):
         """
         Used in templates for breadcrumb building
         """
-        parents = [self.category]
-        parent = self.parent
-        while parent is not None:
-            parents.insert(1, parent)
-            parent = parent.parent
-        return parents
+        return [self.category] + self.get_ancestors()
 
 
 @python_2_unicode_compatible
-class Topic(models.Model):
+class Topic(FieldTrackerMixin, models.Model):
     POLL_TYPE_NONE = 0
     POLL_TYPE_SINGLE = 1
     POLL_TYPE_MULTIPLE = 2
@@ -202,66 +359,149 @@ class Topic(models.Model):
     poll_type = models.IntegerField(
         _('Poll type'), choices=POLL_TYPE_CHOICES, default=POLL_TYPE_NONE)
     poll_question = models.TextField(_('Poll question'), blank=True, null=True)
+    last_post = models.ForeignKey(
+        'Post', related_name='+', verbose_name=_('Last post'),
+        blank=True, null=True, on_delete=models.SET_NULL)
+    head = models.ForeignKey(
+        'Post', related_name='+', verbose_name=_('Head post'),
+        blank=True, null=True, on_delete=models.SET_NULL)
+    # client of forum category, stored to select topics of client without joins
+    client = models.ForeignKey(
+        Client, related_name='topics', verbose_name=_('Client'),
+        blank=True, null=True, editable=False)
+
+    tracked_fields = ('forum_id',)
 
     class Meta(object):
         ordering = ['-created']
         verbose_name = _('Topic')
         verbose_name_plural = _('Topics')
+        index_together = [['client', 'updated'], ['client', 'created'], ['forum', 'sticky', 'updated']]
 
     def __str__(self):
         return self.name
 
-    @property
-    def head(self):
-        """
-        Get first post and cache it for request
-        """
-        if not hasattr(self, "_head"):
-            self._head = self.posts.all().order_by('created')
-        if not len(self._head):
-            return None
-        return self._head[0]
-
-    @property
-    def last_post(self):
-        if not getattr(self, '_last_post', None):
-            self._last_post = self.posts.order_by(
-                '-created').select_related('user')[0]
-        return self._last_post
-
     def get_absolute_url(self):
         return reverse(
             '%s_pybb:topic' % self.forum.category.client_code,
             kwargs={'pk': self.id})
 
     def save(self, *args, **kwargs):
-        if self.id is None:
+        new = self.id is None
+        if new:
             self.created = tznow()
 
-        forum_changed = False
-        old_topic = None
-        if self.id is not None:
-            old_topic = Topic.objects.get(id=self.id)
-            if self.forum != old_topic.forum:
-                forum_changed = True
+        forum_changed = not new and self.field_changed('forum_id')
+        if forum_changed:
+            old_forum = Forum.objects.get(
+                pk=self.original_value('forum_id'))
+        if new or forum_changed:
+            client_changed = self.client_id != self.forum.category.client_id
+            self.client_id = self.forum.category.client_id
 
         super(Topic, self).save(*args, **kwargs)
 
-        if forum_changed:
-            old_topic.forum.update_counters()
-            self.forum.update_counters()
+        if new:
+            self.forum.change_counters(topic_delta=1)
+        elif forum_changed:
+            old_forum.change_counters(
+                post_delta=-self.post_count, topic_delta=-1)
+            old_forum.refresh_last_post()
+            self.forum.change_counters(
+                post_delta=self.post_count, topic_delta=1)
+            self.forum.refresh_last_post()
+            if client_changed:
+                Post.objects.filter(topic=self).update(client=self.client_id)
+            invalidate_unread_counts(forum_ids=[old_forum.id, self.forum_id])
+        self.reset_tracked_fields()
 
     def delete(self, using=None):
+        # counters could be changed by other requests since this instance
+        # was loaded
+        post_count = Topic.objects.filter(pk=self.pk).values_list(
+            'post_count', flat=True).first() or 0
         super(Topic, self).delete(using)
-        self.forum.update_counters()
+        self.forum.change_counters(post_delta=-post_count, topic_delta=-1)
+        if self.forum.last_post_id in (None, self.last_post_id):
+            self.forum.refresh_last_post()
 
     def update_counters(self):
+        """
+        Recalculate counters from scratch.
+
+        Counters are maintained incrementally by `change_counters` on every
+        post change, so this is only needed to repair them
+        (see `pybb_update_counters` command)
+        """
         self.post_count = self.posts.count()
         last_post = Post.objects.filter(topic_id=self.id).order_by(
             '-created')[0]
         self.updated = last_post.updated or last_post.created
+        self.last_post = last_post
+        self.head = Post.objects.filter(topic_id=self.id).order_by(
+            'created', 'id')[0]
         self.save()
 
+    def change_counters(self, post_delta=0, last_post=None):
+        """
+        Atomically apply counter deltas with single UPDATE query and
+        mirror them on this instance. If `last_post` passed, it becomes
+        the latest post of topic
+        """
+        values = {}
+        if post_delta:
+            values['post_count'] = F('post_count') + post_delta
+            self.post_count += post_delta
+        if last_post is not None:
+            values['last_post'] = self.last_post = last_post
+            values['updated'] = self.updated = \
+                last_post.updated or last_post.created
+        if values:
+            Topic.objects.filter(pk=self.pk).update(**values)
+
+    def refresh_last_post(self):
+        """
+        Reread `last_post` and `updated` from the latest post of topic.
+        Should be called only when the latest post leaves topic
+        (deletion or move)
+        """
+        last_post = Post.objects.filter(topic_id=self.id).order_by(
+            '-created').first()
+        if last_post is None:
+            self.last_post = None
+            Topic.objects.filter(pk=self.pk).update(last_post=None)
+        else:
+            self.change_counters(last_post=last_post)
+
+    def refresh_head(self):
+        """
+        Reread `head` from the first post of topic. Should be called only
+        when posts are moved between topics
+        """
+        self.head = Post.objects.filter(topic_id=self.id).order_by(
+            'created', 'id').first()
+        Topic.objects.filter(pk=self.pk).update(head=self.head)
+
+    def shift_positions(self, start, delta):
+        """
+        Add `delta` to `position` of posts of topic starting from `start`.
+        Positions are negated by first UPDATE and restored by second one, so
+        unique (topic, position) index isn't violated in the middle of update
+        """
+        posts = Post.objects.filter(topic_id=self.id)
+        posts.filter(position__gte=start).update(position=F('position') * -1 - delta)
+        posts.filter(position__lt=0).update(position=F('position') * -1)
+
+    def get_post_position(self, post):
+        """
+        Return position `post` should take in topic ordered by (created, id)
+        """
+        posts = Post.objects.filter(topic_id=self.id)
+        if post.pk is None:
+            return posts.filter(created__lte=post.created).count() + 1
+        return posts.filter(Q(created__lt=post.created) | Q(
+            created=post.created, id__lt=post.pk)).exclude(pk=post.pk).count() + 1
+
     def get_parents(self):
         """
         Used in templates for breadcrumb building
@@ -290,18 +530,31 @@ class RenderableItem(models.Model):
     body = models.TextField(_('Message'))
     body_html = models.TextField(_('HTML version'))
     body_text = models.TextField(_('Text version'))
+    body_hash = models.CharField(
+        _('Rendered message hash'), max_length=40, blank=True,
+        editable=False)
 
     def render(self):
-        self.body_html = defaults.PYBB_MARKUP_ENGINES[
-            defaults.PYBB_MARKUP](self.body)
-        # Remove tags which was generated with the markup processor
-        text = strip_tags(self.body_html)
-        # Unescape entities which was generated with the markup processor
-        self.body_text = unescape(text)
+        self.body_html = render_markup(self.body)
+        self.body_text = html_to_text(self.body_html)
+        self.body_hash = self.get_body_hash()
+
+    def get_body_hash(self):
+        """
+        Hash of body together with markup engine and its version, so
+        changing any of them invalidates rendered html
+        """
+        return markup_hash(self.body)
+
+    def is_rendered(self):
+        """
+        Check if body_html and body_text are up to date with body
+        """
+        return self.body_hash == self.get_body_hash()
 
 
 @python_2_unicode_compatible
-class Post(RenderableItem):
+class Post(FieldTrackerMixin, RenderableItem):
     topic = models.ForeignKey(
         Topic, related_name='posts', verbose_name=_('Topic'))
     user = models.ForeignKey(
@@ -311,11 +564,23 @@ class Post(RenderableItem):
     user_ip = models.IPAddressField(
         _('User IP'), blank=True, default='0.0.0.0')
     on_moderation = models.BooleanField(_('On moderation'), default=False)
+    # client of topic, stored to select posts of client without joins
+    client = models.ForeignKey(
+        Client, related_name='posts', verbose_name=_('Client'),
+        blank=True, null=True, editable=False)
+    # 1-based number of post in topic ordered by (created, id), used to
+    # find first post of page without OFFSET
+    position = models.IntegerField(
+        _('Position'), blank=True, null=True, editable=False)
+
+    tracked_fields = ('topic_id', 'on_moderation')
 
     class Meta(object):
         ordering = ['created']
         verbose_name = _('Post')
         verbose_name_plural = _('Posts')
+        index_together = [['client', 'created']]
+        unique_together = [['topic', 'position']]
 
     def summary(self):
         LIMIT = 50
@@ -329,30 +594,115 @@ class Post(RenderableItem):
         created_at = tznow()
         if self.created is None:
             self.created = created_at
-        self.render()
+        if not self.is_rendered():
+            self.render()
 
         new = self.pk is None
 
-        topic_changed = False
-        old_post = None
-        if not new:
-            old_post = Post.objects.get(pk=self.pk)
-            if old_post.topic != self.topic:
-                topic_changed = True
-
-        super(Post, self).save(*args, **kwargs)
+        topic_changed = not new and self.field_changed('topic_id')
+        if topic_changed:
+            old_topic = Topic.objects.select_related('forum').get(
+                pk=self.original_value('topic_id'))
+        if new or topic_changed:
+            self.client_id = self.topic.client_id
+        if new:
+            self._insert(*args, **kwargs)
+        elif topic_changed:
+            old_position = self.position
+            with atomic_func():
+                self.position = self.topic.get_post_position(self)
+                self.topic.shift_positions(self.position, 1)
+                super(Post, self).save(*args, **kwargs)
+                if old_position is not None:
+                    old_topic.shift_positions(old_position + 1, -1)
+        else:
+            super(Post, self).save(*args, **kwargs)
+
+        if new and self.topic.head_id is None:
+            # first post of topic, don't overwrite head saved concurrently
+            self.topic.head = self
+            Topic.objects.filter(
+                pk=self.topic_id, head__isnull=True).update(head=self)
+        elif new and not _is_latest(self, self.topic):
+            # back-dated post (e.g. imported one) may precede current head
+            if Topic.objects.filter(
+                    pk=self.topic_id, head__created__gt=self.created).update(head=self):
+                self.topic.head = self
 
         # If post is topic head and moderated, moderate topic too
-        if self.topic.head == self and not self.on_moderation and \
-                self.topic.on_moderation:
+        if (new or self.field_changed('on_moderation')) and \
+                not self.on_moderation and \
+                self.topic.head_id == self.id and self.topic.on_moderation:
             self.topic.on_moderation = False
+            Topic.objects.filter(pk=self.topic_id).update(on_moderation=False)
+
+        if new:
+            self._add_to_counters(self.topic)
+        elif topic_changed:
+            self._remove_from_counters(old_topic, self.id)
+            old_topic.refresh_head()
+            self.topic.change_counters(post_delta=1)
+            self.topic.refresh_last_post()
+            self.topic.refresh_head()
+            self.topic.forum.change_counters(post_delta=1)
+            self.topic.forum.refresh_last_post()
+        elif self.topic.last_post_id == self.id:
+            # edit of the latest post moves update time of topic and forum
+            self.topic.change_counters(last_post=self)
+            forum = self.topic.forum
+            if forum.last_post_id == self.id:
+                forum.change_counters(last_post=self)
+        self.reset_tracked_fields()
+
+    # inserts retried after concurrent post took the same position
+    position_retries = 3
+
+    def _insert(self, *args, **kwargs):
+        """
+        Save new post at its `position` in topic: after the last post, or
+        between existing ones, moving later posts down. Unique (topic,
+        position) index rejects post which took position concurrently
+        """
+        for attempt in range(self.position_retries):
+            try:
+                with atomic_func():
+                    if _is_latest(self, self.topic):
+                        last_position = Post.objects.filter(
+                            topic_id=self.topic_id).aggregate(
+                            Max('position'))['position__max']
+                        self.position = (last_position or 0) + 1
+                    else:
+                        self.position = self.topic.get_post_position(self)
+                        self.topic.shift_positions(self.position, 1)
+                    super(Post, self).save(*args, **kwargs)
+                return
+            except IntegrityError:
+                if attempt == self.position_retries - 1:
+                    raise
+
+    def _add_to_counters(self, topic):
+        """
+        Account new post in topic and forum counters
+        """
+        topic.change_counters(
+            post_delta=1, last_post=self if _is_latest(self, topic) else None)
+        forum = topic.forum
+        forum.change_counters(
+            post_delta=1, last_post=self if _is_latest(self, forum) else None)
 
-        self.topic.update_counters()
-        self.topic.forum.update_counters()
-
-        if topic_changed:
-            old_post.topic.update_counters()
-            old_post.topic.forum.update_counters()
+    def _remove_from_counters(self, topic, post_id):
+        """
+        Discount post from topic and forum counters. Latest post is reread
+        from database only if it was this post. `post_id` is passed
+        explicitly because deletion resets `self.id`
+        """
+        topic.change_counters(post_delta=-1)
+        if topic.last_post_id in (None, post_id):
+            topic.refresh_last_post()
+        forum = topic.forum
+        forum.change_counters(post_delta=-1)
+        if forum.last_post_id in (None, post_id):
+            forum.refresh_last_post()
 
     def get_absolute_url(self):
         return reverse(
@@ -361,20 +711,20 @@ class Post(RenderableItem):
 
     def delete(self, *args, **kwargs):
         self_id = self.id
-        head_post_id = self.topic.posts.order_by('created')[0].id
 
-        if self_id == head_post_id:
+        if self_id == self.topic.head_id:
             self.topic.delete()
         else:
             super(Post, self).delete(*args, **kwargs)
-            self.topic.update_counters()
-            self.topic.forum.update_counters()
+            self._remove_from_counters(self.topic, self_id)
+            if self.position is not None:
+                self.topic.shift_positions(self.position + 1, -1)
 
     def get_parents(self):
         """
         Used in templates for breadcrumb building
         """
-        return self.topic.forum.category, self.topic.forum, self.topic,
+        return self.topic.get_parents() + [self.topic]
 
 
 class Profile(PybbProfile):
@@ -424,6 +774,21 @@ class Attachment(models.Model):
             return '%.2fMb' % (size / float(1024 * 1024))
 
 
+def _touch_tracker(manager, user, field, obj):
+    """
+    Create read tracker of `user` and `obj` or set its time stamp to now
+    with one INSERT ... ON CONFLICT statement. Databases without upserts
+    use `get_or_create_tracker` and save.
+    """
+    if upsert_supported():
+        bulk_insert(manager.model, ('user', field, 'time_stamp'), [(user.pk, obj.pk, tznow())],
+                    conflict_fields=('user', field), update_fields=('time_stamp',))
+        return
+    tracker, is_new = manager.get_or_create_tracker(user, obj)
+    if not is_new:
+        tracker.save()
+
+
 class TopicReadTrackerManager(models.Manager):
     def get_or_create_tracker(self, user, topic):
         """
@@ -445,6 +810,9 @@ class TopicReadTrackerManager(models.Manager):
             is_new = False
         return obj, is_new
 
+    def touch_tracker(self, user, topic):
+        _touch_tracker(self, user, 'topic', topic)
+
 
 class TopicReadTracker(models.Model):
     """
@@ -483,6 +851,9 @@ class ForumReadTrackerManager(models.Manager):
             obj = ForumReadTracker.objects.get(user=user, forum=forum)
         return obj, is_new
 
+    def touch_tracker(self, user, forum):
+        _touch_tracker(self, user, 'forum', forum)
+
 
 class ForumReadTracker(models.Model):
     """
@@ -500,6 +871,49 @@ class ForumReadTracker(models.Model):
         unique_together = ('user', 'forum')
 
 
+class ForumReadWatermark(models.Model):
+    """
+    Per user forum read tracking used by `WatermarkReadTracker`.
+    Topics updated not later than `time_stamp` are read, topics updated later
+    but read out of order are kept in `topics` as "id:time,..." string
+    """
+    user = models.ForeignKey(User, blank=False, null=False)
+    forum = models.ForeignKey(Forum, blank=False, null=False)
+    time_stamp = models.DateTimeField(blank=True, null=True)
+    topics = models.TextField(blank=True, default='')
+
+    class Meta(object):
+        verbose_name = _('Forum read watermark')
+        verbose_name_plural = _('Forum read watermarks')
+        unique_together = ('user', 'forum')
+
+    def get_topics(self):
+        """
+        Return dict of topic id to read time of topics read out of order
+        """
+        marks = {}
+        for item in self.topics.split(','):
+            if item:
+                topic_id, micro = item.split(':')
+                marks[int(topic_id)] = micro_to_datetime(int(micro))
+        return marks
+
+    def set_topics(self, marks):
+        self.topics = ','.join('%d:%d' % (topic_id, datetime_to_micro(read))
+                               for topic_id, read in sorted(marks.items()))
+
+    def get_read_time(self, topic_id, marks=None):
+        """
+        Return time when topic was read or None if it was never read
+        """
+        if marks is None:
+            marks = self.get_topics()
+        read = marks.get(topic_id)
+        if read is None or (self.time_stamp is not None and self.time_stamp > read):
+            return self.time_stamp
+        return read
+
+
 @python_2_unicode_compatible
 class PollAnswer(models.Model):
     topic = models.ForeignKey(
@@ -542,6 +956,7 @@ class PollAnswerUser(models.Model):
 
 
 def post_saved(instance, **kwargs):
+    invalidate_unread_counts(forum_ids=[instance.topic.forum_id])
     notify_topic_subscribers(instance)
 
     if get_pybb_profile(instance.user).autosubscribe:
@@ -554,6 +969,7 @@ def post_saved(instance, **kwargs):
 
 
 def post_deleted(instance, **kwargs):
+    invalidate_unread_counts(forum_ids=[instance.topic.forum_id])
     profile = get_pybb_profile(instance.user)
     profile.post_count = instance.user.posts.count()
     profile.save()
@@ -575,7 +991,25 @@ def user_saved(instance, created, **kwargs):
         Profile(user=instance).save()
 
 
+def moderators_changed(action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_moderators()
+
+
+def forum_deleted(**kwargs):
+    invalidate_moderators()
+    invalidate_visible_forums()
+
+
+def category_changed(**kwargs):
+    invalidate_visible_forums()
+
+
 post_save.connect(post_saved, sender=Post)
 post_delete.connect(post_deleted, sender=Post)
+m2m_changed.connect(moderators_changed, sender=Forum.moderators.through)
+post_delete.connect(forum_deleted, sender=Forum)
+post_save.connect(category_changed, sender=Category)
+post_delete.connect(category_changed, sender=Category)
 if defaults.PYBB_AUTO_USER_PERMISSIONS:
     post_save.connect(user_saved, sender=get_user_model())
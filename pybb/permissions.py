@@ -4,10 +4,15 @@ Extensible permission system for pybbm
 """
 
 from __future__ import unicode_literals
+import uuid
+
+from django.core.cache import cache
 from django.utils.importlib import import_module
 from django.db.models import Q
 
 from pybb import defaults
+from pybb.models import Forum
+from pybb.util import build_cache_key
 
 
 def _resolve_class(name):
@@ -17,6 +22,154 @@ def _resolve_class(name):
     return getattr(import_module(modname), funcname)()
 
 
+def get_moderators_map():
+    """
+    Return (forum id -> moderator ids, user id -> moderated forum ids) pair of
+    dicts with frozenset values. Maps are loaded with one query and kept in
+    default cache for PYBB_MODERATORS_CACHE_TIMEOUT seconds, they are dropped
+    when moderators of any forum change
+    """
+    timeout = defaults.PYBB_MODERATORS_CACHE_TIMEOUT
+    key = build_cache_key('moderators')
+    maps = cache.get(key) if timeout else None
+    if maps is None:
+        forums, users = {}, {}
+        # through columns are named after models, user model may be swapped
+        field = Forum.moderators.field
+        columns = (field.m2m_field_name() + '_id', field.m2m_reverse_field_name() + '_id')
+        for forum_id, user_id in Forum.moderators.through.objects.values_list(*columns):
+            forums.setdefault(forum_id, set()).add(user_id)
+            users.setdefault(user_id, set()).add(forum_id)
+        maps = (dict((forum_id, frozenset(ids)) for forum_id, ids in forums.items()),
+                dict((user_id, frozenset(ids)) for user_id, ids in users.items()))
+        if timeout:
+            cache.set(key, maps, timeout)
+    return maps
+
+
+def get_forum_moderator_ids(forum_id):
+    """ frozenset of ids of users moderating forum with `forum_id` """
+    return get_moderators_map()[0].get(forum_id, frozenset())
+
+
+def get_moderated_forum_ids(user_id):
+    """ frozenset of ids of forums moderated by user with `user_id` """
+    return get_moderators_map()[1].get(user_id, frozenset())
+
+
+def get_visible_forums_map():
+    """
+    Return {client: {role: frozenset of forum ids}} dict of forums visible for
+    every role (see `PermissionContext.role`), clients are keyed both by id and
+    by code, None key holds forums of all clients. Map is loaded with one query
+    and kept in default cache for PYBB_VISIBLE_FORUMS_CACHE_TIMEOUT seconds
+    under current version, which is changed when forum or category is created,
+    deleted, hidden or moved (see `pybb.util.invalidate_visible_forums`)
+    """
+    timeout = defaults.PYBB_VISIBLE_FORUMS_CACHE_TIMEOUT
+    if timeout:
+        version_key = build_cache_key('visible_forums_version')
+        version = cache.get(version_key)
+        if version is None:
+            cache.add(version_key, uuid.uuid4().hex, timeout)
+            version = cache.get(version_key)
+        key = build_cache_key('visible_forums', version=version)
+        visible = cache.get(key)
+    else:
+        visible = None
+    if visible is None:
+        visible = {None: {'staff': set(), 'user': set()}}
+        for forum_id, client_id, client_code, hidden, category_hidden in Forum.objects.values_list(
+                'id', 'category__client', 'category__client__code', 'hidden', 'category__hidden'):
+            roles = ['staff'] if hidden or category_hidden else ['staff', 'user']
+            for client in (None, client_id, client_code):
+                for role in roles:
+                    visible.setdefault(client, {'staff': set(), 'user': set()})[role].add(forum_id)
+        visible = dict((client, dict((role, frozenset(ids)) for role, ids in roles.items()))
+                       for client, roles in visible.items())
+        if timeout:
+            # map loaded before version changed is kept under old key
+            cache.set(key, visible, timeout)
+    return visible
+
+
+class PermissionContext(object):
+    """
+    Permission related facts about one user: forums moderated by user (from
+    shared moderators cache) and results of `has_perm` checks. Every fact is
+    loaded at most once, context is kept on user object, so it lives as long
+    as `request.user` does. `client` is client of request (set by
+    `PybbRouterMiddleware`), `filter_*` methods limit visible forums to it.
+    """
+
+    def __init__(self, user, client=None):
+        self.user = user
+        self.client = client
+        self._moderated_forum_ids = None
+        self._perms = {}
+
+    @property
+    def is_authenticated(self):
+        return self.user.is_authenticated()
+
+    @property
+    def is_staff(self):
+        return self.user.is_staff
+
+    @property
+    def is_superuser(self):
+        return self.user.is_superuser
+
+    @property
+    def role(self):
+        """ role class used as key of visible forums map """
+        return 'staff' if self.is_staff else 'user'
+
+    @property
+    def moderated_forum_ids(self):
+        """ frozenset of ids of forums moderated by user """
+        if self._moderated_forum_ids is None:
+            if not self.is_authenticated:
+                self._moderated_forum_ids = frozenset()
+            elif defaults.PYBB_MODERATORS_CACHE_TIMEOUT:
+                self._moderated_forum_ids = get_moderated_forum_ids(self.user.pk)
+            else:
+                # without shared cache load only forums of this user
+                self._moderated_forum_ids = frozenset(
+                    Forum.objects.filter(moderators=self.user).values_list('id', flat=True))
+        return self._moderated_forum_ids
+
+    def is_moderator(self, forum_id):
+        return forum_id in self.moderated_forum_ids
+
+    def has_perm(self, perm):
+        if perm not in self._perms:
+            self._perms[perm] = self.user.has_perm(perm)
+        return self._perms[perm]
+
+
+def get_permission_context(user, client=None):
+    """
+    return PermissionContext of `user`, create it on first call, set its
+    client if `client` is passed
+    """
+    context = getattr(user, '_pybb_permission_context', None)
+    if context is None or context.user.pk != user.pk:
+        context = PermissionContext(user)
+        user._pybb_permission_context = context
+    if client is not None:
+        context.client = client
+    return context
+
+
+def reset_permission_context(user):
+    """ forget permission facts loaded for `user`, e.g. after moderators change """
+    try:
+        del user._pybb_permission_context
+    except AttributeError:
+        pass
+
+
 class DefaultPermissionHandler(object):
     """ 
     Default Permission handler. If you want to implement custom permissions (for example,
@@ -28,7 +181,24 @@ class DefaultPermissionHandler(object):
     
     To activate your custom permission handler, set `settings.PYBB_PERMISSION_HANDLER` to
     the full qualified name of your class, e.g. "`myapp.pybb_adapter.MyPermissionHandler`".    
+
+    Use `self.context(user)` in `may_*` methods to get moderated forums and permissions
+    of user loaded once per request.
     """
+    def context(self, user):
+        """ return request scoped PermissionContext of `user` """
+        return get_permission_context(user)
+
+    def get_visible_forum_ids(self, user, client=None):
+        """
+        return frozenset of ids of forums `user` is allowed to see (only forums of
+        `client` instance, id or code if it's passed), `filter_*` methods use it
+        with client of permission context instead of joins to forum and category
+        tables
+        """
+        roles = get_visible_forums_map().get(getattr(client, 'pk', client))
+        return roles[self.context(user).role] if roles else frozenset()
+
     #
     # permission checks on categories
     #
@@ -45,7 +215,9 @@ class DefaultPermissionHandler(object):
     # 
     def filter_forums(self, user, qs):
         """ return a queryset with forums `user` is allowed to see """
-        return qs.filter(Q(hidden=False) & Q(category__hidden=False)) if not user.is_staff else qs
+        if user.is_staff:
+            return qs
+        return qs.filter(id__in=self.get_visible_forum_ids(user, self.context(user).client))
 
     def may_view_forum(self, user, forum):
         """ return True if user may view this forum, False if not """
@@ -53,34 +225,52 @@ class DefaultPermissionHandler(object):
 
     def may_create_topic(self, user, forum):
         """ return True if `user` is allowed to create a new topic in `forum` """
-        return user.has_perm('pybb.add_post')
+        return self.context(user).has_perm('pybb.add_post')
 
     #
     # permission checks on topics
     # 
     def filter_topics(self, user, qs):
         """ return a queryset with topics `user` is allowed to see """
-        if not user.is_staff:
-            qs = qs.filter(Q(forum__hidden=False) & Q(forum__category__hidden=False))
-        if not user.is_superuser:
-            if user.is_authenticated():
-                qs = qs.filter(Q(forum__moderators=user) | Q(user=user) | Q(on_moderation=False)).distinct()
+        context = self.context(user)
+        if not context.is_staff:
+            qs = qs.filter(forum__in=self.get_visible_forum_ids(user, context.client))
+        if not context.is_superuser:
+            if context.is_authenticated:
+                visible = Q(on_moderation=False) | Q(user=user)
+                if context.moderated_forum_ids:
+                    visible |= Q(forum__in=context.moderated_forum_ids)
+                qs = qs.filter(visible)
             else:
                 qs = qs.filter(on_moderation=False)
         return qs
 
     def may_view_topic(self, user, topic):
         """ return True if user may view this topic, False otherwise """
-        if user.is_superuser:
+        context = self.context(user)
+        if context.is_superuser:
             return True
-        if not user.is_staff and (topic.forum.hidden or topic.forum.category.hidden):
+        if not context.is_staff and (topic.forum.hidden or topic.forum.category.hidden):
             return False  # only staff may see hidden forum / category
         if topic.on_moderation:
-            return user.is_authenticated() and (user == topic.user or user in topic.forum.moderators)
+            return context.is_authenticated and (
+                user.pk == topic.user_id or context.is_moderator(topic.forum_id))
         return True
 
+    def may_view_all_topics(self, user, forum):
+        """
+        return True if `filter_topics` hides no topic of visible `forum` from `user`,
+        so stored `forum.topic_count` is used as count of its topics. Override it
+        together with `filter_topics`
+        """
+        context = self.context(user)
+        return not defaults.PYBB_PREMODERATION or context.is_superuser or \
+            context.is_moderator(forum.id)
+
     def may_moderate_topic(self, user, topic):
-        return user.is_superuser or user in topic.forum.moderators.all()
+        """ return True if `user` may moderate `topic` """
+        context = self.context(user)
+        return context.is_superuser or context.is_moderator(topic.forum_id)
 
     def may_close_topic(self, user, topic):
         """ return True if `user` may close `topic` """
@@ -110,7 +300,7 @@ class DefaultPermissionHandler(object):
             return False
 
         # only user which have 'pybb.add_post' permission may post
-        return user.has_perm('pybb.add_post')
+        return self.context(user).has_perm('pybb.add_post')
 
     def may_post_as_admin(self, user):
         """ return True if `user` may post as admin """
@@ -123,17 +313,21 @@ class DefaultPermissionHandler(object):
         """ return a queryset with posts `user` is allowed to see """
 
         # first filter by topic availability
-        if not user.is_staff:
-            qs = qs.filter(Q(topic__forum__hidden=False) & Q(topic__forum__category__hidden=False))
+        context = self.context(user)
+        if not context.is_staff:
+            qs = qs.filter(topic__forum__in=self.get_visible_forum_ids(user, context.client))
 
-        if not defaults.PYBB_PREMODERATION or user.is_superuser:
+        if not defaults.PYBB_PREMODERATION or context.is_superuser:
             # superuser may see all posts, also if premoderation is turned off moderation 
             # flag is ignored
             return qs
-        elif user.is_authenticated():
+        elif context.is_authenticated:
             # post is visible if user is author, post is not on moderation, or user is moderator
             # for this forum
-            qs = qs.filter(Q(user=user) | Q(on_moderation=False) | Q(topic__forum__moderators=user))
+            visible = Q(user=user) | Q(on_moderation=False)
+            if context.moderated_forum_ids:
+                visible |= Q(topic__forum__in=context.moderated_forum_ids)
+            qs = qs.filter(visible)
         else:
             # anonymous user may not see posts which are on moderation
             qs = qs.filter(on_moderation=False)
@@ -141,15 +335,26 @@ class DefaultPermissionHandler(object):
 
     def may_view_post(self, user, post):
         """ return True if `user` may view `post`, False otherwise """
-        if user.is_superuser:
+        context = self.context(user)
+        if context.is_superuser:
             return True
         if post.on_moderation:
-            return post.user == user or user in post.topic.forum.moderators.all()
+            return post.user_id == user.pk or context.is_moderator(post.topic.forum_id)
         return True
 
+    def may_view_all_posts(self, user, topic):
+        """
+        return True if `filter_posts` hides no post of visible `topic` from `user`,
+        so stored `topic.post_count` and post positions are used for pagination.
+        Override it together with `filter_posts`
+        """
+        context = self.context(user)
+        return not defaults.PYBB_PREMODERATION or context.is_superuser or \
+            context.is_moderator(topic.forum_id)
+
     def may_edit_post(self, user, post):
         """ return True if `user` may edit `post` """
-        return user.is_superuser or post.user == user or self.may_moderate_topic(user, post.topic)
+        return user.is_superuser or post.user_id == user.pk or self.may_moderate_topic(user, post.topic)
 
     def may_delete_post(self, user, post):
         """ return True if `user` may delete `post` """
@@ -160,7 +365,7 @@ class DefaultPermissionHandler(object):
     #
     def may_block_user(self, user, user_to_block):
         """ return True if `user` may block `user_to_block` """
-        return user.has_perm('pybb.block_users')
+        return self.context(user).has_perm('pybb.block_users')
 
     def may_attach_files(self, user):
         """
@@ -4,6 +4,7 @@ from django.conf import settings
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from pybb import defaults
+from pybb.markup import render_markup, markup_hash
 from pybb.util import get_file_path
 
 try:
@@ -38,6 +39,8 @@ class PybbProfile(models.Model):
         max_length=defaults.PYBB_SIGNATURE_MAX_LENGTH)
     signature_html = models.TextField(_('Signature HTML Version'), blank=True,
         max_length=defaults.PYBB_SIGNATURE_MAX_LENGTH + 30)
+    signature_hash = models.CharField(_('Rendered signature hash'), max_length=40,
+        blank=True, editable=False)
     time_zone = models.FloatField(_('Time zone'), choices=TZ_CHOICES,
         default=float(defaults.PYBB_DEFAULT_TIME_ZONE))
     language = models.CharField(_('Language'), max_length=10, blank=True,
@@ -52,8 +55,18 @@ class PybbProfile(models.Model):
         help_text=_('Automatically subscribe to topics that you answer'),
         default=defaults.PYBB_DEFAULT_AUTOSUBSCRIBE)
 
+    def get_signature_hash(self):
+        """
+        Hash of signature together with markup engine and its version, like
+        `body_hash` of posts
+        """
+        return markup_hash(self.signature)
+
     def save(self, *args, **kwargs):
-        self.signature_html = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP](self.signature)
+        signature_hash = self.get_signature_hash()
+        if self.signature_hash != signature_hash:
+            self.signature_html = render_markup(self.signature)
+            self.signature_hash = signature_hash
         super(PybbProfile, self).save(*args, **kwargs)
 
     @property
@@ -0,0 +1,582 @@
+# -*- coding: utf-8 -*-
+"""
+Pluggable read tracking for pybbm
+"""
+
+from __future__ import unicode_literals
+import threading
+
+from django.core.cache import cache
+from django.db.models import Count, F, Q
+from django.db.utils import IntegrityError
+from django.utils.timezone import now as tznow
+
+from pybb import defaults
+from pybb.models import (
+    Forum, Topic, TopicReadTracker, ForumReadTracker, ForumReadWatermark, atomic_func)
+from pybb.permissions import _resolve_class, perms
+from pybb.util import (
+    build_cache_key, bulk_insert, get_cache, get_user_model, upsert_supported)
+
+User = get_user_model()
+
+
+class DefaultReadTracker(object):
+    """
+    Default read tracker. Stores one `TopicReadTracker` row per read topic
+    until whole forum is read, then replaces them with `ForumReadTracker`.
+
+    To use other read tracker (for example `WatermarkReadTracker`), set
+    `settings.PYBB_READ_TRACKER` to the full qualified name of its class.
+    Read trackers should implement all methods of this class.
+    """
+
+    def get_topic_read_times(self, user, topics):
+        """
+        Return dict of topic id to time when `user` read topic for `topics`
+        read at least once
+        """
+        forum_marks = dict(ForumReadTracker.objects.filter(
+            user=user, forum__in=set(topic.forum_id for topic in topics)
+        ).values_list('forum', 'time_stamp'))
+        read_times = {}
+        not_read = []
+        for topic in topics:
+            if topic.forum_id in forum_marks:
+                read_times[topic.id] = forum_marks[topic.forum_id]
+                if read_times[topic.id] >= (topic.updated or topic.created):
+                    continue
+            not_read.append(topic.id)
+        if not not_read:
+            return read_times
+        for topic_id, time_stamp in TopicReadTracker.objects.filter(
+                user=user, topic__in=not_read).values_list('topic', 'time_stamp'):
+            if topic_id not in read_times or read_times[topic_id] < time_stamp:
+                read_times[topic_id] = time_stamp
+        return read_times
+
+    def get_forum_read_times(self, user, forum_ids):
+        """
+        Return dict of forum id to time up to which `user` read all topics
+        of forum
+        """
+        return dict(ForumReadTracker.objects.filter(
+            user=user, forum__in=forum_ids).values_list('forum', 'time_stamp'))
+
+    def filter_unread_topics(self, user, topics):
+        """
+        Filter `topics` queryset leaving topics unread by `user`
+        """
+        readed = Topic.objects.filter(Q(
+            topicreadtracker__user=user,
+            topicreadtracker__time_stamp__gte=F('updated')) | Q(
+                forum__forumreadtracker__user=user,
+                forum__forumreadtracker__time_stamp__gte=F('updated'))).values('id')
+        return topics.exclude(id__in=readed)
+
+    def get_unread_topic_counts(self, user, topics):
+        """
+        Return dict of forum id to count of topics from `topics` queryset
+        unread by `user`, forums without unread topics are omitted
+        """
+        return dict(self.filter_unread_topics(user, topics).order_by().values_list(
+            'forum').annotate(Count('id', distinct=True)))
+
+    def mark_topic_read(self, user, topic):
+        try:
+            forum_mark = ForumReadTracker.objects.get(
+                forum=topic.forum_id, user=user)
+        except ForumReadTracker.DoesNotExist:
+            forum_mark = None
+        if (forum_mark is None) or (forum_mark.time_stamp < topic.updated):
+            # Mark topic as readed
+            TopicReadTracker.objects.touch_tracker(user, topic)
+
+            self.update_forum_mark(user, topic.forum)
+
+    def mark_topics_read(self, user, marks):
+        """
+        Mark topics as read at given times, `marks` is dict of forum id to
+        dict of topic id to read time
+        """
+        forum_marks = self.get_forum_read_times(user, list(marks))
+        reads = {}
+        for forum_id, topic_marks in marks.items():
+            for topic_id, read in topic_marks.items():
+                if forum_id not in forum_marks or read > forum_marks[forum_id]:
+                    reads[topic_id] = read
+        if not reads:
+            return
+        for topic_id, time_stamp in TopicReadTracker.objects.filter(
+                user=user, topic__in=list(reads)).values_list('topic', 'time_stamp'):
+            if time_stamp >= reads[topic_id]:
+                del reads[topic_id]
+        if reads:
+            rows = [(user.pk, topic_id, read) for topic_id, read in reads.items()]
+            if upsert_supported():
+                bulk_insert(TopicReadTracker, ('user', 'topic', 'time_stamp'), rows,
+                            conflict_fields=('user', 'topic'), update_fields=('time_stamp',))
+            else:
+                TopicReadTracker.objects.filter(user=user, topic__in=list(reads)).delete()
+                bulk_insert(TopicReadTracker, ('user', 'topic', 'time_stamp'), rows)
+        for forum in Forum.objects.filter(id__in=list(marks)):
+            self.update_forum_mark(user, forum)
+
+    def update_forum_mark(self, user, forum):
+        """
+        Replace topic marks of `forum` with forum mark if all its topics are read
+        """
+        readed = forum.topics.filter((Q(
+            topicreadtracker__user=user,
+            topicreadtracker__time_stamp__gte=F('updated'))) | Q(
+                forum__forumreadtracker__user=user,
+                forum__forumreadtracker__time_stamp__gte=F(
+                    'updated'))).only('id').order_by()
+
+        not_readed = forum.topics.exclude(id__in=readed)
+        if not not_readed.exists():
+            # Clear all topic marks for this forum, mark forum as readed
+            TopicReadTracker.objects.filter(
+                user=user, topic__forum=forum).delete()
+            ForumReadTracker.objects.touch_tracker(user, forum)
+
+    def mark_all_read(self, user, forums):
+        """
+        Mark all topics of `forums` queryset as read
+        """
+        if upsert_supported():
+            now = tznow()
+            bulk_insert(ForumReadTracker, ('user', 'forum', 'time_stamp'),
+                        [(user.pk, forum_id, now) for forum_id in forums.values_list('id', flat=True)],
+                        conflict_fields=('user', 'forum'), update_fields=('time_stamp',))
+        else:
+            for forum in forums:
+                ForumReadTracker.objects.touch_tracker(user, forum)
+        TopicReadTracker.objects.filter(
+            user=user, topic__forum__in=forums.values_list('id', flat=True)).delete()
+
+
+class WatermarkReadTracker(DefaultReadTracker):
+    """
+    Read tracker with one `ForumReadWatermark` row per user and forum.
+    Watermark moves forward while topics are read in order of update time,
+    topics read out of order are kept in compact set until watermark passes
+    them. Reading already read topic costs one query and no writes.
+    """
+
+    def get_marks(self, user, forum_ids):
+        return dict((mark.forum_id, mark) for mark in ForumReadWatermark.objects.filter(
+            user=user, forum__in=forum_ids))
+
+    def get_topic_read_times(self, user, topics):
+        marks = self.get_marks(user, set(topic.forum_id for topic in topics))
+        topic_marks = {}
+        read_times = {}
+        for topic in topics:
+            mark = marks.get(topic.forum_id)
+            if mark is None:
+                continue
+            if mark.forum_id not in topic_marks:
+                topic_marks[mark.forum_id] = mark.get_topics()
+            read = mark.get_read_time(topic.id, topic_marks[mark.forum_id])
+            if read is not None:
+                read_times[topic.id] = read
+        return read_times
+
+    def get_forum_read_times(self, user, forum_ids):
+        return dict(ForumReadWatermark.objects.filter(
+            user=user, forum__in=forum_ids, time_stamp__isnull=False
+        ).values_list('forum', 'time_stamp'))
+
+    # max count of topic ids passed to one query
+    chunk_size = 500
+
+    def filter_unread_topics(self, user, topics):
+        # topics passed by watermarks are excluded with join, topics read out
+        # of order are checked in python by chunks of their ids
+        topics = topics.exclude(id__in=Topic.objects.filter(
+            forum__forumreadwatermark__user=user,
+            forum__forumreadwatermark__time_stamp__gte=F('updated')).values('id'))
+        topic_marks = {}
+        for topics_str in ForumReadWatermark.objects.filter(user=user).exclude(
+                topics='').values_list('topics', flat=True):
+            topic_marks.update(ForumReadWatermark(topics=topics_str).get_topics())
+        topic_ids = list(topic_marks)
+        read = []
+        for i in range(0, len(topic_ids), self.chunk_size):
+            read.extend(topic_id for topic_id, updated in topics.filter(
+                id__in=topic_ids[i:i + self.chunk_size]).values_list('id', 'updated')
+                if updated is not None and updated <= topic_marks[topic_id])
+        if read:
+            topics = topics.exclude(id__in=read)
+        return topics
+
+    def advance(self, mark, topic_marks):
+        """
+        Move watermark up to the oldest unread topic of forum and drop topic
+        marks it passes
+        """
+        topics = Topic.objects.filter(forum=mark.forum_id, updated__isnull=False)
+        if mark.time_stamp is not None:
+            topics = topics.filter(updated__gt=mark.time_stamp)
+        unread = list(topics.exclude(id__in=list(topic_marks)).order_by(
+            'updated').values_list('updated', flat=True)[:1])
+        read = []
+        for topic_id, updated in topics.filter(
+                id__in=list(topic_marks)).values_list('id', 'updated'):
+            if updated > topic_marks[topic_id]:
+                unread.append(updated)
+            else:
+                read.append((topic_id, updated))
+
+        if not unread:
+            mark.time_stamp = tznow()
+            mark.set_topics({})
+            return
+        oldest_unread = min(unread)
+        for topic_id, updated in read:
+            if updated < oldest_unread and (
+                    mark.time_stamp is None or updated > mark.time_stamp):
+                mark.time_stamp = updated
+        mark.set_topics(dict(
+            (topic_id, topic_marks[topic_id]) for topic_id, updated in read
+            if mark.time_stamp is None or updated > mark.time_stamp))
+
+    def save_mark(self, mark):
+        if mark.pk is not None:
+            mark.save()
+            return
+        if upsert_supported():
+            bulk_insert(ForumReadWatermark, ('user', 'forum', 'time_stamp', 'topics'),
+                        [(mark.user_id, mark.forum_id, mark.time_stamp, mark.topics)],
+                        conflict_fields=('user', 'forum'), update_fields=('time_stamp', 'topics'))
+            return
+        try:
+            with atomic_func():
+                mark.save()
+        except IntegrityError:
+            # concurrent request created watermark, it will be moved forward
+            # by the next topic view
+            pass
+
+    def mark_topic_read(self, user, topic):
+        try:
+            mark = ForumReadWatermark.objects.get(user=user, forum=topic.forum_id)
+        except ForumReadWatermark.DoesNotExist:
+            mark = ForumReadWatermark(user=user, forum_id=topic.forum_id)
+        topic_marks = mark.get_topics()
+        read = mark.get_read_time(topic.id, topic_marks)
+        if read is not None and read >= (topic.updated or topic.created):
+            return
+        topic_marks[topic.id] = tznow()
+        self.advance(mark, topic_marks)
+        self.save_mark(mark)
+
+    def mark_topics_read(self, user, marks):
+        forum_marks = self.get_marks(user, list(marks))
+        for forum_id, reads in marks.items():
+            mark = forum_marks.get(forum_id) or ForumReadWatermark(user=user, forum_id=forum_id)
+            topic_marks = mark.get_topics()
+            for topic_id, read in reads.items():
+                if topic_id not in topic_marks or topic_marks[topic_id] < read:
+                    topic_marks[topic_id] = read
+            self.advance(mark, topic_marks)
+            self.save_mark(mark)
+
+    def mark_all_read(self, user, forums):
+        now = tznow()
+        forum_ids = set(forums.values_list('id', flat=True))
+        if upsert_supported():
+            bulk_insert(ForumReadWatermark, ('user', 'forum', 'time_stamp', 'topics'),
+                        [(user.pk, forum_id, now, '') for forum_id in forum_ids],
+                        conflict_fields=('user', 'forum'), update_fields=('time_stamp', 'topics'))
+            return
+        marks = ForumReadWatermark.objects.filter(user=user, forum__in=forum_ids)
+        marks.update(time_stamp=now, topics='')
+        forum_ids.difference_update(marks.values_list('forum', flat=True))
+        ForumReadWatermark.objects.bulk_create([
+            ForumReadWatermark(user=user, forum_id=forum_id, time_stamp=now)
+            for forum_id in forum_ids])
+
+
+class CacheLog(object):
+    """
+    Append only list of values kept in cache shared between processes. Every
+    value has own key with index from atomic counter and slots are claimed
+    with `cache.add` both by `append` and by `collect` skipping missing slot,
+    so concurrent appends and collects never lose values.
+    """
+    # placeholder of slot skipped by collect before append filled it
+    skipped = '-'
+
+    def __init__(self, cache, name, timeout):
+        self.cache = cache
+        self.name = name
+        self.timeout = timeout
+
+    def key(self, item):
+        return build_cache_key('read_marks', log=self.name, item=item)
+
+    def append(self, value):
+        counter = self.key('count')
+        while True:
+            self.cache.add(counter, 0, self.timeout)
+            try:
+                index = self.cache.incr(counter)
+            except ValueError:
+                # counter expired between add and incr
+                continue
+            if self.cache.add(self.key(index), value, self.timeout):
+                return index
+
+    def get_range(self):
+        start = self.cache.get(self.key('start')) or 1
+        end = self.cache.get(self.key('count')) or 0
+        if end < start - 1:
+            # counter expired and started again
+            start = 1
+        return start, end
+
+    def values(self):
+        """ list of values in log """
+        start, end = self.get_range()
+        if end < start:
+            return []
+        values = self.cache.get_many([self.key(index) for index in range(start, end + 1)])
+        return [value for value in values.values() if value != self.skipped]
+
+    def collect(self):
+        """
+        Return (end, values) of log, slots which are not filled yet are
+        skipped. Call `drop(end, ...)` once values are processed
+        """
+        start, end = self.get_range()
+        if end < start:
+            return end, []
+        keys = [self.key(index) for index in range(start, end + 1)]
+        values = self.cache.get_many(keys)
+        for key in keys:
+            if key not in values and not self.cache.add(key, self.skipped, self.timeout):
+                # value was appended meanwhile
+                values[key] = self.cache.get(key)
+        values = dict((key, value) for key, value in values.items()
+                      if value is not None and value != self.skipped)
+        return end, list(values.values())
+
+    def drop(self, end):
+        """ remove values up to index `end` returned by `collect` """
+        start = self.get_range()[0]
+        self.cache.set(self.key('start'), end + 1, self.timeout)
+        if end >= start:
+            # skipped placeholders are kept until they expire, so late
+            # append can't fill slot which is already dropped
+            keys = [self.key(index) for index in range(start, end + 1)]
+            self.cache.delete_many([key for key, value in self.cache.get_many(keys).items()
+                                    if value != self.skipped])
+
+
+class BufferedReadTracker(object):
+    """
+    Wrapper of other read tracker which keeps marks of read topics in cache
+    and writes them with `mark_topics_read` of wrapped tracker in batches,
+    when `flush` is called by `pybb_flush_read_marks` command. Read state of
+    topics and forums includes pending marks of user, they are merged in
+    memory. It's used when `settings.PYBB_READ_TRACKER_FLUSH_INTERVAL` is set.
+    """
+    # pending marks which are not written for so long are lost
+    timeout = 7 * 24 * 3600
+
+    def __init__(self, tracker, interval, cache_alias='default'):
+        self.tracker = tracker
+        self.interval = interval
+        self.cache_alias = cache_alias
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.tracker, name)
+
+    @property
+    def cache(self):
+        """ cache with `cache_alias`, resolved once per thread like django does """
+        cache = getattr(self._local, 'cache', None)
+        if cache is None:
+            cache = self._local.cache = get_cache(self.cache_alias)
+        return cache
+
+    def get_log(self, user_id=None):
+        """ CacheLog of (topic id, forum id, read time) marks of user, of user ids by default """
+        return CacheLog(self.cache, 'users' if user_id is None else user_id, self.timeout)
+
+    def get_pending(self, user):
+        """
+        Return dict of topic id to (forum id, read time) of pending marks of `user`
+        """
+        pending = {}
+        for topic_id, forum_id, read in self.get_log(user.pk).values():
+            if topic_id not in pending or pending[topic_id][1] < read:
+                pending[topic_id] = (forum_id, read)
+        return pending
+
+    def get_pending_read_ids(self, user, pending):
+        """ list of ids of topics read by `user` according to `pending` marks """
+        if not pending:
+            return []
+        return [topic_id for topic_id, updated, created in Topic.objects.filter(
+            id__in=list(pending)).values_list('id', 'updated', 'created')
+            if pending[topic_id][1] >= (updated or created)]
+
+    def get_topic_read_times(self, user, topics):
+        read_times = self.tracker.get_topic_read_times(user, topics)
+        pending = self.get_pending(user)
+        for topic in topics:
+            if topic.id in pending:
+                read = pending[topic.id][1]
+                if topic.id not in read_times or read_times[topic.id] < read:
+                    read_times[topic.id] = read
+        return read_times
+
+    def get_forum_read_times(self, user, forum_ids):
+        read_times = self.tracker.get_forum_read_times(user, forum_ids)
+        forum_ids = set(forum_ids)
+        pending = self.get_pending(user)
+        forums = {}
+        for forum_id, read in pending.values():
+            if forum_id in forum_ids and (forum_id not in forums or forums[forum_id] < read):
+                forums[forum_id] = read
+        if not forums:
+            return read_times
+        # forum is read up to the last pending mark if pending marks read all its topics
+        unread = set(self.tracker.filter_unread_topics(user, Topic.objects.filter(
+            forum__in=list(forums)).exclude(id__in=self.get_pending_read_ids(user, pending))
+        ).order_by().values_list('forum', flat=True).distinct())
+        for forum_id, read in forums.items():
+            if forum_id not in unread and (forum_id not in read_times or read_times[forum_id] < read):
+                read_times[forum_id] = read
+        return read_times
+
+    def filter_unread_topics(self, user, topics):
+        read_ids = self.get_pending_read_ids(user, self.get_pending(user))
+        if read_ids:
+            topics = topics.exclude(id__in=read_ids)
+        return self.tracker.filter_unread_topics(user, topics)
+
+    def get_unread_topic_counts(self, user, topics):
+        read_ids = self.get_pending_read_ids(user, self.get_pending(user))
+        if read_ids:
+            topics = topics.exclude(id__in=read_ids)
+        return self.tracker.get_unread_topic_counts(user, topics)
+
+    def mark_topic_read(self, user, topic):
+        self.get_log(user.pk).append((topic.id, topic.forum_id, tznow()))
+        if self.cache.add(build_cache_key('read_marks_queued', user_id=user.pk), True, self.timeout):
+            self.get_log().append(user.pk)
+
+    def mark_all_read(self, user, forums):
+        # pending marks of these forums are older than forum marks, so
+        # wrapped tracker ignores them when they are written
+        self.tracker.mark_all_read(user, forums)
+
+    def flush(self):
+        """
+        Write pending marks of all users to database, return count of written
+        marks. Concurrent calls are skipped, lock expires in `interval` seconds
+        """
+        cache = self.cache
+        lock = build_cache_key('read_marks_flush')
+        if not cache.add(lock, True, self.interval):
+            return 0
+        try:
+            users_log = self.get_log()
+            end, user_ids = users_log.collect()
+            users = User.objects.in_bulk(list(set(user_ids)))
+            count = 0
+            for user_id in set(user_ids):
+                # marks added after this are queued again
+                cache.delete(build_cache_key('read_marks_queued', user_id=user_id))
+                log = self.get_log(user_id)
+                user_end, topic_marks = log.collect()
+                if user_id in users and topic_marks:
+                    marks = {}
+                    for topic_id, forum_id, read in topic_marks:
+                        forum_marks = marks.setdefault(forum_id, {})
+                        if topic_id not in forum_marks or forum_marks[topic_id] < read:
+                            forum_marks[topic_id] = read
+                    self.tracker.mark_topics_read(users[user_id], marks)
+                    count += len(topic_marks)
+                log.drop(user_end)
+            users_log.drop(end)
+        finally:
+            cache.delete(lock)
+        return count
+
+
+def annotate_topics_unread(user, topics):
+    """
+    Set `unread` attribute of topics from any iterable for `user` and return
+    them as list. Read times are loaded at once by ids of topics and forums
+    with at most two queries, related objects of topics are not loaded
+    """
+    topic_list = list(topics)
+    if not user.is_authenticated():
+        for topic in topic_list:
+            topic.unread = False
+        return topic_list
+    read_times = read_tracker.get_topic_read_times(user, topic_list) if topic_list else {}
+    for topic in topic_list:
+        read = read_times.get(topic.id)
+        topic.unread = read is None or (topic.updated or topic.created) > read
+    return topic_list
+
+
+def get_unread_counts(user, client=None):
+    """
+    Return counts of topics unread by `user` per forum, category and client
+    together with total count, only forums of `client` (instance, id or code)
+    are counted if it's passed. Counts are cached until user reads something
+    or topics of forums visible to user change (see `invalidate_unread_counts`)
+    """
+    empty = {'total': 0, 'forums': {}, 'categories': {}, 'clients': {}}
+    if not user.is_authenticated():
+        return empty
+    client = getattr(client, 'pk', client)
+    forum_ids = perms.get_visible_forum_ids(user, client)
+    version_keys = dict((build_cache_key('unread_counts_version', forum_id=forum_id), forum_id)
+                        for forum_id in forum_ids)
+    cached_versions = cache.get_many(list(version_keys))
+    versions = dict((forum_id, cached_versions.get(key)) for key, forum_id in version_keys.items())
+    key = build_cache_key('unread_counts', user_id=user.pk)
+    cached = cache.get(key) or {}
+    if client in cached and cached[client][0] == versions:
+        return cached[client][1]
+
+    forums = perms.filter_forums(user, Forum.objects.filter(id__in=list(forum_ids)))
+    forum_counts = read_tracker.get_unread_topic_counts(
+        user, perms.filter_topics(user, Topic.objects.filter(forum__in=forums.values('id'))))
+    counts = empty
+    for forum_id, category_id, client_code in forums.filter(
+            id__in=list(forum_counts)).values_list('id', 'category', 'category__client__code'):
+        count = forum_counts[forum_id]
+        counts['forums'][forum_id] = count
+        counts['categories'][category_id] = counts['categories'].get(category_id, 0) + count
+        counts['clients'][client_code] = counts['clients'].get(client_code, 0) + count
+        counts['total'] += count
+    cached[client] = (versions, counts)
+    cache.set(key, cached, defaults.PYBB_UNREAD_COUNTS_CACHE_TIMEOUT)
+    return counts
+
+
+def get_subscribed_unread_topics(user):
+    """
+    Return queryset of topics subscribed by `user` which have posts unread
+    by him, ordered by update time and id from the newest
+    """
+    topics = perms.filter_topics(user, Topic.objects.filter(
+        subscribers=user, updated__isnull=False))
+    return read_tracker.filter_unread_topics(user, topics).order_by('-updated', '-id')
+
+
+read_tracker = _resolve_class(defaults.PYBB_READ_TRACKER)
+if defaults.PYBB_READ_TRACKER_FLUSH_INTERVAL:
+    read_tracker = BufferedReadTracker(
+        read_tracker, defaults.PYBB_READ_TRACKER_FLUSH_INTERVAL,
+        defaults.PYBB_READ_TRACKER_BUFFER_BACKEND)
@@ -23,7 +23,7 @@ email_validator = forms.EmailField()
 
 def notify_topic_subscribers(post):
     topic = post.topic
-    if post != topic.head:
+    if post.id != topic.head_id:
         for user in topic.subscribers.all():
             if user != post.user:
                 try:
@@ -3,11 +3,14 @@ from __future__ import unicode_literals
 import inspect
 
 import math
+import operator
 import time
 import warnings
+from functools import reduce
 
 from django import template
 from django.core.cache import cache
+from django.db.models import Q
 from django.template.base import (
     get_library, InvalidTemplateLibrary, TemplateSyntaxError,
     TOKEN_BLOCK, token_kwargs)
@@ -30,10 +33,9 @@ try:
 except ImportError:
     pytils_enabled = False
 
-from pybb.models import (
-    TopicReadTracker, ForumReadTracker, PollAnswerUser, Topic, Post)
+from pybb.models import PollAnswerUser, Topic, Post, Forum
 from pybb.permissions import perms
-from pybb import defaults, util
+from pybb import defaults, read_tracking, util
 
 
 register = template.Library()
@@ -143,20 +145,7 @@ def pybb_posted_by(post, user):
 
 @register.filter
 def pybb_is_topic_unread(topic, user):
-    if not user.is_authenticated():
-        return False
-
-    last_topic_update = topic.updated or topic.created
-
-    unread = not ForumReadTracker.objects.filter(
-        forum=topic.forum,
-        user=user.id,
-        time_stamp__gte=last_topic_update).exists()
-    unread &= not TopicReadTracker.objects.filter(
-        topic=topic,
-        user=user.id,
-        time_stamp__gte=last_topic_update).exists()
-    return unread
+    return read_tracking.annotate_topics_unread(user, [topic])[0].unread
 
 
 @register.filter
@@ -164,50 +153,58 @@ def pybb_topic_unread(topics, user):
     """
     Mark all topics in queryset/list with .unread for target user
     """
-    topic_list = list(topics)
-
-    if user.is_authenticated():
-        for topic in topic_list:
-            topic.unread = True
-
-        forums_ids = [f.forum_id for f in topic_list]
-        forum_marks = dict([(m.forum_id, m.time_stamp)
-                            for m
-                            in ForumReadTracker.objects.filter(user=user, forum__in=forums_ids)])
-        if len(forum_marks):
-            for topic in topic_list:
-                topic_updated = topic.updated or topic.created
-                if topic.forum.id in forum_marks and topic_updated <= forum_marks[topic.forum.id]:
-                    topic.unread = False
-
-        qs = TopicReadTracker.objects.filter(user=user, topic__in=topic_list).select_related('topic')
-        topic_marks = list(qs)
-        topic_dict = dict(((topic.id, topic) for topic in topic_list))
-        for mark in topic_marks:
-            if topic_dict[mark.topic.id].updated <= mark.time_stamp:
-                topic_dict[mark.topic.id].unread = False
-    return topic_list
+    if isinstance(topics, UnreadCheckedList):
+        return topics
+    return read_tracking.annotate_topics_unread(user, topics)
+
+
+class UnreadCheckedList(list):
+    """
+    List of forums or topics already checked for unread messages,
+    `pybb_forum_unread` and `pybb_topic_unread` return it as is
+    """
 
 
 @register.filter
 def pybb_forum_unread(forums, user):
     """
     Check if forum has unread messages.
+    Forum with topics is unread if it was updated after user read it or
+    any of its subforums is unread. Subforums of all forums are loaded
+    with one query by materialized path, read marks with another one.
     """
+    if isinstance(forums, UnreadCheckedList):
+        return forums
     forum_list = list(forums)
-    if user.is_authenticated():
-        for forum in forum_list:
-            forum.unread = forum.topic_count > 0
-        forum_marks = ForumReadTracker.objects.filter(
-            user=user,
-            forum__in=forum_list
-        ).select_related('forum')
-        forum_dict = dict(((forum.id, forum) for forum in forum_list))
-        for mark in forum_marks:
-            curr_forum = forum_dict[mark.forum.id]
-            if (curr_forum.updated is None) or (curr_forum.updated <= mark.time_stamp):
-                if not any((f.unread for f in pybb_forum_unread(curr_forum.child_forums.all(), user))):
-                    forum_dict[mark.forum.id].unread = False
+    if not user.is_authenticated():
+        return forum_list
+    for forum in forum_list:
+        forum.unread = forum.topic_count > 0
+    checked = [forum for forum in forum_list if forum.unread]
+    if not checked:
+        return forum_list
+
+    # forums without path (not migrated yet) are checked without subforums
+    tree = dict((forum.id, forum) for forum in Forum.objects.filter(reduce(
+        operator.or_, [Q(path__startswith=forum.path) if forum.path else Q(pk=forum.pk)
+                       for forum in checked])
+    ).only('id', 'parent', 'path', 'topic_count', 'updated'))
+    tree.update((forum.id, forum) for forum in forum_list)
+    children = {}
+    for forum in tree.values():
+        children.setdefault(forum.parent_id, []).append(forum)
+    marks = read_tracking.read_tracker.get_forum_read_times(user, list(tree))
+
+    def is_unread(forum):
+        if not forum.topic_count:
+            return False
+        time_stamp = marks.get(forum.id)
+        if time_stamp is None or (forum.updated is not None and forum.updated > time_stamp):
+            return True
+        return any(is_unread(child) for child in children.get(forum.id, ()))
+
+    for forum in checked:
+        forum.unread = is_unread(forum)
     return forum_list
 
 
@@ -237,9 +234,16 @@ def pybb_get_profile(*args, **kwargs):
         return util.get_pybb_profile_model().objects.none()
 
 
+def _get_client(context, client):
+    if client is None and context is not None:
+        client = getattr(context.get('request'), 'pybb_client', None)
+    return client
+
+
 @register.assignment_tag(takes_context=True)
-def pybb_get_latest_topics(context, cnt=5, user=None):
-    qs = Topic.objects.all().order_by('-updated', '-created')
+def pybb_get_latest_topics(context, cnt=5, user=None, client=None):
+    qs = util.filter_by_client(Topic.objects.all(), _get_client(context, client))
+    qs = qs.order_by('-updated', '-created')
     if not user:
         user = context['user']
     qs = perms.filter_topics(user, qs)
@@ -247,8 +251,9 @@ def pybb_get_latest_topics(context, cnt=5, user=None):
 
 
 @register.assignment_tag(takes_context=True)
-def pybb_get_latest_posts(context, cnt=5, user=None):
-    qs = Post.objects.all().order_by('-created')
+def pybb_get_latest_posts(context, cnt=5, user=None, client=None):
+    qs = util.filter_by_client(Post.objects.all(), _get_client(context, client))
+    qs = qs.order_by('-created')
     if not user:
         user = context['user']
     qs = perms.filter_posts(user, qs)
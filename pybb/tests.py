@@ -3,19 +3,31 @@
 from __future__ import unicode_literals
 import time
 import datetime
+import json
 import os
+import threading
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 from django.contrib.auth.models import Permission
 from django.conf import settings
 from django.core import mail
 from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.utils import IntegrityError
 from django.db.models import Q
+from django.template import Context, Template
 from django.test import TestCase
 from django.test.client import Client
-from django.test.utils import override_settings
-from pybb import permissions, views as pybb_views
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils import timezone
+from pybb import models as pybb_models, permissions, read_tracking, views as pybb_views
+from pybb.markup import RenderCache, get_shared_cache, html_to_text, render_cache
 from pybb.templatetags.pybb_tags import pybb_is_topic_unread, pybb_topic_unread, pybb_forum_unread, \
     pybb_get_latest_topics, pybb_get_latest_posts
 
@@ -31,7 +43,7 @@ except ImportError:
     raise Exception('PyBB requires lxml for self testing')
 
 from pybb import defaults
-from pybb.models import Topic, TopicReadTracker, Forum, ForumReadTracker, Post, Category, PollAnswer, Profile, Client as ClientModel
+from pybb.models import Topic, TopicReadTracker, Forum, ForumReadTracker, ForumReadWatermark, Post, Category, PollAnswer, Profile, Client as ClientModel
 
 __author__ = 'zeus'
 
@@ -378,6 +390,240 @@ class FeaturesTest(TestCase, SharedTestModule):
         self.assertEqual(TopicReadTracker.objects.filter(user=self.user, topic=self.topic).count(), 0)
         self.assertEqual(ForumReadTracker.objects.filter(user=self.user, forum=self.forum).count(), 1)
 
+    def test_touch_tracker(self):
+        self.assertTrue(util.upsert_supported())
+        with self.assertNumQueries(1):
+            TopicReadTracker.objects.touch_tracker(self.user, self.topic)
+        time_stamp = TopicReadTracker.objects.get(user=self.user, topic=self.topic).time_stamp
+        with self.assertNumQueries(1):
+            TopicReadTracker.objects.touch_tracker(self.user, self.topic)
+        self.assertEqual(TopicReadTracker.objects.filter(user=self.user).count(), 1)
+        self.assertGreater(
+            TopicReadTracker.objects.get(user=self.user, topic=self.topic).time_stamp, time_stamp)
+
+        with self.assertNumQueries(1):
+            ForumReadTracker.objects.touch_tracker(self.user, self.forum)
+        self.assertEqual(ForumReadTracker.objects.filter(user=self.user, forum=self.forum).count(), 1)
+
+    def test_touch_tracker_fallback(self):
+        orig_upsert_supported = pybb_models.upsert_supported
+        pybb_models.upsert_supported = lambda: False
+        try:
+            TopicReadTracker.objects.touch_tracker(self.user, self.topic)
+            time_stamp = TopicReadTracker.objects.get(user=self.user, topic=self.topic).time_stamp
+            TopicReadTracker.objects.touch_tracker(self.user, self.topic)
+            self.assertEqual(TopicReadTracker.objects.filter(user=self.user).count(), 1)
+            self.assertGreater(
+                TopicReadTracker.objects.get(user=self.user, topic=self.topic).time_stamp, time_stamp)
+        finally:
+            pybb_models.upsert_supported = orig_upsert_supported
+
+    def test_mark_all_as_read_queries(self):
+        for i in range(30):
+            forum = Forum.objects.create(name='forum_%s' % i, category=self.category)
+            topic = Topic.objects.create(name='topic_%s' % i, forum=forum, user=self.user)
+            Post.objects.create(topic=topic, user=self.user, body='one')
+            TopicReadTracker.objects.touch_tracker(self.user, topic)
+        ForumReadTracker.objects.touch_tracker(self.user, self.forum)
+        with self.assertNumQueries(3):
+            read_tracking.DefaultReadTracker().mark_all_read(self.user, Forum.objects.all())
+        self.assertEqual(ForumReadTracker.objects.filter(user=self.user).count(), 31)
+        self.assertEqual(TopicReadTracker.objects.filter(user=self.user).count(), 0)
+
+    def test_mark_all_as_read_scope(self):
+        category_2 = Category.objects.create(name='bar', client=self.client_for)
+        forum_2 = Forum.objects.create(name='forum_2', category=category_2)
+        forum_3 = Forum.objects.create(name='forum_3', category=category_2, parent=forum_2)
+        forum_4 = Forum.objects.create(name='forum_4', category=category_2)
+        for forum in (forum_2, forum_3, forum_4):
+            topic = Topic.objects.create(name='topic', forum=forum, user=self.user)
+            Post.objects.create(topic=topic, user=self.user, body='one')
+        forums = [self.forum, forum_2, forum_3, forum_4]
+        self.login_client()
+
+        response = self.client.get(reverse('pybb_pybb:mark_forum_as_read', kwargs={'forum_id': forum_2.id}))
+        self.assertRedirects(response, forum_2.get_absolute_url())
+        self.assertListEqual([f.unread for f in pybb_forum_unread(
+            Forum.objects.filter(id__in=[f.id for f in forums]).order_by('id'), self.user)],
+            [True, False, False, True])
+
+        response = self.client.get(reverse('pybb_pybb:mark_category_as_read', kwargs={'category_id': category_2.id}))
+        self.assertRedirects(response, category_2.get_absolute_url())
+        self.assertListEqual([f.unread for f in pybb_forum_unread(
+            Forum.objects.filter(id__in=[f.id for f in forums]).order_by('id'), self.user)],
+            [True, False, False, False])
+
+    def test_topic_unread_queries(self):
+        forums = [Forum.objects.create(name='forum_%s' % i, category=self.category) for i in range(3)]
+        for i in range(20):
+            topic = Topic.objects.create(name='topic_%s' % i, forum=forums[i % 3], user=self.user)
+            Post.objects.create(topic=topic, user=self.user, body='one')
+            if i % 2:
+                TopicReadTracker.objects.touch_tracker(self.user, topic)
+        ForumReadTracker.objects.touch_tracker(self.user, forums[0])
+        topics = list(Topic.objects.filter(forum__in=forums).order_by('id'))
+        with self.assertNumQueries(2):
+            unread = [t.unread for t in pybb_topic_unread(topics, self.user)]
+        self.assertListEqual(unread, [i % 3 != 0 and i % 2 == 0 for i in range(20)])
+
+        topics = list(forums[0].topics.all())
+        with self.assertNumQueries(1):
+            self.assertFalse(any(t.unread for t in pybb_topic_unread(topics, self.user)))
+        with self.assertNumQueries(0):
+            pybb_topic_unread([], self.user)
+
+    def test_permission_context_queries(self):
+        user = User.objects.create_user('moder', 'moder@localhost', 'moder')
+        self.forum.moderators.add(user)
+        posts = [Post.objects.create(topic=self.topic, user=self.user, body='post %s' % i)
+                 for i in range(50)]
+        posts = list(Post.objects.filter(id__in=[p.id for p in posts]).select_related('topic__forum'))
+        template = Template('{% load pybb_tags %}{% for post in posts %}'
+                            '{% if user|pybb_may_edit_post:post %}E{% endif %}'
+                            '{% if user|pybb_may_delete_post:post %}D{% endif %}'
+                            '{% if user|pybb_may_create_post:post.topic %}C{% endif %}{% endfor %}')
+        # moderated forums, user permissions and group permissions
+        with self.assertNumQueries(3):
+            self.assertEqual(template.render(Context({'user': user, 'posts': posts})), 'EDC' * 50)
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(Context({'user': user, 'posts': posts})), 'EDC' * 50)
+
+        user.is_superuser = True
+        self.assertTrue(permissions.perms.may_moderate_topic(user, self.topic))
+        self.forum.moderators.remove(user)
+        user.is_superuser = False
+        self.assertTrue(permissions.perms.may_moderate_topic(user, self.topic))
+        permissions.reset_permission_context(user)
+        self.assertFalse(permissions.perms.may_moderate_topic(user, self.topic))
+
+        self.client.login(username='moder', password='moder')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.topic.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len([q for q in ctx.captured_queries
+                                  if 'pybb_forum_moderators' in q['sql']]), 2)
+
+    def test_moderators_cache(self):
+        user = User.objects.create_user('moder', 'moder@localhost', 'moder')
+        forum = Forum.objects.create(name='forum_2', category=self.category)
+        self.forum.moderators.add(user)
+        with self.assertNumQueries(1):
+            self.assertEqual(permissions.get_moderated_forum_ids(user.id), frozenset([self.forum.id]))
+        with self.assertNumQueries(0):
+            self.assertEqual(permissions.get_forum_moderator_ids(self.forum.id), frozenset([user.id]))
+            self.assertEqual(permissions.get_forum_moderator_ids(forum.id), frozenset())
+            self.assertTrue(permissions.perms.may_moderate_topic(user, self.topic))
+
+        user.forum_set.add(forum)
+        self.assertEqual(permissions.get_forum_moderator_ids(forum.id), frozenset([user.id]))
+        self.forum.moderators.clear()
+        self.assertEqual(permissions.get_moderated_forum_ids(user.id), frozenset([forum.id]))
+        forum.delete()
+        self.assertEqual(permissions.get_moderated_forum_ids(user.id), frozenset())
+
+        call_command('supermoderator', 'add', 'moder')
+        self.assertEqual(permissions.get_moderated_forum_ids(user.id),
+                         frozenset(Forum.objects.values_list('id', flat=True)))
+        call_command('supermoderator', 'del', 'moder')
+        self.assertEqual(permissions.get_moderated_forum_ids(user.id), frozenset())
+
+    def test_moderators_map_user_model(self):
+        # through table columns depend on AUTH_USER_MODEL (runtests.py uses custom one)
+        user = User.objects.create_user('moder', 'moder@localhost', 'moder')
+        self.forum.moderators.add(user, self.user)
+        forums, users = permissions.get_moderators_map()
+        self.assertEqual(forums[self.forum.id], frozenset([user.id, self.user.id]))
+        self.assertEqual(users[user.id], frozenset([self.forum.id]))
+
+        orig_timeout = defaults.PYBB_MODERATORS_CACHE_TIMEOUT
+        defaults.PYBB_MODERATORS_CACHE_TIMEOUT = 0
+        try:
+            with self.assertNumQueries(1):
+                context = permissions.PermissionContext(user)
+                self.assertEqual(context.moderated_forum_ids, frozenset([self.forum.id]))
+                self.assertTrue(context.is_moderator(self.forum.id))
+        finally:
+            defaults.PYBB_MODERATORS_CACHE_TIMEOUT = orig_timeout
+
+    def test_visible_forum_ids(self):
+        perms = permissions.perms
+        staff = User.objects.create_user('staff', 'staff@localhost', 'staff')
+        staff.is_staff = True
+        staff.save()
+        hidden_forum = Forum.objects.create(name='hidden', category=self.category, hidden=True)
+        category = Category.objects.create(name='hidden', client=self.client_for, hidden=True)
+        hidden_category_forum = Forum.objects.create(name='in hidden', category=category)
+        other_client = ClientModel.objects.create(name='Other', code='other')
+        other_forum = Forum.objects.create(
+            name='other', category=Category.objects.create(name='other', client=other_client))
+
+        self.assertEqual(perms.get_visible_forum_ids(self.user), frozenset([self.forum.id, other_forum.id]))
+        with self.assertNumQueries(0):
+            self.assertEqual(perms.get_visible_forum_ids(self.user, self.client_for), frozenset([self.forum.id]))
+            self.assertEqual(perms.get_visible_forum_ids(staff, self.client_for.id), frozenset(
+                [self.forum.id, hidden_forum.id, hidden_category_forum.id]))
+
+        hidden_forum.hidden = False
+        hidden_forum.save()
+        category.hidden = False
+        category.save()
+        self.assertEqual(perms.get_visible_forum_ids(self.user, self.client_for), frozenset(
+            [self.forum.id, hidden_forum.id, hidden_category_forum.id]))
+        other_forum.delete()
+        self.assertEqual(perms.get_visible_forum_ids(self.user, other_client), frozenset())
+
+        Forum.objects.filter(id=hidden_forum.id).update(hidden=True)
+        util.invalidate_visible_forums()
+        self.assertEqual(perms.get_visible_forum_ids(self.user, self.client_for.code), frozenset(
+            [self.forum.id, hidden_category_forum.id]))
+
+    def test_filters_scoped_to_request_client(self):
+        perms = permissions.perms
+        other_client = ClientModel.objects.create(name='Other', code='other')
+        other_forum = Forum.objects.create(
+            name='other', category=Category.objects.create(name='other', client=other_client))
+        other_topic = Topic.objects.create(name='other', forum=other_forum, user=self.user)
+        Post.objects.create(topic=other_topic, user=self.user, body='other')
+        user = User.objects.get(id=self.user.id)
+        self.assertEqual(set(perms.filter_topics(user, Topic.objects.all())),
+                         set([self.topic, other_topic]))
+
+        permissions.get_permission_context(user, self.client_for.code)
+        self.assertEqual(list(perms.filter_topics(user, Topic.objects.all())), [self.topic])
+        self.assertEqual(list(perms.filter_posts(user, Post.objects.all())), [self.post])
+        self.assertEqual(list(perms.filter_forums(user, Forum.objects.all())), [self.forum])
+
+        response = self.client.get(self.topic.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        request = response.context['request']
+        self.assertEqual(permissions.get_permission_context(request.user).client, request.pybb_client)
+
+    def test_filter_topics_without_joins(self):
+        perms = permissions.perms
+        hidden_forum = Forum.objects.create(name='hidden', category=self.category, hidden=True)
+        hidden_topic = Topic.objects.create(name='hidden', forum=hidden_forum, user=self.user)
+        moderated_topic = Topic.objects.create(name='moderated', forum=hidden_forum, user=self.user,
+                                               on_moderation=True)
+        user = User.objects.create_user('moder', 'moder@localhost', 'moder')
+        topic = Topic.objects.create(name='on moderation', forum=self.forum, user=self.user,
+                                     on_moderation=True)
+        self.assertEqual(list(perms.filter_topics(user, Topic.objects.all())), [self.topic])
+        self.forum.moderators.add(user)
+        user = User.objects.get(id=user.id)
+        qs = perms.filter_topics(user, Topic.objects.order_by('id'))
+        self.assertEqual(list(qs), [self.topic, topic])
+        sql = str(qs.query).upper()
+        self.assertNotIn('DISTINCT', sql)
+        self.assertNotIn('PYBB_FORUM_MODERATORS', sql)
+        self.assertNotIn('PYBB_CATEGORY', sql)
+
+        user.is_staff = True
+        self.assertEqual(list(perms.filter_topics(user, Topic.objects.order_by('id'))),
+                         [self.topic, hidden_topic, topic])
+        user.is_superuser = True
+        self.assertEqual(list(perms.filter_topics(user, Topic.objects.order_by('id'))),
+                         [self.topic, hidden_topic, moderated_topic, topic])
+
     def test_pybb_is_topic_unread_filter(self):
         forum_1 = self.forum
         topic_1 = self.topic
@@ -483,6 +729,96 @@ class FeaturesTest(TestCase, SharedTestModule):
         self.assertListEqual([f.unread for f in pybb_forum_unread([forum_parent, forum_child1, forum_child2], user_ann)],
                              [False, False, False])
 
+    def test_forum_unread_queries_independent_of_depth(self):
+        user_ann = User.objects.create_user('ann', 'ann@localhost', 'ann')
+        client_ann = Client()
+        client_ann.login(username='ann', password='ann')
+        parent = self.forum
+        for i in range(5):
+            parent = Forum.objects.create(name='child_%s' % i, category=self.category, parent=parent)
+            topic = Topic.objects.create(name='topic_%s' % i, forum=parent, user=self.user)
+            Post.objects.create(topic=topic, user=self.user, body='post %s' % i)
+        client_ann.get(reverse('pybb_pybb:mark_all_as_read'))
+        forums = list(Forum.objects.filter(parent=None))
+        with self.assertNumQueries(2):
+            self.assertEqual([f.unread for f in pybb_forum_unread(forums, user_ann)], [False])
+
+        Post.objects.create(topic=topic, user=self.user, body='deep unread')
+        forums = list(Forum.objects.filter(parent=None))
+        with self.assertNumQueries(2):
+            self.assertEqual([f.unread for f in pybb_forum_unread(forums, user_ann)], [True])
+
+    def test_forum_path(self):
+        child = Forum.objects.create(name='child', category=self.category, parent=self.forum)
+        grandchild = Forum.objects.create(name='grandchild', category=self.category, parent=child)
+        self.assertEqual(Forum.objects.get(id=grandchild.id).path,
+                         '%s/%s/%s/' % (self.forum.id, child.id, grandchild.id))
+
+        # moving forum moves its subtree
+        child.parent = None
+        child.save()
+        self.assertEqual(Forum.objects.get(id=child.id).path, '%s/' % child.id)
+        self.assertEqual(Forum.objects.get(id=grandchild.id).path, '%s/%s/' % (child.id, grandchild.id))
+        other = Forum.objects.create(name='other', category=self.category)
+        child.parent = other
+        child.save()
+        self.assertEqual(Forum.objects.get(id=grandchild.id).path,
+                         '%s/%s/%s/' % (other.id, child.id, grandchild.id))
+
+    def test_forum_subtree(self):
+        child = Forum.objects.create(name='child', category=self.category, parent=self.forum)
+        grandchild = Forum.objects.create(name='grandchild', category=self.category, parent=child)
+        topic = Topic.objects.create(name='deep', forum=grandchild, user=self.user)
+        Post.objects.create(topic=topic, user=self.user, body='deep')
+        Post.objects.create(topic=topic, user=self.user, body='deep 2')
+        forum = Forum.objects.get(id=self.forum.id)
+
+        self.assertEqual(list(forum.get_descendants()), [child, grandchild])
+        self.assertEqual(set(forum.subtree_topics), set([self.topic, topic]))
+        self.assertEqual(forum.get_subtree_counters(), {'topic_count': 2, 'post_count': 3})
+        grandchild = Forum.objects.get(id=grandchild.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(grandchild.get_ancestors(), [self.forum, child])
+
+    def test_forum_subtree_without_path(self):
+        child = Forum.objects.create(name='child', category=self.category, parent=self.forum)
+        grandchild = Forum.objects.create(name='grandchild', category=self.category, parent=child)
+        other = Forum.objects.create(name='other', category=self.category)
+        Topic.objects.create(name='other', forum=other, user=self.user)
+        topic = Topic.objects.create(name='deep', forum=grandchild, user=self.user)
+        # path isn't built e.g. for forums inserted with raw SQL
+        Forum.objects.update(path='')
+        forum = Forum.objects.get(id=self.forum.id)
+
+        self.assertEqual(set(forum.get_descendants()), set([child, grandchild]))
+        self.assertEqual(set(forum.get_descendants(include_self=True)), set([self.forum, child, grandchild]))
+        self.assertEqual(set(forum.subtree_topics), set([self.topic, topic]))
+        self.assertEqual(Forum.objects.get(id=other.id).get_subtree_counters(),
+                         {'topic_count': 1, 'post_count': 0})
+
+    def test_breadcrumb_queries_independent_of_depth(self):
+        def page_queries(url):
+            permissions.get_visible_forums_map()  # load cached visible forums
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            return len(ctx.captured_queries)
+
+        def deep_forum(depth):
+            parent = None
+            for i in range(depth):
+                parent = Forum.objects.create(name='level_%s' % i, category=self.category, parent=parent)
+            topic = Topic.objects.create(name='deep', forum=parent, user=self.user)
+            Post.objects.create(topic=topic, user=self.user, body='deep')
+            return parent, topic
+
+        forum_1, topic_1 = deep_forum(1)
+        forum_5, topic_5 = deep_forum(5)
+        self.assertEqual(page_queries(forum_1.get_absolute_url()) + 1,
+                         page_queries(forum_5.get_absolute_url()))
+        self.assertEqual(page_queries(topic_1.get_absolute_url()) + 1,
+                         page_queries(topic_5.get_absolute_url()))
+        self.assertContains(self.client.get(topic_5.get_absolute_url()), 'level_3')
+
     def test_read_tracker_when_topics_forum_changed(self):
         forum_1 = Forum.objects.create(name='f1', description='bar', category=self.category)
         forum_2 = Forum.objects.create(name='f2', description='bar', category=self.category)
@@ -939,6 +1275,342 @@ class FeaturesTest(TestCase, SharedTestModule):
         self.assertEqual(forum_1.topic_count, 0)
         self.assertEqual(forum_1.post_count, 0)
 
+    def test_counters_incremental(self):
+        forum_2 = Forum.objects.create(name='forum_2', category=self.category)
+        topic_2 = Topic.objects.create(name='topic_2', forum=forum_2, user=self.user)
+        posts = [Post.objects.create(topic=topic_2, user=self.user, body='post %s' % i) for i in range(3)]
+        self.assertEqual(topic_2.post_count, 3)
+        self.assertEqual(forum_2.post_count, 3)
+        self.assertEqual(forum_2.topic_count, 1)
+
+        # move the latest post to another forum
+        post = Post.objects.get(id=posts[-1].id)
+        post.topic = Topic.objects.get(id=self.topic.id)
+        post.save()
+        # move topic to another forum
+        topic_2 = Topic.objects.get(id=topic_2.id)
+        topic_2.forum = self.forum
+        topic_2.save()
+        Post.objects.get(id=posts[1].id).delete()
+
+        for obj in (Topic.objects.get(id=self.topic.id), Topic.objects.get(id=topic_2.id),
+                    Forum.objects.get(id=self.forum.id), Forum.objects.get(id=forum_2.id)):
+            incremental = obj.__class__.objects.filter(id=obj.id).values()[0]
+            obj.update_counters()
+            self.assertEqual(incremental, obj.__class__.objects.filter(id=obj.id).values()[0])
+
+    def test_latest_post_edited(self):
+        post = Post.objects.create(topic=self.topic, user=self.user, body='latest')
+        post = Post.objects.get(id=post.id)
+        post.body = 'edited'
+        post.updated = post.created + datetime.timedelta(minutes=1)
+        post.save()
+        self.assertEqual(Topic.objects.get(id=self.topic.id).updated, post.updated)
+        self.assertEqual(Forum.objects.get(id=self.forum.id).updated, post.updated)
+
+        # edit of older post doesn't move update time
+        old_post = Post.objects.get(id=self.post.id)
+        old_post.updated = post.updated + datetime.timedelta(minutes=1)
+        old_post.save()
+        self.assertEqual(Topic.objects.get(id=self.topic.id).updated, post.updated)
+        self.assertEqual(Forum.objects.get(id=self.forum.id).updated, post.updated)
+
+    def test_post_save_queries_independent_of_forum_size(self):
+        def post_save_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                Post.objects.create(topic=self.topic, user=self.user, body='test')
+            return len(ctx.captured_queries)
+
+        queries = post_save_queries()
+        for i in range(20):
+            topic = Topic.objects.create(name='topic_%s' % i, forum=self.forum, user=self.user)
+            Post.objects.create(topic=topic, user=self.user, body='test')
+        self.assertEqual(post_save_queries(), queries)
+
+    def test_last_post(self):
+        forum_2 = Forum.objects.create(name='forum_2', category=self.category)
+        topic_2 = Topic.objects.create(name='topic_2', forum=forum_2, user=self.user)
+        post_1 = Post.objects.create(topic=topic_2, user=self.user, body='post 1')
+        post_2 = Post.objects.create(topic=topic_2, user=self.user, body='post 2')
+        self.assertEqual(Topic.objects.get(id=topic_2.id).last_post, post_2)
+        self.assertEqual(Forum.objects.get(id=forum_2.id).last_post, post_2)
+
+        post_2.delete()
+        self.assertEqual(Topic.objects.get(id=topic_2.id).last_post, post_1)
+        self.assertEqual(Forum.objects.get(id=forum_2.id).last_post, post_1)
+
+        topic_2 = Topic.objects.get(id=topic_2.id)
+        topic_2.forum = self.forum
+        topic_2.save()
+        self.assertEqual(Forum.objects.get(id=self.forum.id).last_post, post_1)
+        self.assertEqual(Forum.objects.get(id=forum_2.id).last_post, None)
+
+        topic_2.delete()
+        self.assertEqual(Forum.objects.get(id=self.forum.id).last_post, self.post)
+
+    def test_topic_head(self):
+        self.assertEqual(Topic.objects.get(id=self.topic.id).head, self.post)
+        topic_2 = Topic.objects.create(name='topic_2', forum=self.forum, user=self.user)
+        post_1 = Post.objects.create(topic=topic_2, user=self.user, body='post 1')
+        post_2 = Post.objects.create(topic=topic_2, user=self.user, body='post 2')
+        self.assertEqual(Topic.objects.get(id=topic_2.id).head, post_1)
+
+        # move head post to another topic, it's not the first one there
+        post_1.topic = Topic.objects.get(id=self.topic.id)
+        post_1.save()
+        self.assertEqual(Topic.objects.get(id=topic_2.id).head, post_2)
+        self.assertEqual(Topic.objects.get(id=self.topic.id).head, self.post)
+
+        # editing head post must not load other posts of topic
+        post_2 = Post.objects.get(id=post_2.id)
+        post_2.body = 'edited'
+        with CaptureQueriesContext(connection) as ctx:
+            post_2.save()
+        self.assertFalse([q for q in ctx.captured_queries if 'ORDER BY' in q['sql']])
+
+        Post.objects.get(id=post_2.id).delete()
+        self.assertFalse(Topic.objects.filter(id=topic_2.id).exists())
+
+    def test_topic_head_backdated_post(self):
+        topic = Topic.objects.create(name='imported', forum=self.forum, user=self.user)
+        post_1 = Post.objects.create(topic=topic, user=self.user, body='post 1')
+        post_2 = Post.objects.create(topic=topic, user=self.user, body='post 2',
+                                     created=post_1.created - datetime.timedelta(days=1))
+        self.assertEqual(topic.head, post_2)
+        self.assertEqual(Topic.objects.get(id=topic.id).head, post_2)
+
+        # post between head and last post doesn't change head
+        post_3 = Post.objects.create(topic=topic, user=self.user, body='post 3',
+                                     created=post_1.created - datetime.timedelta(hours=1))
+        self.assertEqual(Topic.objects.get(id=topic.id).head, post_2)
+        self.assertEqual(list(topic.posts.order_by('position')), [post_2, post_3, post_1])
+
+    def test_post_create_queries(self):
+        topic = Topic.objects.create(name='measured', forum=self.forum, user=self.user)
+        Post.objects.create(topic=topic, user=self.user, body='first')
+        for i in range(2):
+            # savepoint and its release, max position, insert, counter updates of
+            # topic and forum, post author, subscribers and post count of profile
+            with self.assertNumQueries(10):
+                Post.objects.create(topic=topic, user=self.user, body='post %s' % i)
+        self.assertEqual(Topic.objects.get(id=topic.id).post_count, 3)
+
+    def test_save_does_not_refetch(self):
+        topic = Topic.objects.get(id=self.topic.id)
+        topic.sticky = True
+        with self.assertNumQueries(1):
+            topic.save()
+
+        post = Post.objects.select_related('topic').get(id=self.post.id)
+        post.body = 'edited'
+        with CaptureQueriesContext(connection) as ctx:
+            post.save()
+        self.assertFalse([q for q in ctx.captured_queries if 'FROM "pybb_post"' in q['sql']])
+
+        # deferred tracked fields are still compared with database value
+        forum_2 = Forum.objects.create(name='forum_2', category=self.category)
+        topic = Topic.objects.only('id', 'name').get(id=self.topic.id)
+        topic.forum = forum_2
+        topic.save()
+        self.assertEqual(Forum.objects.get(id=forum_2.id).topic_count, 1)
+        self.assertEqual(Forum.objects.get(id=self.forum.id).topic_count, 0)
+
+    def test_render_only_changed_body(self):
+        rendered = []
+        orig_engines = defaults.PYBB_MARKUP_ENGINES
+        orig_version = defaults.PYBB_MARKUP_VERSION
+
+        def engine(body):
+            rendered.append(body)
+            return body
+        defaults.PYBB_MARKUP_ENGINES = {defaults.PYBB_MARKUP: engine}
+        render_cache.clear()
+        try:
+            post = Post.objects.get(id=self.post.id)
+            post.on_moderation = True
+            post.save()
+            self.assertEqual(rendered, [])
+
+            post.body = 'changed'
+            post.save()
+            self.assertEqual(rendered, ['changed'])
+            Post.objects.get(id=post.id).save()
+            self.assertEqual(rendered, ['changed'])
+
+            defaults.PYBB_MARKUP_VERSION = orig_version + 1
+            Post.objects.get(id=post.id).save()
+            self.assertEqual(rendered, ['changed', 'changed'])
+
+            profile = util.get_pybb_profile(self.user)
+            profile.signature = 'signature'
+            profile.save()
+            self.assertEqual(rendered[-1], 'signature')
+            count = len(rendered)
+            profile.language = 'en'
+            profile.save()
+            self.assertEqual(len(rendered), count)
+
+            # signature is rendered again with new markup version too
+            defaults.PYBB_MARKUP_VERSION = orig_version + 2
+            profile.save()
+            self.assertEqual(rendered[count:], ['signature'])
+        finally:
+            defaults.PYBB_MARKUP_ENGINES = orig_engines
+            defaults.PYBB_MARKUP_VERSION = orig_version
+
+    def test_render_cache(self):
+        cache = RenderCache(size=2)
+        rendered = []
+
+        def render(text):
+            return cache.get_or_render(text, lambda: rendered.append(text) or text.upper())
+
+        self.assertEqual([render('a'), render('b'), render('a')], ['A', 'B', 'A'])
+        self.assertEqual(rendered, ['a', 'b'])
+        render('c')  # 'b' is least recently used
+        render('a')
+        render('b')
+        self.assertEqual(rendered, ['a', 'b', 'c', 'b'])
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 2, 'shared_hits': 0, 'misses': 4})
+
+        orig_backend = defaults.PYBB_RENDER_CACHE_BACKEND
+        defaults.PYBB_RENDER_CACHE_BACKEND = 'default'
+        try:
+            render('shared')
+            RenderCache(size=2).get_or_render('shared', lambda: self.fail('rendered twice'))
+            self.assertIs(get_shared_cache(), get_shared_cache())
+        finally:
+            defaults.PYBB_RENDER_CACHE_BACKEND = orig_backend
+
+        render_cache.clear()
+        self.login_client()
+        for i in range(3):
+            response = self.client.post(reverse('pybb_pybb:post_ajax_preview'), data={'data': '[b]preview[/b]'})
+            self.assertContains(response, '<strong>preview</strong>')
+        self.assertEqual(render_cache.stats()['misses'], 1)
+        self.assertEqual(render_cache.stats()['hits'], 2)
+
+    def test_smile_it(self):
+        smile_it = defaults.compile_smiles({':)': 'smile.png', ':))': 'lol.png', '8)': 'glasses.png'})
+        tree = html.fromstring(smile_it('<p><a title="8)" href="/a:)">:)) 8)</a> :)</p>'))
+        self.assertEqual(tree.xpath('//a/@title'), ['8)'])
+        self.assertEqual(tree.xpath('//a/@href'), ['/a:)'])
+        self.assertEqual([img.get('src').split('/')[-1] for img in tree.xpath('//img')],
+                         ['lol.png', 'glasses.png', 'smile.png'])
+        self.assertEqual(defaults.compile_smiles({})(':)'), ':)')
+
+        # entities are kept whole, smiles made of entities are still replaced
+        smile_it = defaults.compile_smiles({';)': 'wink.png', '&gt;_&lt;': 'angry.png'})
+        self.assertEqual(smile_it('&quot;quoted&quot;) &#39;single&#39;) &amp;)'),
+                         '&quot;quoted&quot;) &#39;single&#39;) &amp;)')
+        self.assertEqual(smile_it('&gt;_&lt; &gt;) ;)').count('<img'), 2)
+
+    def test_markdown_it(self):
+        self.assertIn('<a href="http://example.com">link</a>',
+                      defaults.markdown_it('[link][1]\n\n[1]: http://example.com'))
+        # references of previous text must not leak into next one
+        self.assertNotIn('<a', defaults.markdown_it('[link][1]'))
+        self.assertIn('&lt;script&gt;', defaults.markdown_it('<script>'))
+
+        results = {}
+
+        def convert(i):
+            results[i] = [defaults.markdown_it('*text %s*' % i) for _ in range(50)]
+        threads = [threading.Thread(target=convert, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(4):
+            self.assertEqual(set(results[i]), set(['<p><em>text %s</em></p>' % i]))
+
+    def test_rerender_command(self):
+        forum_2 = Forum.objects.create(name='forum_2', category=self.category)
+        topic_2 = Topic.objects.create(name='topic_2', forum=forum_2, user=self.user)
+        Post.objects.create(topic=topic_2, user=self.user, body='[b]other[/b]')
+        Post.objects.all().update(body_html='stale', body_text='stale', body_hash='')
+        profile = util.get_pybb_profile(self.user)
+        profile.signature = '[b]signature[/b]'
+        profile.save()
+        profile.__class__.objects.filter(pk=profile.pk).update(signature_html='stale', signature_hash='')
+        updated = Topic.objects.get(id=self.topic.id).updated
+        out = StringIO()
+
+        call_command('pybb_rerender', forums=[forum_2.id], processes=1, stdout=out)
+        self.assertEqual(Post.objects.filter(body_html='stale').count(), 1)
+        self.assertEqual(Post.objects.get(topic=topic_2).body_html, '<strong>other</strong>')
+
+        call_command('pybb_rerender', processes=2, chunk_size=1, signatures=True, stdout=out)
+        self.assertFalse(Post.objects.filter(body_html='stale').exists())
+        post = Post.objects.get(id=self.post.id)
+        self.assertEqual(post.body_text, 'bbcode test')
+        self.assertTrue(post.is_rendered())
+        self.assertEqual(profile.__class__.objects.get(pk=profile.pk).signature_html,
+                         '<strong>signature</strong>')
+        # counters and dates are not touched
+        self.assertEqual(Topic.objects.get(id=self.topic.id).updated, updated)
+
+        # up to date posts are skipped unless forced, start id allows to resume
+        out = StringIO()
+        call_command('pybb_rerender', processes=1, stdout=out)
+        self.assertIn('Successfully rendered 0 posts', out.getvalue())
+        call_command('pybb_rerender', processes=1, force=True, start_id=self.post.id + 1, stdout=out)
+        self.assertIn('Successfully rendered 1 posts', out.getvalue())
+
+        # only posts of client with passed code are rendered
+        out = StringIO()
+        call_command('pybb_rerender', processes=1, force=True, client='other', stdout=out)
+        self.assertIn('Successfully rendered 0 posts', out.getvalue())
+        call_command('pybb_rerender', processes=1, force=True, client=self.client_for.code, stdout=out)
+        self.assertIn('Successfully rendered 2 posts', out.getvalue())
+
+    def test_html_to_text(self):
+        self.assertEqual(
+            html_to_text('<blockquote><em>a &amp; b</em> &lt;tag&gt;</blockquote><!-- <p> -->'
+                         '<a href="/?a=1&amp;b=2">&quot;c&#39;&#8212;&#x263A;&copy;&nbsp;</a>'),
+            'a & b <tag>"c\'\u2014\u263a\xa9\xa0')
+        # unknown and broken entities are left as is
+        self.assertEqual(html_to_text('&unknown; &#99999999999; & &amp'), '&unknown; &#99999999999; & &amp')
+
+    def test_last_post_queries_independent_of_list_size(self):
+        def page_queries(url):
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            return len(ctx.captured_queries)
+
+        urls = [reverse('pybb_pybb:index'), self.forum.get_absolute_url()]
+        queries = [page_queries(url) for url in urls]
+        for i in range(5):
+            user = User.objects.create_user('user_%s' % i, 'user_%s@localhost' % i, 'user')
+            forum = Forum.objects.create(name='forum_%s' % i, category=self.category)
+            for f in (forum, self.forum):
+                topic = Topic.objects.create(name='topic_%s' % i, forum=f, user=user)
+                Post.objects.create(topic=topic, user=user, body='test')
+        self.assertEqual([page_queries(url) for url in urls], queries)
+        self.assertContains(self.client.get(urls[0]), 'user_4')
+
+    def test_index_query_budget(self):
+        def index_queries():
+            permissions.get_visible_forums_map()  # load cached visible forums
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(reverse('pybb_pybb:index'))
+            self.assertEqual(response.status_code, 200)
+            return len(ctx.captured_queries)
+
+        self.login_client()
+        queries = index_queries()
+        self.client.logout()
+        anonymous_queries = index_queries()
+        for i in range(3):
+            category = Category.objects.create(name='category_%s' % i, client=self.client_for)
+            for j in range(3):
+                forum = Forum.objects.create(name='forum_%s_%s' % (i, j), category=category)
+                topic = Topic.objects.create(name='topic', forum=forum, user=self.user)
+                Post.objects.create(topic=topic, user=self.user, body='test')
+        self.assertEqual(index_queries(), anonymous_queries)
+        self.login_client()
+        self.assertEqual(index_queries(), queries)
+
     def test_user_views(self):
         response = self.client.get(reverse('pybb_pybb:user', kwargs={'username': self.user.username}))
         self.assertEqual(response.status_code, 200)
@@ -992,6 +1664,223 @@ class FeaturesTest(TestCase, SharedTestModule):
         self.assertEqual(latest_topics[0].body, 'post9')
         self.assertEqual(latest_topics[4].body, 'post5')
 
+    def test_client_kept_in_sync(self):
+        post = Post.objects.create(topic=self.topic, user=self.user, body='test')
+        self.assertEqual(Topic.objects.get(id=self.topic.id).client, self.client_for)
+        self.assertEqual(Post.objects.get(id=post.id).client, self.client_for)
+
+        other_client = ClientModel.objects.create(name='Other', code='other')
+        other_category = Category.objects.create(name='other', client=other_client)
+        other_forum = Forum.objects.create(name='other', category=other_category)
+        topic = Topic.objects.get(id=self.topic.id)
+        topic.forum = other_forum
+        topic.save()
+        self.assertEqual(Topic.objects.get(id=topic.id).client, other_client)
+        self.assertEqual(Post.objects.get(id=post.id).client, other_client)
+
+        other_forum.category = self.category
+        other_forum.save()
+        self.assertEqual(Topic.objects.get(id=topic.id).client, self.client_for)
+        self.assertEqual(Post.objects.get(id=post.id).client, self.client_for)
+
+        self.category.client = other_client
+        self.category.save()
+        self.assertEqual(Topic.objects.get(id=topic.id).client, other_client)
+        self.assertEqual(Post.objects.get(id=post.id).client, other_client)
+
+        post = Post.objects.get(id=post.id)
+        post.topic = Topic.objects.create(name='moved', forum=Forum.objects.create(
+            name='moved', category=Category.objects.create(name='moved', client=self.client_for)),
+            user=self.user)
+        post.save()
+        self.assertEqual(Post.objects.get(id=post.id).client, self.client_for)
+
+    def test_client_scoped_lists(self):
+        post = Post.objects.create(topic=self.topic, user=self.user, body='test')
+        other_client = ClientModel.objects.create(name='Other', code='other')
+        other_forum = Forum.objects.create(
+            name='other', category=Category.objects.create(name='other', client=other_client))
+        other_topic = Topic.objects.create(name='foreign topic', forum=other_forum, user=self.user)
+        other_post = Post.objects.create(topic=other_topic, user=self.user, body='foreign post')
+
+        self.login_client()
+        response = self.client.get(reverse('pybb_pybb:topic_latest'))
+        self.assertListEqual(list(response.context['topic_list']), [self.topic])
+        response = self.client.get(reverse('pybb_pybb:user_posts', kwargs={'username': self.user.username}))
+        self.assertListEqual(list(response.context['object_list']), [post, self.post])
+        response = self.client.get(reverse('pybb_pybb:user_topics', kwargs={'username': self.user.username}))
+        self.assertListEqual(list(response.context['object_list']), [self.topic])
+        response = self.client.get(reverse('pybb_pybb:feed_topics'))
+        self.assertContains(response, self.topic.get_absolute_url())
+        self.assertNotContains(response, 'foreign topic')
+        response = self.client.get(reverse('pybb_pybb:feed_posts'))
+        self.assertContains(response, post.get_absolute_url())
+        self.assertNotContains(response, 'foreign')
+
+        self.assertEqual(list(pybb_get_latest_topics(context=None, user=self.user, client='other')),
+                         [other_topic])
+        self.assertEqual(list(pybb_get_latest_posts(context=None, user=self.user, client=other_client)),
+                         [other_post])
+        self.assertEqual(len(pybb_get_latest_posts(context=None, user=self.user)), 3)
+
+    def test_post_position(self):
+        def positions(topic):
+            return list(topic.posts.order_by('created', 'id').values_list('position', flat=True))
+
+        posts = [self.post] + [Post.objects.create(topic=self.topic, user=self.user, body='post %s' % i)
+                               for i in range(4)]
+        self.assertEqual(positions(self.topic), [1, 2, 3, 4, 5])
+        start = posts[0].created - datetime.timedelta(days=1)
+        for i, post in enumerate(posts):
+            Post.objects.filter(id=post.id).update(created=start + datetime.timedelta(minutes=i))
+            post.created = start + datetime.timedelta(minutes=i)
+        Post.objects.get(id=posts[2].id).delete()
+        self.assertEqual(positions(self.topic), [1, 2, 3, 4])
+
+        earlier = Post(topic=self.topic, user=self.user, body='earlier',
+                       created=posts[0].created + datetime.timedelta(seconds=1))
+        earlier.save()
+        self.assertEqual(Post.objects.get(id=earlier.id).position, 2)
+        self.assertEqual(positions(self.topic), [1, 2, 3, 4, 5])
+
+        topic = Topic.objects.create(name='other', forum=self.forum, user=self.user)
+        head = Post.objects.create(topic=topic, user=self.user, body='head')
+        post = Post.objects.get(id=posts[3].id)
+        post.topic = topic
+        post.save()
+        self.assertEqual(positions(self.topic), [1, 2, 3, 4])
+        self.assertEqual(positions(topic), [1, 2])
+        self.assertEqual(list(topic.posts.order_by('position')), [post, head])
+
+        with self.assertNumQueries(2):
+            self.topic.shift_positions(2, 1)
+        self.assertEqual(positions(self.topic), [1, 3, 4, 5])
+        self.topic.shift_positions(3, -1)
+        self.assertEqual(positions(self.topic), [1, 2, 3, 4])
+
+    def test_post_position_conflict(self):
+        Post.objects.filter(id=self.post.id).update(
+            created=self.post.created - datetime.timedelta(days=2))
+        Post.objects.create(topic=self.topic, user=self.user, body='second')
+        orig_shift_positions = Topic.shift_positions
+        shifts = []
+
+        def skip_first_shift(topic, start, delta):
+            # position taken by concurrent post is not moved on first attempt
+            shifts.append(start)
+            if len(shifts) > 1:
+                orig_shift_positions(topic, start, delta)
+
+        Topic.shift_positions = skip_first_shift
+        try:
+            post = Post.objects.create(topic=self.topic, user=self.user, body='between',
+                                       created=self.post.created - datetime.timedelta(days=1))
+        finally:
+            Topic.shift_positions = orig_shift_positions
+        self.assertEqual(shifts, [2, 2])
+        self.assertEqual(Post.objects.get(id=post.id).position, 2)
+        self.assertEqual(list(self.topic.posts.order_by('position').values_list('position', flat=True)),
+                         [1, 2, 3])
+        with self.assertRaises(IntegrityError):
+            Post.objects.filter(id=post.id).update(position=1)
+
+    def test_keyset_topic_pagination(self):
+        page_size = defaults.PYBB_TOPIC_PAGE_SIZE
+        posts = [self.post] + [Post.objects.create(topic=self.topic, user=self.user, body='post %s' % i)
+                               for i in range(page_size * 3 - 1)]
+        url = self.topic.get_absolute_url()
+
+        def page_queries(params):
+            permissions.get_visible_forums_map()  # load cached visible forums
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            post_queries = [q['sql'] for q in ctx.captured_queries if 'FROM "pybb_post"' in q['sql']]
+            self.assertFalse([sql for sql in post_queries if 'OFFSET' in sql or 'COUNT(' in sql])
+            return response, len(ctx.captured_queries)
+
+        response, first_queries = page_queries({'page': 1})
+        self.assertEqual(list(response.context['object_list']), posts[:page_size])
+        self.assertEqual(response.context['page_obj'].paginator.num_pages, 3)
+        next_cursor = response.context['page_obj'].next_cursor
+        self.assertContains(response, 'after=%s' % next_cursor)
+
+        response, queries = page_queries({'page': 3})
+        self.assertEqual(list(response.context['object_list']), posts[2 * page_size:])
+        self.assertFalse(response.context['page_obj'].has_next())
+        self.assertEqual(queries, first_queries)
+        response, queries = page_queries({'page': 2, 'after': next_cursor})
+        self.assertEqual(list(response.context['object_list']), posts[page_size:2 * page_size])
+        self.assertEqual(response.context['page_obj'].number, 2)
+        self.assertEqual(queries, first_queries)
+        response = self.client.get(url, {'page': 'last'})
+        self.assertEqual(response.context['page_obj'].number, 3)
+        self.assertEqual(self.client.get(url, {'page': 4}).status_code, 404)
+
+        response = self.client.get(reverse('pybb_pybb:post', kwargs={'pk': posts[page_size].id}))
+        self.assertTrue(response['Location'].endswith('%s?page=2#post-%d' % (url, posts[page_size].id)))
+
+        orig_keyset = defaults.PYBB_KEYSET_PAGINATION
+        defaults.PYBB_KEYSET_PAGINATION = False
+        try:
+            response = self.client.get(url, {'page': 2})
+            self.assertEqual(list(response.context['object_list']), posts[page_size:2 * page_size])
+        finally:
+            defaults.PYBB_KEYSET_PAGINATION = orig_keyset
+
+    def test_keyset_forum_pagination(self):
+        page_size = defaults.PYBB_FORUM_PAGE_SIZE
+        for i in range(page_size * 2):
+            topic = Topic.objects.create(name='topic %s' % i, forum=self.forum, user=self.user)
+            if i % 3:
+                Post.objects.create(topic=topic, user=self.user, body='post %s' % i)
+        Topic.objects.filter(name='topic 4').update(sticky=True)
+        url = self.forum.get_absolute_url()
+
+        orig_keyset = defaults.PYBB_KEYSET_PAGINATION
+        defaults.PYBB_KEYSET_PAGINATION = False
+        try:
+            expected = []
+            for page in (1, 2, 3):
+                expected.extend(self.client.get(url, {'page': page}).context['object_list'])
+        finally:
+            defaults.PYBB_KEYSET_PAGINATION = orig_keyset
+
+        topics = []
+        params = {'page': 1}
+        while True:
+            response = self.client.get(url, params)
+            page_obj = response.context['page_obj']
+            topics.extend(response.context['object_list'])
+            if not page_obj.has_next():
+                break
+            params = {'page': page_obj.next_page_number(), 'after': page_obj.next_cursor}
+        self.assertEqual(page_obj.number, 3)
+        self.assertEqual(topics, expected)
+        self.assertEqual(len(set(topics)), page_size * 2 + 1)
+
+        response = self.client.get(url, {'page': 2, 'after': 'wrong'})
+        self.assertEqual(list(response.context['object_list']), expected[page_size:page_size * 2])
+
+        # page by number: OFFSET reads only ordering fields
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, {'page': 3})
+        self.assertEqual(list(response.context['object_list']), expected[page_size * 2:])
+        offset_queries = [q['sql'] for q in ctx.captured_queries if 'OFFSET' in q['sql']]
+        self.assertEqual(len(offset_queries), 1)
+        self.assertNotIn('"pybb_topic"."name"', offset_queries[0])
+        self.assertNotIn('JOIN', offset_queries[0])
+
+        # stored counter isn't used when topics on moderation are hidden
+        defaults.PYBB_PREMODERATION = lambda user, body: False
+        try:
+            Topic.objects.filter(id=expected[0].id).update(on_moderation=True)
+            self.assertEqual(self.client.get(url).context['paginator'].count, page_size * 2)
+            self.login_client()
+            self.assertEqual(self.client.get(url).context['paginator'].count, page_size * 2 + 1)
+        finally:
+            defaults.PYBB_PREMODERATION = False
+
     def test_multiple_objects_returned(self):
         """
         see issue #87: https://github.com/hovel/pybbm/issues/87
@@ -1427,6 +2316,354 @@ class FiltersTest(TestCase, SharedTestModule):
         self.assertEqual(Post.objects.all()[0].body, 'test\nmultiple empty lines')
 
 
+class WatermarkReadTrackerTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.topic_2 = Topic.objects.create(name='topic_2', forum=self.forum, user=self.user)
+        Post.objects.create(topic=self.topic_2, user=self.user, body='two')
+        self.user_ann = User.objects.create_user('ann', 'ann@localhost', 'ann')
+        self.client.login(username='ann', password='ann')
+        self.ORIG_READ_TRACKER = read_tracking.read_tracker
+        read_tracking.read_tracker = read_tracking.WatermarkReadTracker()
+
+    def tearDown(self):
+        read_tracking.read_tracker = self.ORIG_READ_TRACKER
+
+    def get_unread(self):
+        topics = list(Topic.objects.filter(id__in=[self.topic.id, self.topic_2.id]).order_by('id'))
+        forums = list(Forum.objects.filter(id=self.forum.id))
+        return ([t.unread for t in pybb_topic_unread(topics, self.user_ann)] +
+                [f.unread for f in pybb_forum_unread(forums, self.user_ann)])
+
+    def test_read_in_order(self):
+        self.assertListEqual(self.get_unread(), [True, True, True])
+        self.client.get(self.topic.get_absolute_url())
+        self.assertListEqual(self.get_unread(), [False, True, True])
+        mark = ForumReadWatermark.objects.get(user=self.user_ann, forum=self.forum)
+        self.assertEqual(mark.time_stamp, Topic.objects.get(id=self.topic.id).updated)
+        self.assertEqual(mark.topics, '')
+
+        self.client.get(self.topic_2.get_absolute_url())
+        self.assertListEqual(self.get_unread(), [False, False, False])
+        self.assertEqual(ForumReadWatermark.objects.get(user=self.user_ann, forum=self.forum).topics, '')
+
+        Post.objects.create(topic=self.topic, user=self.user, body='three')
+        self.assertListEqual(self.get_unread(), [True, False, True])
+        self.assertTrue(pybb_is_topic_unread(Topic.objects.get(id=self.topic.id), self.user_ann))
+        self.assertFalse(pybb_is_topic_unread(Topic.objects.get(id=self.topic_2.id), self.user_ann))
+
+    def test_read_out_of_order(self):
+        self.client.get(self.topic_2.get_absolute_url())
+        self.assertListEqual(self.get_unread(), [True, False, True])
+        mark = ForumReadWatermark.objects.get(user=self.user_ann, forum=self.forum)
+        self.assertIsNone(mark.time_stamp)
+        self.assertListEqual(list(mark.get_topics()), [self.topic_2.id])
+
+        self.client.get(self.topic.get_absolute_url())
+        self.assertListEqual(self.get_unread(), [False, False, False])
+        mark = ForumReadWatermark.objects.get(user=self.user_ann, forum=self.forum)
+        self.assertIsNotNone(mark.time_stamp)
+        self.assertEqual(mark.topics, '')
+        self.assertEqual(TopicReadTracker.objects.count(), 0)
+        self.assertEqual(ForumReadTracker.objects.count(), 0)
+
+    def test_read_topic_again(self):
+        self.client.get(self.topic.get_absolute_url())
+        topic = Topic.objects.get(id=self.topic.id)
+        with self.assertNumQueries(1):
+            read_tracking.read_tracker.mark_topic_read(self.user_ann, topic)
+
+    def test_mark_all_as_read(self):
+        self.client.get(self.topic_2.get_absolute_url())
+        self.client.get(reverse('pybb_pybb:mark_all_as_read'))
+        self.assertListEqual(self.get_unread(), [False, False, False])
+        self.assertEqual(ForumReadWatermark.objects.get(user=self.user_ann, forum=self.forum).topics, '')
+        Post.objects.create(topic=self.topic_2, user=self.user, body='three')
+        self.assertListEqual(self.get_unread(), [False, True, True])
+
+    def test_open_first_unread_post(self):
+        self.client.get(self.topic.get_absolute_url())
+        post = Post.objects.create(topic=self.topic, user=self.user, body='three')
+        response = self.client.get(self.topic.get_absolute_url(), data={'first-unread': 1}, follow=True)
+        self.assertRedirects(response, '%s?page=1#post-%d' % (self.topic.get_absolute_url(), post.id))
+
+    def test_filter_unread_topics_many_marks(self):
+        tracker = read_tracking.read_tracker
+        updated = timezone.now() - datetime.timedelta(days=1)
+        forums = [Forum.objects.create(name='forum_%s' % i, category=self.category) for i in range(3)]
+        Topic.objects.bulk_create([
+            Topic(name='topic_%s' % i, forum=forums[i % 3], user=self.user, created=updated, updated=updated)
+            for i in range(1500)])
+        topic_ids = list(Topic.objects.filter(forum__in=forums).order_by('id').values_list('id', flat=True))
+        for forum in forums:
+            mark = ForumReadWatermark(user=self.user_ann, forum=forum)
+            # every topic except each 10th is read out of order
+            mark.set_topics(dict((topic_id, timezone.now()) for i, topic_id in enumerate(topic_ids)
+                                 if i % 3 == forums.index(forum) and i % 10))
+            mark.save()
+        ForumReadWatermark.objects.create(user=self.user_ann, forum=self.forum, time_stamp=timezone.now())
+
+        unread = tracker.filter_unread_topics(self.user_ann, Topic.objects.all())
+        self.assertEqual(sorted(unread.values_list('id', flat=True)), topic_ids[::10])
+        self.assertEqual(sum(tracker.get_unread_topic_counts(self.user_ann, Topic.objects.all()).values()), 150)
+
+    def test_migrate_command(self):
+        forum_2 = Forum.objects.create(name='forum_2', category=self.category)
+        topic_3 = Topic.objects.create(name='topic_3', forum=forum_2, user=self.user)
+        Post.objects.create(topic=topic_3, user=self.user, body='three')
+        read_tracking.read_tracker = self.ORIG_READ_TRACKER
+        self.client.get(self.topic_2.get_absolute_url())
+        self.client.get(topic_3.get_absolute_url())
+        self.assertEqual(TopicReadTracker.objects.count(), 1)
+        self.assertEqual(ForumReadTracker.objects.count(), 1)
+        unread = self.get_unread()
+
+        read_tracking.read_tracker = read_tracking.WatermarkReadTracker()
+        call_command('pybb_migrate_read_trackers', delete=True, stdout=StringIO())
+        self.assertEqual(TopicReadTracker.objects.count(), 0)
+        self.assertEqual(ForumReadTracker.objects.count(), 0)
+        self.assertEqual(ForumReadWatermark.objects.count(), 2)
+        self.assertListEqual(self.get_unread(), unread)
+        self.assertFalse(pybb_is_topic_unread(topic_3, self.user_ann))
+
+
+class BufferedReadTrackerTest(TestCase, SharedTestModule):
+    tracker_class = read_tracking.DefaultReadTracker
+
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.topic_2 = Topic.objects.create(name='topic_2', forum=self.forum, user=self.user)
+        Post.objects.create(topic=self.topic_2, user=self.user, body='two')
+        self.user_ann = User.objects.create_user('ann', 'ann@localhost', 'ann')
+        self.client.login(username='ann', password='ann')
+        self.ORIG_READ_TRACKER = read_tracking.read_tracker
+        self.tracker = read_tracking.read_tracker = read_tracking.BufferedReadTracker(
+            self.tracker_class(), 3600)
+        self.tracker.cache.clear()
+
+    def tearDown(self):
+        self.tracker.cache.clear()
+        read_tracking.read_tracker = self.ORIG_READ_TRACKER
+
+    def count_marks(self):
+        return (TopicReadTracker.objects.count() + ForumReadTracker.objects.count() +
+                ForumReadWatermark.objects.count())
+
+    def get_topic_unread(self):
+        topics = Topic.objects.filter(id__in=[self.topic.id, self.topic_2.id]).order_by('id')
+        return [t.unread for t in pybb_topic_unread(topics, self.user_ann)]
+
+    def test_marks_are_buffered(self):
+        self.client.get(self.topic.get_absolute_url())
+        self.client.get(self.topic_2.get_absolute_url())
+        self.assertEqual(self.count_marks(), 0)
+        self.assertListEqual(self.get_topic_unread(), [False, False])
+        self.assertFalse(pybb_is_topic_unread(self.topic, self.user_ann))
+        self.assertEqual(self.count_marks(), 0)
+
+        post = Post.objects.create(topic=self.topic, user=self.user, body='three')
+        self.assertListEqual(self.get_topic_unread(), [True, False])
+        response = self.client.get(self.topic.get_absolute_url(), data={'first-unread': 1}, follow=True)
+        self.assertRedirects(response, '%s?page=1#post-%d' % (self.topic.get_absolute_url(), post.id))
+
+    def test_forum_read_times_include_pending_marks(self):
+        self.client.get(self.topic.get_absolute_url())
+        forums = list(Forum.objects.filter(id=self.forum.id))
+        self.assertTrue(pybb_forum_unread(forums, self.user_ann)[0].unread)
+        self.client.get(self.topic_2.get_absolute_url())
+        forums = list(Forum.objects.filter(id=self.forum.id))
+        self.assertFalse(pybb_forum_unread(forums, self.user_ann)[0].unread)
+        self.assertEqual(read_tracking.get_unread_counts(self.user_ann)['total'], 0)
+        self.assertEqual(self.count_marks(), 0)
+        self.assertEqual(len(self.tracker.get_pending(self.user_ann)), 2)
+
+    def test_flush_keeps_read_times(self):
+        self.client.get(self.topic.get_absolute_url())
+        self.client.get(self.topic_2.get_absolute_url())
+        Post.objects.create(topic=self.topic, user=self.user, body='three')
+        out = StringIO()
+        call_command('pybb_flush_read_marks', stdout=out)
+        self.assertIn('2 read marks', out.getvalue())
+        self.assertGreater(self.count_marks(), 0)
+        self.assertEqual(self.tracker.get_pending(self.user_ann), {})
+        self.assertListEqual(self.get_topic_unread(), [True, False])
+
+    def test_marks_are_not_flushed_by_requests(self):
+        for i in range(3):
+            self.client.get(self.topic.get_absolute_url())
+            self.client.get(self.topic_2.get_absolute_url())
+        self.assertEqual(self.count_marks(), 0)
+        self.assertEqual(self.tracker.flush(), 6)
+        self.assertGreater(self.count_marks(), 0)
+        self.assertEqual(self.tracker.flush(), 0)
+
+    def test_cache_resolved_once(self):
+        aliases = []
+        orig_get_cache = read_tracking.get_cache
+        read_tracking.get_cache = lambda alias: aliases.append(alias) or orig_get_cache(alias)
+        try:
+            tracker = read_tracking.BufferedReadTracker(self.tracker_class(), 3600)
+            self.assertIs(tracker.cache, tracker.cache)
+            self.assertEqual(aliases, ['default'])
+        finally:
+            read_tracking.get_cache = orig_get_cache
+
+    def test_cache_log_keeps_concurrent_appends(self):
+        log = read_tracking.CacheLog(self.tracker.cache, 'test', 60)
+        log.append(1)
+        log.append(2)
+        end, values = log.collect()
+        self.assertEqual(sorted(values), [1, 2])
+        # appended while collected values are written
+        log.append(3)
+        log.drop(end)
+        self.assertEqual(log.values(), [3])
+        # slot taken by append which is not finished yet is skipped by collect
+        index = self.tracker.cache.incr(log.key('count'))
+        end, values = log.collect()
+        self.assertEqual(values, [3])
+        log.drop(end)
+        self.assertFalse(self.tracker.cache.add(log.key(index), 4))
+        log.append(5)
+        self.assertEqual(log.values(), [5])
+
+    def test_flush_lock(self):
+        self.client.get(self.topic.get_absolute_url())
+        self.tracker.cache.add(util.build_cache_key('read_marks_flush'), True, 60)
+        self.assertEqual(self.tracker.flush(), 0)
+        self.tracker.cache.delete(util.build_cache_key('read_marks_flush'))
+        self.assertEqual(self.tracker.flush(), 1)
+
+    def test_mark_all_as_read(self):
+        self.client.get(self.topic.get_absolute_url())
+        self.client.get(reverse('pybb_pybb:mark_all_as_read'))
+        self.assertListEqual(self.get_topic_unread(), [False, False])
+        self.tracker.flush()
+        self.assertListEqual(self.get_topic_unread(), [False, False])
+
+
+class BufferedWatermarkReadTrackerTest(BufferedReadTrackerTest):
+    tracker_class = read_tracking.WatermarkReadTracker
+
+
+class UnreadCountsTest(TestCase, SharedTestModule):
+    tracker_class = read_tracking.DefaultReadTracker
+
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.category_2 = Category.objects.create(name='bar', client=self.client_for)
+        self.forum_2 = Forum.objects.create(name='forum_2', category=self.category_2)
+        self.topic_2 = Topic.objects.create(name='topic_2', forum=self.forum_2, user=self.user)
+        Post.objects.create(topic=self.topic_2, user=self.user, body='two')
+        self.topic_3 = Topic.objects.create(name='topic_3', forum=self.forum_2, user=self.user)
+        Post.objects.create(topic=self.topic_3, user=self.user, body='three')
+        self.user_ann = User.objects.create_user('ann', 'ann@localhost', 'ann')
+        self.client.login(username='ann', password='ann')
+        self.ORIG_READ_TRACKER = read_tracking.read_tracker
+        read_tracking.read_tracker = self.tracker_class()
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+        read_tracking.read_tracker = self.ORIG_READ_TRACKER
+
+    def get_counts(self):
+        counts = read_tracking.get_unread_counts(self.user_ann)
+        return (counts['total'], counts['forums'].get(self.forum.id, 0),
+                counts['forums'].get(self.forum_2.id, 0), counts['categories'].get(self.category_2.id, 0),
+                counts['clients'].get('pybb', 0))
+
+    def test_unread_counts(self):
+        self.assertEqual(self.get_counts(), (3, 1, 2, 2, 3))
+        with self.assertNumQueries(0):
+            self.get_counts()
+
+        self.client.get(self.topic_3.get_absolute_url())
+        self.assertEqual(self.get_counts(), (2, 1, 1, 1, 2))
+        self.client.get(self.topic_2.get_absolute_url())
+        self.assertEqual(self.get_counts(), (1, 1, 0, 0, 1))
+
+        Post.objects.create(topic=self.topic_3, user=self.user, body='four')
+        self.assertEqual(self.get_counts(), (2, 1, 1, 1, 2))
+
+        self.client.get(reverse('pybb_pybb:mark_all_as_read'))
+        self.assertEqual(self.get_counts(), (0, 0, 0, 0, 0))
+
+    def test_unread_counts_view(self):
+        response = self.client.get(reverse('pybb_pybb:unread_counts'))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        counts = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(counts['total'], 3)
+        self.assertEqual(counts['forums'], {str(self.forum.id): 1, str(self.forum_2.id): 2})
+        self.assertEqual(counts['clients'], {'pybb': 3})
+
+        self.client.logout()
+        response = self.client.get(reverse('pybb_pybb:unread_counts'))
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['total'], 0)
+
+    def test_unread_counts_per_client(self):
+        other_client = ClientModel.objects.create(name='Other', code='other')
+        other_forum = Forum.objects.create(
+            name='other', category=Category.objects.create(name='other', client=other_client))
+        other_topic = Topic.objects.create(name='other', forum=other_forum, user=self.user)
+        Post.objects.create(topic=other_topic, user=self.user, body='other')
+
+        self.assertEqual(read_tracking.get_unread_counts(self.user_ann)['total'], 4)
+        self.assertEqual(read_tracking.get_unread_counts(self.user_ann, 'pybb')['total'], 3)
+        self.assertEqual(read_tracking.get_unread_counts(self.user_ann, other_client)['clients'], {'other': 1})
+        response = self.client.get(reverse('pybb_pybb:unread_counts'))
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['clients'], {'pybb': 3})
+
+        # posts of other client's forum don't drop cached counts of this client
+        Post.objects.create(topic=other_topic, user=self.user, body='other 2')
+        with self.assertNumQueries(0):
+            self.assertEqual(read_tracking.get_unread_counts(self.user_ann, 'pybb')['total'], 3)
+        self.assertEqual(read_tracking.get_unread_counts(self.user_ann)['total'], 4)
+        Post.objects.create(topic=self.topic, user=self.user, body='again')
+        self.assertEqual(read_tracking.get_unread_counts(self.user_ann, 'pybb')['total'], 3)
+
+        other_topic.forum = self.forum
+        other_topic.save()
+        self.assertEqual(read_tracking.get_unread_counts(self.user_ann, 'pybb')['total'], 4)
+
+
+    def test_subscribed_unread_topics(self):
+        topics = [self.topic, self.topic_2, self.topic_3]
+        for topic in topics:
+            topic.subscribers.add(self.user_ann)
+        topic_4 = Topic.objects.create(name='topic_4', forum=self.forum_2, user=self.user)
+        Post.objects.create(topic=topic_4, user=self.user, body='four')
+        self.client.get(self.topic_2.get_absolute_url())
+
+        with self.assertNumQueries(1 if self.tracker_class is read_tracking.DefaultReadTracker else 2):
+            unread = list(read_tracking.get_subscribed_unread_topics(self.user_ann))
+        self.assertListEqual(unread, [self.topic_3, self.topic])
+
+        Post.objects.create(topic=self.topic_2, user=self.user, body='five')
+        self.assertListEqual(list(read_tracking.get_subscribed_unread_topics(self.user_ann)),
+                             [self.topic_2, self.topic_3, self.topic])
+
+        orig_paginate_by = pybb_views.SubscribedTopicsView.paginate_by
+        pybb_views.SubscribedTopicsView.paginate_by = 2
+        try:
+            url = reverse('pybb_pybb:subscribed_unread_topics')
+            response = self.client.get(url)
+            self.assertListEqual(list(response.context['topic_list']), [self.topic_2, self.topic_3])
+            self.assertTrue(all(t.unread for t in response.context['topic_list']))
+            response = self.client.get(url, data={'before': response.context['next_cursor']})
+            self.assertListEqual(list(response.context['topic_list']), [self.topic])
+            self.assertIsNone(response.context['next_cursor'])
+        finally:
+            pybb_views.SubscribedTopicsView.paginate_by = orig_paginate_by
+
+
+class WatermarkUnreadCountsTest(UnreadCountsTest):
+    tracker_class = read_tracking.WatermarkReadTracker
+
+
 class CustomPermissionHandler(permissions.DefaultPermissionHandler):
     """
     a custom permission handler which changes the meaning of "hidden" forum:
@@ -1453,6 +2690,9 @@ class CustomPermissionHandler(permissions.DefaultPermissionHandler):
         qs = qs.filter(closed=False)  # filter out closed topics for test
         return qs
 
+    def may_view_all_topics(self, user, forum):
+        return False  # closed topics are filtered out, stored counter doesn't match
+
     def may_view_topic(self, user, topic):
         return self.may_view_forum(user, topic.forum)
 
@@ -1529,7 +2769,8 @@ class CustomPermissionHandlerTest(TestCase, SharedTestModule):
             self.assertEqual(r.status_code, 302 if f.hidden or f.category.hidden else 200)
             r = self.get_with_user(f.get_absolute_url(), 'zeus', 'zeus')
             self.assertEqual(r.status_code, 200)
-            self.assertEqual(r.context['object_list'].count(), f.topics.filter(closed=False).count())
+            self.assertEqual(len(r.context['object_list']), f.topics.filter(closed=False).count())
+            self.assertEqual(r.context['paginator'].count, f.topics.filter(closed=False).count())
 
     def test_topic_permission(self):
         for t in Topic.objects.all():
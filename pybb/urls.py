@@ -11,7 +11,7 @@ from pybb.views import IndexView, CategoryView, ForumView, TopicView,\
     AddPostView, EditPostView, UserView, PostView, ProfileEditView,\
     DeletePostView, StickTopicView, UnstickTopicView, CloseTopicView,\
     OpenTopicView, ModeratePost, TopicPollVoteView, LatestTopicsView,\
-    UserTopics, UserPosts, topic_cancel_poll_vote
+    UserTopics, UserPosts, SubscribedTopicsView, topic_cancel_poll_vote
 
 
 urlpatterns = patterns('',
@@ -64,10 +64,17 @@ urlpatterns += patterns('pybb.views',
                             'delete_subscription', name='delete_subscription'),
                         url('^subscription/topic/(\d+)/add/$',
                             'add_subscription', name='add_subscription'),
+                        url('^subscription/topic/unread/$', SubscribedTopicsView.as_view(),
+                            name='subscribed_unread_topics'),
 
                         # API
                         url('^api/post_ajax_preview/$', 'post_ajax_preview', name='post_ajax_preview'),
+                        url('^api/unread_counts/$', 'unread_counts', name='unread_counts'),
 
                         # Commands
-                        url('^mark_all_as_read/$', 'mark_all_as_read', name='mark_all_as_read')
+                        url('^mark_all_as_read/$', 'mark_all_as_read', name='mark_all_as_read'),
+                        url('^category/(?P<category_id>\d+)/mark_as_read/$', 'mark_all_as_read',
+                            name='mark_category_as_read'),
+                        url('^forum/(?P<forum_id>\d+)/mark_as_read/$', 'mark_all_as_read',
+                            name='mark_forum_as_read'),
                         )
@@ -3,7 +3,11 @@ from __future__ import unicode_literals
 import os
 import re
 import uuid
+import datetime
 import django
+from django.conf import settings
+from django.db import connection
+from django.utils import six, timezone
 from django.utils.translation import ugettext as _
 
 
@@ -76,10 +80,188 @@ def get_pybb_profile_model():
 def build_cache_key(key_name, **kwargs):
     if key_name == 'anonymous_topic_views':
         return 'pybbm_anonymous_topic_%s_views' % kwargs['topic_id']
+    elif key_name == 'rendered_markup':
+        return 'pybbm_rendered_markup_%s' % kwargs['hash']
+    elif key_name == 'read_marks':
+        return 'pybbm_read_marks_%s_%s' % (kwargs['log'], kwargs['item'])
+    elif key_name == 'read_marks_queued':
+        return 'pybbm_read_marks_queued_%s' % kwargs['user_id']
+    elif key_name == 'read_marks_flush':
+        return 'pybbm_read_marks_flush'
+    elif key_name == 'unread_counts':
+        return 'pybbm_unread_counts_%s' % kwargs['user_id']
+    elif key_name == 'unread_counts_version':
+        return 'pybbm_unread_counts_version_%s' % kwargs['forum_id']
+    elif key_name == 'moderators':
+        return 'pybbm_moderators'
+    elif key_name == 'visible_forums':
+        return 'pybbm_visible_forums_%s' % kwargs['version']
+    elif key_name == 'visible_forums_version':
+        return 'pybbm_visible_forums_version'
     else:
         raise ValueError('Wrong key_name parameter passed: %s' % key_name)
 
 
+def get_cache(alias):
+    """
+    Return django cache with `alias` from CACHES setting
+    """
+    try:
+        from django.core.cache import caches
+    except ImportError:  # django < 1.7
+        from django.core.cache import get_cache as get_cache_by_alias
+        return get_cache_by_alias(alias)
+    return caches[alias]
+
+
+def invalidate_unread_counts(user=None, forum_ids=None):
+    """
+    Drop cached unread counts of `user`, or change versions of forums with
+    `forum_ids`, so counts of users who see these forums are recalculated.
+    Without arguments versions of all forums are changed
+    """
+    from django.core.cache import cache
+    from pybb import defaults
+
+    if user is not None:
+        cache.delete(build_cache_key('unread_counts', user_id=user.pk))
+        return
+    if forum_ids is None:
+        from pybb.models import Forum
+        forum_ids = Forum.objects.values_list('id', flat=True)
+    version = uuid.uuid4().hex
+    cache.set_many(dict((build_cache_key('unread_counts_version', forum_id=forum_id), version)
+                        for forum_id in forum_ids), defaults.PYBB_UNREAD_COUNTS_CACHE_TIMEOUT)
+
+
+def invalidate_moderators():
+    """
+    Drop cached maps of forum moderators
+    """
+    from django.core.cache import cache
+
+    cache.delete(build_cache_key('moderators'))
+
+
+def invalidate_visible_forums():
+    """
+    Change version of cached ids of forums visible for every client and role.
+    Call it after changing `hidden` or `category` of forums or `hidden` or
+    `client` of categories with `QuerySet.update`
+    """
+    from django.core.cache import cache
+    from pybb import defaults
+
+    cache.set(build_cache_key('visible_forums_version'), uuid.uuid4().hex,
+              defaults.PYBB_VISIBLE_FORUMS_CACHE_TIMEOUT)
+
+
+def filter_by_client(qs, client):
+    """
+    Limit queryset of topics or posts to `client` (Client instance, id or
+    code from PYBB_CLIENT_FORUMS) with stored `client` field, so no joins
+    to forum and category are needed. Falsy `client` leaves queryset as is
+    """
+    if not client:
+        return qs
+    if isinstance(client, six.string_types):
+        return qs.filter(client__code=client)
+    return qs.filter(client=client)
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def datetime_to_micro(value):
+    """
+    Convert datetime to integer count of microseconds since epoch
+    """
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def micro_to_datetime(micro):
+    value = _EPOCH + datetime.timedelta(microseconds=micro)
+    if settings.USE_TZ:
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def encode_cursor(values):
+    """
+    Encode values of ordering fields of object (datetimes, booleans,
+    numbers or None) to string used in urls for keyset pagination
+    """
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append('')
+        elif isinstance(value, datetime.datetime):
+            parts.append('%d' % datetime_to_micro(value))
+        elif isinstance(value, bool):
+            parts.append('1' if value else '0')
+        else:
+            parts.append('%s' % value)
+    return '_'.join(parts)
+
+
+def decode_cursor(cursor, fields):
+    """
+    Return list of values of model `fields` from string made by
+    `encode_cursor` or None if string is malformed
+    """
+    from django.core.exceptions import ValidationError
+    from django.db import models
+
+    parts = cursor.split('_')
+    if len(parts) != len(fields):
+        return None
+    values = []
+    try:
+        for field, part in zip(fields, parts):
+            if part == '':
+                values.append(None)
+            elif isinstance(field, models.DateTimeField):
+                values.append(micro_to_datetime(int(part)))
+            elif isinstance(field, models.BooleanField):
+                values.append(part == '1')
+            else:
+                values.append(field.to_python(part))
+    except (ValueError, OverflowError, ValidationError):
+        return None
+    return values
+
+
+def keyset_filter(ordering, values):
+    """
+    Return Q selecting objects which follow object with `values` of
+    `ordering` fields ((name, descending) pairs, last field should be
+    unique) in queryset ordered by these fields
+    """
+    from django.db.models import Q
+
+    # NULL is the smallest value for these databases and the largest one
+    # for others
+    nulls_first = connection.vendor in ('sqlite', 'mysql')
+    condition = None
+    equal = Q()
+    for (name, descending), value in zip(ordering, values):
+        if value is None:
+            after = Q(**{'%s__isnull' % name: False}) if nulls_first != descending else None
+            same = Q(**{'%s__isnull' % name: True})
+        else:
+            after = Q(**{'%s__%s' % (name, 'lt' if descending else 'gt'): value})
+            if nulls_first == descending:
+                after |= Q(**{'%s__isnull' % name: True})
+            same = Q(**{name: value})
+        if after is not None:
+            condition = equal & after if condition is None else condition | (equal & after)
+        equal &= same
+    return condition
+
+
 def get_file_path(instance, filename, to):
     """
     This function generate filename with uuid4
@@ -89,4 +271,93 @@ def get_file_path(instance, filename, to):
     """
     ext = filename.split('.')[-1]
     filename = "%s.%s" % (uuid.uuid4(), ext)
-    return os.path.join(to, filename)
\ No newline at end of file
+    return os.path.join(to, filename)
+
+
+class FieldTrackerMixin(object):
+    """
+    Model mixin which remembers values of `tracked_fields` (attribute names)
+    as they were loaded from database, so `save` can find out what was
+    changed without refetching the instance.
+    Model should call `reset_tracked_fields` when it's saved.
+    """
+    tracked_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        super(FieldTrackerMixin, self).__init__(*args, **kwargs)
+        self.reset_tracked_fields()
+
+    def reset_tracked_fields(self):
+        # deferred fields are not loaded, so they are not in instance dict
+        self._tracked_values = dict(
+            (name, self.__dict__[name]) for name in self.tracked_fields
+            if name in self.__dict__)
+
+    def original_value(self, name):
+        """
+        Get value of tracked field as it is stored in database
+        """
+        if name in self._tracked_values:
+            return self._tracked_values[name]
+        return self.__class__._default_manager.filter(
+            pk=self.pk).values_list(name, flat=True)[0]
+
+    def field_changed(self, name):
+        """
+        Check if tracked field was changed since instance was loaded or saved
+        """
+        if self.pk is None:
+            return True
+        return getattr(self, name) != self.original_value(name)
+
+
+# rows per single INSERT statement, keeps query parameters count
+# below sqlite limit
+INSERT_BATCH_SIZE = 100
+
+
+def upsert_supported():
+    """
+    Check if database supports INSERT ... ON CONFLICT/ON DUPLICATE KEY UPDATE
+    """
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 24, 0)
+    return connection.vendor == 'mysql'
+
+
+def bulk_insert(model, fields, rows, conflict_fields=(), update_fields=()):
+    """
+    Insert rows of `fields` values to table of `model` with one multi row
+    INSERT statement per batch. Unlike `QuerySet.bulk_create` it keeps
+    given values of `auto_now` fields. Signals are not sent.
+
+    If `conflict_fields` are given, rows which conflict with existing ones
+    by unique constraint on these fields update `update_fields` of existing
+    rows instead (check `upsert_supported` before).
+    """
+    qn = connection.ops.quote_name
+    fields = [model._meta.get_field(name) for name in fields]
+    placeholder = '(%s)' % ', '.join(['%s'] * len(fields))
+    suffix = ''
+    if conflict_fields:
+        update_columns = [qn(model._meta.get_field(name).column) for name in update_fields]
+        if connection.vendor == 'mysql':
+            suffix = ' ON DUPLICATE KEY UPDATE %s' % ', '.join(
+                '%s = VALUES(%s)' % (column, column) for column in update_columns)
+        else:
+            suffix = ' ON CONFLICT (%s) DO UPDATE SET %s' % (
+                ', '.join(qn(model._meta.get_field(name).column) for name in conflict_fields),
+                ', '.join('%s = EXCLUDED.%s' % (column, column) for column in update_columns))
+    cursor = connection.cursor()
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        batch = rows[start:start + INSERT_BATCH_SIZE]
+        params = []
+        for row in batch:
+            params.extend(field.get_db_prep_save(value, connection=connection)
+                          for field, value in zip(fields, row))
+        cursor.execute('INSERT INTO %s (%s) VALUES %s%s' % (
+            qn(model._meta.db_table), ', '.join(qn(field.column) for field in fields),
+            ', '.join([placeholder] * len(batch)), suffix), params)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals
+import json
 import math
 
 from django.contrib.auth.decorators import login_required
@@ -8,7 +9,7 @@ from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
 from django.contrib import messages
-from django.db.models import F, Q
+from django.db.models import F
 from django.db.models.aggregates import Count
 from django.http import (
     HttpResponseRedirect, HttpResponse, Http404,
@@ -21,6 +22,7 @@ from django.core.exceptions import ImproperlyConfigured
 from django.views.generic.edit import ModelFormMixin
 from django.views.decorators.csrf import csrf_protect, requires_csrf_token
 from django.views import generic
+from pybb.markup import render_markup
 from pybb.util import build_cache_key
 
 try:
@@ -30,20 +32,16 @@ except ImportError:
     # the simplest emulation of django-pure-pagination behavior
     from django.core.paginator import Paginator, Page
 
-    class PageRepr(int):
-        def querystring(self):
-            return 'page=%s' % self
     Page.pages = lambda self: [PageRepr(i) for i in range(
         1, self.paginator.num_pages + 1)]
     pure_pagination = False
 
-from pybb.models import (
-    Category, Forum, Topic, Post, TopicReadTracker,
-    ForumReadTracker, PollAnswerUser)
+from pybb.models import Category, Forum, Topic, Post, PollAnswerUser
 from pybb.forms import (
     PostForm, AdminPostForm, AttachmentFormSet, PollAnswerFormSet, PollForm)
-from pybb.templatetags.pybb_tags import pybb_topic_poll_not_voted
-from pybb import defaults
+from pybb.templatetags.pybb_tags import (
+    UnreadCheckedList, pybb_forum_unread, pybb_topic_poll_not_voted)
+from pybb import defaults, read_tracking
 
 from pybb.permissions import perms
 
@@ -53,7 +51,75 @@ User = util.get_user_model()
 username_field = util.get_username_field()
 
 
+class PageRepr(int):
+    def querystring(self):
+        return 'page=%s' % self
+
+
+class KeysetPaginator(object):
+    """
+    Counts of pages selected by keyset pagination
+    """
+    def __init__(self, count, per_page):
+        self.count = count
+        self.per_page = per_page
+        self.num_pages = max(int(math.ceil(count / float(per_page))), 1)
+        self.page_range = range(1, self.num_pages + 1)
+
+
+class KeysetPage(object):
+    """
+    Page selected by keyset pagination, provides the same attributes as
+    django Page used in pagination templates. Link to next page should
+    pass `next_cursor` in `after` parameter
+    """
+    def __init__(self, object_list, number, paginator, has_next, next_cursor):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_next = has_next
+        self.next_cursor = next_cursor
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def start_index(self):
+        return (self.number - 1) * self.paginator.per_page + 1
+
+    def end_index(self):
+        return self.start_index() + len(self.object_list) - 1
+
+    def pages(self):
+        return [PageRepr(i) for i in range(1, max(self.paginator.num_pages, self.number) + 1)]
+
+
 class PaginatorMixin(object):
+    # Keyset pagination mode: (field name, descending) pairs of queryset
+    # ordering, last field should be unique. Next page is selected with
+    # WHERE on these fields after the last object of current page (`after`
+    # parameter), page by number with `get_page_queryset`, and count of
+    # objects is taken from `get_count`, so deep pages cost as much as the
+    # first one. Used if PYBB_KEYSET_PAGINATION setting is True
+    keyset_ordering = None
+
     def get_paginator(
             self, queryset, per_page, orphans=0,
             allow_empty_first_page=True, **kwargs):
@@ -64,6 +130,64 @@ class PaginatorMixin(object):
             queryset, per_page, orphans=0,
             allow_empty_first_page=True, **kwargs)
 
+    def get_count(self, queryset):
+        """
+        Count of objects of filtered `queryset` for keyset pagination, views
+        may return stored counter if it counts the same objects
+        """
+        return queryset.count()
+
+    def get_page_queryset(self, queryset, number, page_size):
+        """
+        Queryset starting from the first object of page `number` for keyset
+        pagination. By default ordering fields of the last object of previous
+        page are read with OFFSET over these fields only (index scan without
+        joins), page is selected after them with WHERE
+        """
+        if number == 1:
+            return queryset
+        values = list(queryset.values_list(*[
+            name for name, descending in self.keyset_ordering
+        ])[(number - 1) * page_size - 1:(number - 1) * page_size])
+        if not values:
+            return queryset.none()
+        return queryset.filter(util.keyset_filter(self.keyset_ordering, values[0]))
+
+    def paginate_queryset(self, queryset, page_size):
+        if not (self.keyset_ordering and defaults.PYBB_KEYSET_PAGINATION):
+            return super(PaginatorMixin, self).paginate_queryset(queryset, page_size)
+
+        paginator = KeysetPaginator(self.get_count(queryset), page_size)
+        page = self.kwargs.get(self.page_kwarg) or self.request.GET.get(self.page_kwarg) or 1
+        if page == 'last':
+            number = paginator.num_pages
+        else:
+            try:
+                number = int(page)
+            except ValueError:
+                raise Http404(_('Page is not "last", nor can it be converted to an int.'))
+
+        values = None
+        cursor = self.request.GET.get('after')
+        if cursor:
+            values = util.decode_cursor(cursor, [
+                queryset.model._meta.get_field(name) for name, descending in self.keyset_ordering])
+        if values is not None:
+            queryset = queryset.filter(util.keyset_filter(self.keyset_ordering, values))
+        elif number < 1 or number > paginator.num_pages:
+            raise Http404(_('Invalid page (%(page_number)s)') % {'page_number': number})
+        else:
+            queryset = self.get_page_queryset(queryset, number, page_size)
+
+        object_list = list(queryset[:page_size + 1])
+        has_next = len(object_list) > page_size
+        del object_list[page_size:]
+        next_cursor = util.encode_cursor([
+            getattr(object_list[-1], name) for name, descending in self.keyset_ordering
+        ]) if has_next else None
+        page = KeysetPage(object_list, number, paginator, has_next, next_cursor)
+        return paginator, page, object_list, page.has_other_pages()
+
 
 # custom view mixin that will look up templates from client specific locations.
 class ClientTemplateViewMixin(object):
@@ -127,10 +251,21 @@ class IndexView(ClientTemplateViewMixin, generic.ListView):
 
     def get_context_data(self, **kwargs):
         ctx = super(IndexView, self).get_context_data(**kwargs)
-        categories = ctx['categories']
+        categories = list(ctx['categories'])
+        # forums of all categories are fetched and checked for unread
+        # messages at once
+        forums = pybb_forum_unread(perms.filter_forums(
+            self.request.user, Forum.objects.filter(
+                category__in=categories, parent=None
+            ).select_related('category__client', 'last_post__user')),
+            self.request.user)
+        forums_by_category = {}
+        for forum in forums:
+            forums_by_category.setdefault(
+                forum.category_id, UnreadCheckedList()).append(forum)
         for category in categories:
-            category.forums_accessed = perms.filter_forums(
-                self.request.user, category.forums.filter(parent=None))
+            category.forums_accessed = forums_by_category.get(
+                category.id, UnreadCheckedList())
         ctx['categories'] = categories
         return ctx
 
@@ -163,7 +298,8 @@ class CategoryView(
     def get_context_data(self, **kwargs):
         ctx = super(CategoryView, self).get_context_data(**kwargs)
         ctx['category'].forums_accessed = perms.filter_forums(
-            self.request.user, ctx['category'].forums.filter(parent=None))
+            self.request.user, ctx['category'].forums.filter(
+                parent=None).select_related('last_post__user'))
         ctx['categories'] = [ctx['category']]
         return ctx
 
@@ -176,6 +312,7 @@ class ForumView(
     paginate_by = defaults.PYBB_FORUM_PAGE_SIZE
     context_object_name = 'topic_list'
     template_name = 'pybb/forum.html'
+    keyset_ordering = (('sticky', True), ('updated', True), ('id', True))
 
     def get_login_redirect_url(self):
         return reverse('%s_pybb:forum' % self.request.pybb_client, args=(
@@ -185,19 +322,35 @@ class ForumView(
         ctx = super(ForumView, self).get_context_data(**kwargs)
         ctx['forum'] = self.forum
         ctx['forum'].forums_accessed = perms.filter_forums(
-            self.request.user, self.forum.child_forums.all())
+            self.request.user,
+            self.forum.child_forums.select_related(
+                'category__client', 'last_post__user'))
         return ctx
 
     def get_queryset(self):
         self.forum = get_object_or_404(
-            Forum.objects.all(), pk=self.kwargs['pk'])
+            Forum.objects.select_related('category__client'),
+            pk=self.kwargs['pk'])
         if not perms.may_view_forum(self.request.user, self.forum):
             raise PermissionDenied
 
-        qs = self.forum.topics.order_by('-sticky', '-updated').select_related()
+        qs = self.forum.topics.order_by('-sticky', '-updated', '-id').select_related(
+            'forum__category__client', 'last_post__user')
         qs = perms.filter_topics(self.request.user, qs)
         return qs
 
+    def all_topics_visible(self):
+        """
+        True if user sees all topics of forum, so stored topic counter matches
+        them (see `may_view_all_topics` of permission handler)
+        """
+        return perms.may_view_all_topics(self.request.user, self.forum)
+
+    def get_count(self, queryset):
+        if self.all_topics_visible():
+            return self.forum.topic_count
+        return queryset.count()
+
 
 @permissions_decorator()
 class LatestTopicsView(
@@ -208,11 +361,53 @@ class LatestTopicsView(
     template_name = 'pybb/latest_topics.html'
 
     def get_queryset(self):
-        qs = Topic.objects.all().select_related()
+        qs = util.filter_by_client(Topic.objects.all(), self.request.pybb_client).select_related(
+            'forum__category__client', 'last_post__user')
         qs = perms.filter_topics(self.request.user, qs)
         return qs.order_by('-updated')
 
 
+class SubscribedTopicsView(ClientTemplateViewMixin, generic.ListView):
+    """
+    Topics subscribed by user with unread posts. Pages are selected by
+    (updated, id) of the last topic on previous page passed in `before`
+    """
+    paginate_by = defaults.PYBB_FORUM_PAGE_SIZE
+    context_object_name = 'topic_list'
+    template_name = 'pybb/subscribed_topics.html'
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        return super(SubscribedTopicsView, self).dispatch(request, *args, **kwargs)
+
+    keyset_ordering = (('updated', True), ('id', True))
+
+    def paginate_queryset(self, queryset, page_size):
+        values = util.decode_cursor(self.request.GET.get('before', ''), [
+            Topic._meta.get_field(name) for name, descending in self.keyset_ordering])
+        if values is not None:
+            queryset = queryset.filter(util.keyset_filter(self.keyset_ordering, values))
+        topics = UnreadCheckedList(queryset[:page_size + 1])
+        has_next = len(topics) > page_size
+        del topics[page_size:]
+        for topic in topics:
+            topic.unread = True
+        self.next_cursor = util.encode_cursor([
+            getattr(topics[-1], name) for name, descending in self.keyset_ordering
+        ]) if has_next else None
+        return None, None, topics, False
+
+    def get_context_data(self, **kwargs):
+        ctx = super(SubscribedTopicsView, self).get_context_data(**kwargs)
+        ctx['next_cursor'] = self.next_cursor
+        return ctx
+
+    def get_queryset(self):
+        return util.filter_by_client(
+            read_tracking.get_subscribed_unread_topics(self.request.user),
+            self.request.pybb_client).select_related('forum__category__client', 'last_post__user')
+
+
 @permissions_decorator()
 class TopicView(
         ClientTemplateViewMixin, RedirectToLoginMixin,
@@ -220,6 +415,7 @@ class TopicView(
     paginate_by = defaults.PYBB_TOPIC_PAGE_SIZE
     template_object_name = 'post_list'
     template_name = 'pybb/topic.html'
+    keyset_ordering = (('created', False), ('id', False))
 
     def get_login_redirect_url(self):
         return reverse('%s_pybb:topic' % self.request.pybb_client, args=(
@@ -228,23 +424,13 @@ class TopicView(
     @method_decorator(requires_csrf_token)
     def dispatch(self, request, *args, **kwargs):
         self.topic = get_object_or_404(
-            Topic.objects.select_related('forum'), pk=kwargs['pk'])
+            Topic.objects.select_related('forum__category__client'),
+            pk=kwargs['pk'])
 
         if request.GET.get('first-unread'):
             if request.user.is_authenticated():
-                read_dates = []
-                try:
-                    read_dates.append(TopicReadTracker.objects.get(
-                        user=request.user, topic=self.topic).time_stamp)
-                except TopicReadTracker.DoesNotExist:
-                    pass
-                try:
-                    read_dates.append(ForumReadTracker.objects.get(
-                        user=request.user, forum=self.topic.forum).time_stamp)
-                except ForumReadTracker.DoesNotExist:
-                    pass
-
-                read_date = read_dates and max(read_dates)
+                read_date = read_tracking.read_tracker.get_topic_read_times(
+                    request.user, [self.topic]).get(self.topic.id)
                 if read_date:
                     try:
                         first_unread_topic = self.topic.posts.filter(
@@ -277,7 +463,7 @@ class TopicView(
                         defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER
                     )
                 cache.set(cache_key, 0)
-        qs = self.topic.posts.all().select_related('user')
+        qs = self.topic.posts.order_by('created', 'id').select_related('user')
         if defaults.PYBB_PROFILE_RELATED_NAME:
             qs = qs.select_related(
                 'user__%s' % defaults.PYBB_PROFILE_RELATED_NAME)
@@ -321,36 +507,28 @@ class TopicView(
 
         return ctx
 
+    def all_posts_visible(self):
+        """
+        True if user sees all posts of topic, so stored post counter and
+        positions match them: moderators see posts without filtering, others
+        if `may_view_all_posts` of permission handler allows it
+        """
+        return perms.may_moderate_topic(self.request.user, self.topic) or \
+            perms.may_view_all_posts(self.request.user, self.topic)
+
+    def get_count(self, queryset):
+        if self.all_posts_visible():
+            return self.topic.post_count
+        return queryset.count()
+
+    def get_page_queryset(self, queryset, number, page_size):
+        if self.all_posts_visible():
+            return queryset.filter(position__gt=(number - 1) * page_size)
+        return super(TopicView, self).get_page_queryset(queryset, number, page_size)
+
     def mark_read(self, user, topic):
-        try:
-            forum_mark = ForumReadTracker.objects.get(
-                forum=topic.forum, user=user)
-        except ForumReadTracker.DoesNotExist:
-            forum_mark = None
-        if (forum_mark is None) or (forum_mark.time_stamp < topic.updated):
-            # Mark topic as readed
-            topic_mark, new = TopicReadTracker.objects.get_or_create_tracker(
-                topic=topic, user=user)
-            if not new:
-                topic_mark.save()
-
-            # Check, if there are any unread topics in forum
-            readed = topic.forum.topics.filter((Q(
-                topicreadtracker__user=user,
-                topicreadtracker__time_stamp__gte=F('updated'))) | Q(
-                    forum__forumreadtracker__user=user,
-                    forum__forumreadtracker__time_stamp__gte=F(
-                        'updated'))).only('id').order_by()
-
-            not_readed = topic.forum.topics.exclude(id__in=readed)
-            if not not_readed.exists():
-                # Clear all topic marks for this forum, mark forum as readed
-                TopicReadTracker.objects.filter(
-                    user=user, topic__forum=topic.forum).delete()
-                forum_mark, new = \
-                    ForumReadTracker.objects.get_or_create_tracker(
-                        forum=topic.forum, user=user)
-                forum_mark.save()
+        read_tracking.read_tracker.mark_topic_read(user, topic)
+        util.invalidate_unread_counts(user)
 
 
 class PostEditMixin(object):
@@ -393,7 +571,7 @@ class PostEditMixin(object):
         if perms.may_create_poll(self.request.user):
             pollformset = PollAnswerFormSet()
             if getattr(self, 'forum', None) or \
-                    self.object.topic.head == self.object:
+                    self.object.topic.head_id == self.object.id:
                 if self.object.topic.poll_type != Topic.POLL_TYPE_NONE:
                     pollformset = PollAnswerFormSet(
                         self.request.POST, instance=self.object.topic)
@@ -554,7 +732,7 @@ class UserPosts(ClientTemplateViewMixin, PaginatorMixin, generic.ListView):
 
     def get_queryset(self):
         qs = super(UserPosts, self).get_queryset()
-        qs = qs.filter(user=self.user)
+        qs = util.filter_by_client(qs.filter(user=self.user), self.request.pybb_client)
         qs = perms.filter_posts(self.request.user, qs).select_related('topic')
         qs = qs.order_by('-created', '-updated')
         return qs
@@ -578,7 +756,8 @@ class UserTopics(ClientTemplateViewMixin, PaginatorMixin, generic.ListView):
 
     def get_queryset(self):
         qs = super(UserTopics, self).get_queryset()
-        qs = qs.filter(user=self.user)
+        qs = util.filter_by_client(qs.filter(user=self.user), self.request.pybb_client).select_related(
+            'forum__category__client', 'last_post__user')
         qs = perms.filter_topics(self.user, qs)
         qs = qs.order_by('-updated', '-created')
         return qs
@@ -600,7 +779,7 @@ class PostView(RedirectToLoginMixin, generic.RedirectView):
         post = get_object_or_404(Post.objects.all(), pk=self.kwargs['pk'])
         if not perms.may_view_post(self.request.user, post):
             raise PermissionDenied
-        count = post.topic.posts.filter(created__lt=post.created).count() + 1
+        count = post.position or post.topic.posts.filter(created__lt=post.created).count() + 1
         page = math.ceil(count / float(defaults.PYBB_TOPIC_PAGE_SIZE))
         return '%s?page=%d#post-%d' % (
             reverse('%s_pybb:topic' % self.request.pybb_client, args=[
@@ -787,20 +966,40 @@ def add_subscription(request, topic_id):
 @login_required
 def post_ajax_preview(request):
     content = request.POST.get('data')
-    html = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP](content)
+    html = render_markup(content)
     return render(request, 'pybb/_markitup_preview.html', {'html': html})
 
 
+def unread_counts(request):
+    """
+    Counts of unread topics of current client per forum and category as JSON
+    """
+    counts = read_tracking.get_unread_counts(request.user, request.pybb_client)
+    return HttpResponse(json.dumps(counts),
+                        content_type='application/json')
+
+
 @login_required
-def mark_all_as_read(request):
-    for forum in perms.filter_forums(request.user, Forum.objects.all()):
-        forum_mark, new = ForumReadTracker.objects.get_or_create_tracker(
-            forum=forum, user=request.user)
-        forum_mark.save()
-    TopicReadTracker.objects.filter(user=request.user).delete()
+def mark_all_as_read(request, category_id=None, forum_id=None):
+    """
+    Mark all forums (or forums of category, or forum with subforums) as read
+    """
+    forums = Forum.objects.all()
+    redirect_url = reverse('%s_pybb:index' % request.pybb_client)
+    if category_id is not None:
+        category = get_object_or_404(Category, pk=category_id)
+        forums = forums.filter(category=category)
+        redirect_url = category.get_absolute_url()
+    elif forum_id is not None:
+        forum = get_object_or_404(Forum, pk=forum_id)
+        forums = forum.get_descendants(include_self=True)
+        redirect_url = forum.get_absolute_url()
+    read_tracking.read_tracker.mark_all_read(
+        request.user, perms.filter_forums(request.user, forums))
+    util.invalidate_unread_counts(request.user)
     msg = _('All forums marked as read')
     messages.success(request, msg, fail_silently=True)
-    return redirect(reverse('%s_pybb:index' % request.pybb_client))
+    return redirect(redirect_url)
 
 
 @login_required